@@ -0,0 +1,234 @@
+# Benchmark of the workflow's pipeline stages on the bundled verified-data
+# sets, run locally without the Latch runtime (it needs the workflow's Python
+# dependencies, e.g. inside the workflow image). For every data set and scale
+# it records wall time, peak RSS and bytes written per stage to
+# <output>/benchmark.json and benchmark.csv.
+#
+# Scales above 1 run on synthetic FCS files with scale x the events of each
+# bundled file, drawn with replacement from its events, so that scaling
+# regressions show up on data sizes closer to production:
+#
+#   python benchmark.py --scales 1 10 100 --output /tmp/flow-cyte-benchmark
+
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict
+import argparse
+import json
+import shutil
+
+import cytoflow as flow
+import numpy as np
+import pandas as pd
+
+from wf import plots as plot
+from wf.bins import EventBins
+from wf.compensation import bleedthrough_compensation
+from wf.events import EventTable
+from wf.export import EventWriter
+from wf.fcs import open_events, read_header, write_fcs
+from wf.gates import add_gate_columns, gating_tree
+from wf.metrics import RunMetrics
+from wf.models import apply_gmm
+from wf.pipeline import GMM_PARAMETERS, file_plot_jobs, import_experiment, plot_bin_spec, quadrant_statistics
+from wf.options import PlotOptions
+from wf.sampling import stratified_sample
+from wf.stats import gate_counts, gate_statistics
+from wf.transforms import ChannelTransforms, ScaledEvents
+
+
+TASBE = "TASBE - Li et al"
+PBMC = "BD Biosciences - Monocyte RNA and Protein Co-Staining Analysis"
+
+DATASETS = {
+    "tasbe": dict(
+        condition_name="Dox",
+        files=[(f"{TASBE}/TAL14_{i}.fcs", dox) for i, dox in enumerate(
+            ["0.0", "0.1", "0.2", "0.5", "1.0", "2.0", "5.0", "10.0", "20.0",
+             "50.0", "100.0", "200.0", "500.0", "1000.0", "2000.0"], start=1)],
+        blank_file=f"{TASBE}/controls/Blank-1_H12_H12_P3.fcs",
+        fluor_channels=["Pacific Blue-A", "FITC-A", "PE-Tx-Red-YG-A"],
+        controls={"FITC-A": f"{TASBE}/controls/EYFP-1_H10_H10_P3.fcs",
+                  "PE-Tx-Red-YG-A": f"{TASBE}/controls/mkate-1_H8_H08_P3.fcs",
+                  "Pacific Blue-A": f"{TASBE}/controls/EBFP2-1_H9_H09_P3.fcs"},
+        threshold_gate=None,
+        quad_gate=SimpleNamespace(gate_name="Quad", xchannel="Pacific Blue-A", xthreshold=637.6907814597589,
+                                  ychannel="PE-Tx-Red-YG-A", ythreshold=1130.7109998300425)),
+    "pbmc-protein": dict(
+        condition_name="Stain",
+        files=[(f"{PBMC}/PBMC_CD4_Protein_Stained.fcs", "stained"),
+               (f"{PBMC}/PBMC_CD4_Protein_Unstained.fcs", "unstained")],
+        blank_file=f"{PBMC}/PBMC_CD4_Protein_Unstained.fcs",
+        fluor_channels=["HV 450-A", "PE-A"],
+        controls=None,
+        threshold_gate=SimpleNamespace(gate_name="CD4", channel="PE-A", threshold=1000.0),
+        quad_gate=None),
+    "pbmc-rna-protein": dict(
+        condition_name="Stain",
+        files=[(f"{PBMC}/PBMC_CD4_RNA_Protein_Stained.fcs", "stained"),
+               (f"{PBMC}/PBMC_CD4_RNA_Protein_Unstained.fcs", "unstained")],
+        blank_file=f"{PBMC}/PBMC_CD4_RNA_Protein_Unstained.fcs",
+        fluor_channels=["HV 450-A", "PE-A", "APC-A"],
+        controls=None,
+        threshold_gate=None,
+        quad_gate=SimpleNamespace(gate_name="Quad", xchannel="PE-A", xthreshold=1000.0,
+                                  ychannel="APC-A", ythreshold=1000.0)),
+}
+
+
+def synthesize(source: Path, destination: Path, scale: int, seed: int, chunk_events: int = 1000000):
+    # Writes a copy of source with scale x its events, drawn with replacement
+    header = read_header(source)
+    events = open_events(header)
+    rng = np.random.default_rng(seed)
+    total = header.event_count * scale
+
+    def chunks():
+        for start in range(0, total, chunk_events):
+            size = min(chunk_events, total - start)
+            yield events[np.sort(rng.integers(0, header.event_count, size))]
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    write_fcs(destination, header, chunks(), total)
+
+
+def dataset_files(data: Path, output: Path, name: str, scale: int, seed: int) -> Dict:
+    # The data set's configuration with every relative path resolved against
+    # the bundled data (scale 1) or synthetic files generated for this scale
+    config = DATASETS[name]
+    if scale == 1:
+        root = data
+    else:
+        root = output / "synthetic" / f"x{scale}"
+        paths = [p for p, _ in config["files"]] + [config["blank_file"]] + list((config["controls"] or {}).values())
+        for i, relative in enumerate(dict.fromkeys(paths)):
+            destination = root / relative
+            if not destination.exists():
+                print(f"Generating {destination}")
+                synthesize(data / relative, destination, scale, seed + i)
+
+    resolved = dict(config)
+    resolved["files"] = [(str(root / p), v) for p, v in config["files"]]
+    resolved["blank_file"] = str(root / config["blank_file"])
+    if config["controls"]:
+        resolved["controls"] = {c: str(root / p) for c, p in config["controls"].items()}
+    return resolved
+
+
+def run(config: Dict, output_directory: Path, plots: PlotOptions, estimation_events: int, seed: int) -> RunMetrics:
+    output_directory.mkdir(parents=True, exist_ok=True)
+    metrics = RunMetrics(output_directory)
+    condition_name = config["condition_name"]
+    files = config["files"]
+
+    with metrics.stage("import") as stage:
+        ex = import_experiment(files, condition_name)
+        stage.info["events"] = len(ex.data)
+
+    with metrics.stage("sample", events=estimation_events):
+        sample = stratified_sample(files, condition_name, estimation_events, seed)
+
+    with metrics.stage("gmm_estimate"):
+        gmm = flow.GaussianMixtureOp(**GMM_PARAMETERS)
+        gmm.estimate(sample)
+        sample = gmm.apply(sample)
+
+    with metrics.stage("gmm_apply"):
+        ex = apply_gmm(gmm, ex)
+
+    if config["blank_file"]:
+        with metrics.stage("autofluorescence"):
+            af = flow.AutofluorescenceOp()
+            af.blank_file = config["blank_file"]
+            af.channels = config["fluor_channels"]
+            af.estimate(sample, subset = "CellBulk_2 == True")
+            sample = af.apply(sample)
+            ex = af.apply(ex)
+
+    if config["controls"]:
+        with metrics.stage("bleedthrough"):
+            bl = flow.BleedthroughLinearOp()
+            bl.controls = config["controls"]
+            bl.estimate(sample, subset = "CellBulk_2 == True")
+            compensation = bleedthrough_compensation(list(config["controls"]), bl.spillover)
+        with metrics.stage("compensation"):
+            ex = compensation.apply(ex)
+
+    with metrics.stage("compact") as stage:
+        ranges = plot.experiment_ranges(ex)
+        stage.info["frame_bytes"] = int(ex.data.memory_usage(deep=True).sum())
+        events = EventTable.from_frame(ex.data, ex.channels)
+        ex = None
+        stage.info["event_bytes"] = events.nbytes
+
+    with metrics.stage("gates") as stage:
+        tree = gating_tree(config["threshold_gate"], config["quad_gate"])
+        masks = tree.bind(events)
+        table = gate_statistics(masks, events.channels)
+        add_gate_columns(events, masks)
+        stage.info["populations"] = len(tree.populations)
+
+    if plots.enabled:
+        quad_gate = config["quad_gate"]
+        with metrics.stage("binning"):
+            transforms = ChannelTransforms(ranges=ranges)
+            bins = EventBins(transforms, ScaledEvents(events, transforms), masks)
+            spec = plot_bin_spec(tree, events.channels, quad_gate)
+            bins.compute(spec.groups, spec.channels, spec.densities)
+        with metrics.stage("plotting") as stage:
+            quadrant_data = quadrant_statistics(quad_gate.gate_name, gate_counts(table)) if quad_gate else None
+            jobs = file_plot_jobs(events.channels, output_directory, plots, condition_name,
+                                  config["threshold_gate"], quad_gate, quadrant_data)
+            jobs.append((plot.scatter, dict(path=output_directory / "scatterplot.png", options=plots,
+                                            xchannel="FSC-A", ychannel="SSC-A",
+                                            huefacet="CellBulk_2")))
+            plot.render(bins, jobs, plots)
+            stage.info["plots"] = len(jobs)
+
+    with metrics.stage("parquet_export"):
+        with EventWriter(output_directory, condition_name) as writer:
+            writer.write(events.to_frame())
+
+    with metrics.stage("csv_export"):
+        events.to_frame().to_csv(output_directory / "cell_matrix.csv", index=False)
+
+    table.to_csv(output_directory / "statistics.csv", index=False)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flow cytometry pipeline stages on verified-data.")
+    parser.add_argument("--data", type=Path, default=Path(__file__).resolve().parent.parent / "verified-data")
+    parser.add_argument("--output", type=Path, default=Path("/tmp/flow-cyte-benchmark"))
+    parser.add_argument("--datasets", nargs="+", choices=sorted(DATASETS), default=sorted(DATASETS))
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 10])
+    parser.add_argument("--estimation-events", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-plots", action="store_true")
+    parser.add_argument("--plot-dpi", type=int, default=100)
+    args = parser.parse_args()
+
+    plots = PlotOptions(enabled=not args.no_plots, dpi=args.plot_dpi)
+    plot.setup(plots)
+
+    results = []
+    for scale in args.scales:
+        for name in args.datasets:
+            print(f"Benchmarking {name} at {scale}x")
+            config = dataset_files(args.data, args.output, name, scale, args.seed)
+            run_directory = args.output / "runs" / f"{name}-x{scale}"
+            shutil.rmtree(run_directory, ignore_errors=True)
+            metrics = run(config, run_directory, plots, args.estimation_events, args.seed)
+            for stage in metrics.to_dict()["stages"]:
+                results.append({"dataset": name, "scale": scale, **stage})
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    with open(args.output / "benchmark.json", "w") as f:
+        json.dump(results, f, indent=2)
+    table = pd.DataFrame(results).drop(columns=["info"])
+    table.to_csv(args.output / "benchmark.csv", index=False)
+    print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
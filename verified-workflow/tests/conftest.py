@@ -0,0 +1,71 @@
+import sys
+import types
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+WORKFLOW = Path(__file__).resolve().parents[1]
+DATA = WORKFLOW.parent / "verified-data"
+TASBE = DATA / "TASBE - Li et al"
+
+sys.path.insert(0, str(WORKFLOW))
+
+try:
+    import latch  # noqa: F401
+except ImportError:
+    # wf/__init__.py declares the Latch workflow; without the SDK the
+    # analysis modules are imported from the package directory alone
+    wf = types.ModuleType("wf")
+    wf.__path__ = [str(WORKFLOW / "wf")]
+    sys.modules["wf"] = wf
+
+FLUOR_CHANNELS = ["Pacific Blue-A", "FITC-A", "PE-Tx-Red-YG-A"]
+QUAD_GATE = SimpleNamespace(gate_name="Quad", xchannel="Pacific Blue-A", xthreshold=600.0,
+                            ychannel="PE-Tx-Red-YG-A", ythreshold=1000.0)
+THRESHOLD_GATE = SimpleNamespace(gate_name="Bright", channel="FITC-A", threshold=100.0)
+
+
+@pytest.fixture(scope="session")
+def tasbe() -> Path:
+    if not TASBE.exists():
+        pytest.skip("verified-data is not available")
+    return TASBE
+
+
+@pytest.fixture(scope="session")
+def tasbe_files(tasbe):
+    # (path, condition value) of the first three TASBE tubes
+    return [(str(tasbe / f"TAL14_{i}.fcs"), str(i)) for i in (1, 2, 3)]
+
+
+@pytest.fixture(scope="session")
+def blank_file(tasbe) -> str:
+    return str(tasbe / "controls" / "Blank-1_H12_H12_P3.fcs")
+
+
+@pytest.fixture(scope="session")
+def controls(tasbe):
+    return {
+        "Pacific Blue-A": str(tasbe / "controls" / "EBFP2-1_H9_H09_P3.fcs"),
+        "FITC-A": str(tasbe / "controls" / "EYFP-1_H10_H10_P3.fcs"),
+        "PE-Tx-Red-YG-A": str(tasbe / "controls" / "mkate-1_H8_H08_P3.fcs"),
+    }
+
+
+@pytest.fixture(scope="session")
+def models(tasbe_files, blank_file, controls, tmp_path_factory):
+    # Gaussian mixture, autofluorescence and compensation estimated on a
+    # small sample of the TASBE tubes
+    pytest.importorskip("cytoflow")
+    from wf.options import PlotOptions
+    from wf.pipeline import estimate_models
+    from wf.sampling import stratified_sample
+
+    return estimate_models(
+        lambda: stratified_sample(tasbe_files, "Dox", 6000),
+        tmp_path_factory.mktemp("estimate"),
+        blank_file=blank_file,
+        fluor_channels=FLUOR_CHANNELS,
+        controls=controls,
+        plots=PlotOptions(enabled=False))
@@ -0,0 +1,52 @@
+import json
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("cytoflow")
+
+import benchmark
+from wf.fcs import read_events, read_header
+from wf.options import PlotOptions
+
+from conftest import DATA
+
+
+@pytest.fixture
+def config(tasbe):
+    config = benchmark.dataset_files(DATA, None, "tasbe", 1, 0)
+    config["files"] = config["files"][:2]
+    return config
+
+
+@pytest.mark.parametrize("plots", [PlotOptions(enabled=False), PlotOptions(dpi=30, processes=1)])
+def test_run(config, tmp_path, plots):
+    metrics = benchmark.run(config, tmp_path, plots, 3000, 0)
+    stages = {stage["stage"]: stage for stage in metrics.to_dict()["stages"]}
+    assert stages["import"]["info"]["events"] == 20000
+    assert {"sample", "gmm_estimate", "autofluorescence", "bleedthrough", "gates", "parquet_export"} <= set(stages)
+    assert ("plotting" in stages) == plots.enabled
+    compact = stages["compact"]["info"]
+    assert compact["event_bytes"] < compact["frame_bytes"] / 3
+    assert len(pd.read_csv(tmp_path / "cell_matrix.csv")) == 20000
+    assert (tmp_path / "statistics.csv").exists()
+
+
+def test_synthesize(tasbe_files, tmp_path):
+    source = tasbe_files[0][0]
+    benchmark.synthesize(source, tmp_path / "x3.fcs", 3, seed=0, chunk_events=7000)
+    header = read_header(tmp_path / "x3.fcs")
+    assert header.event_count == 30000
+    assert header.channels == read_header(source).channels
+    # Events are drawn from the source
+    events = read_events(tmp_path / "x3.fcs")
+    assert len(events.merge(read_events(source).drop_duplicates())) == 30000
+
+
+def test_main(tmp_path, monkeypatch, tasbe):
+    monkeypatch.setattr("sys.argv", ["benchmark.py", "--datasets", "pbmc-protein", "--scales", "1",
+                                     "--no-plots", "--estimation-events", "2000", "--output", str(tmp_path)])
+    benchmark.main()
+    results = json.load(open(tmp_path / "benchmark.json"))
+    assert {r["dataset"] for r in results} == {"pbmc-protein"}
+    assert len(pd.read_csv(tmp_path / "benchmark.csv")) == len(results)
@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wf.bins import DENSITY_BINS, HISTOGRAM_BINS, BinSpec, EventBins, load_bins, merge_bins
+from wf.gates import ALL_EVENTS, GatingTree
+from wf.transforms import ChannelTransforms, ScaledEvents
+
+RANGES = {"FSC-A": 262144.0, "SSC-A": 262144.0, "FITC-A": 262144.0}
+TREE = GatingTree([SimpleNamespace(gate_name="Bright", gate_type="threshold", xchannel="FITC-A", xthreshold=1000.0)])
+SPEC = BinSpec([ALL_EVENTS, "Bright", "Stain=a"], ["FSC-A", "SSC-A", "FITC-A"], [(ALL_EVENTS, "FSC-A", "SSC-A")])
+
+
+def events(n, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "FSC-A": rng.uniform(0, 250000, n),
+        "SSC-A": rng.uniform(-100, 250000, n),
+        "FITC-A": rng.normal(1000, 2000, n),
+        "Stain": rng.choice(["a", "b"], n),
+    })
+
+
+def binned(data, ranges=RANGES):
+    transforms = ChannelTransforms(ranges=ranges)
+    bins = EventBins(transforms, ScaledEvents(data, transforms), TREE.bind(data))
+    bins.compute(SPEC.groups, SPEC.channels, SPEC.densities)
+    return bins
+
+
+def test_counts():
+    data = events(5000, 0)
+    bins = binned(data)
+    counts, edges = bins.histogram(ALL_EVENTS, "FSC-A")
+    assert len(counts) == HISTOGRAM_BINS and len(edges) == HISTOGRAM_BINS + 1
+    assert counts.sum() == 5000
+    # Log SSC has no bin for values <= 0
+    assert bins.histogram(ALL_EVENTS, "SSC-A")[0].sum() == (data["SSC-A"] > 0).sum()
+    assert bins.histogram("Bright", "FITC-A")[0].sum() == (data["FITC-A"] > 1000).sum()
+    assert bins.histogram("Stain=a", "FSC-A")[0].sum() == (data["Stain"] == "a").sum()
+
+    density, xedges, yedges = bins.density(ALL_EVENTS, "FSC-A", "SSC-A")
+    assert density.shape == (DENSITY_BINS, DENSITY_BINS)
+    assert density.sum() == (data["SSC-A"] > 0).sum()
+    np.testing.assert_array_equal(density.sum(axis=1), np.histogram(
+        ScaledEvents(data, ChannelTransforms(ranges=RANGES)).scaled("FSC-A")[data["SSC-A"] > 0], xedges)[0])
+
+
+def test_chunks_add_up():
+    data = events(5000, 0)
+    whole = binned(data)
+    chunked = EventBins(ChannelTransforms(ranges=RANGES))
+    for start in range(0, 5000, 1200):
+        chunk = data.iloc[start:start + 1200].reset_index(drop=True)
+        chunked.add_events(chunk, TREE.bind(chunk), SPEC)
+    assert set(chunked.histograms) == set(whole.histograms)
+    for key, counts in whole.histograms.items():
+        np.testing.assert_array_equal(chunked.histograms[key], counts)
+    np.testing.assert_array_equal(chunked.densities[(ALL_EVENTS, "FSC-A", "SSC-A")],
+                                  whole.densities[(ALL_EVENTS, "FSC-A", "SSC-A")])
+
+
+def test_save_and_merge(tmp_path):
+    first, second = binned(events(3000, 1)), binned(events(2000, 2))
+    first.save(tmp_path / "a.npz")
+    second.save(tmp_path / "b.npz")
+
+    loaded = load_bins(tmp_path / "a.npz")
+    assert loaded.transforms["FITC-A"] == first.transforms["FITC-A"]
+    np.testing.assert_array_equal(loaded.histogram("Bright", "FITC-A")[0], first.histogram("Bright", "FITC-A")[0])
+
+    merge_bins([tmp_path / "a.npz", tmp_path / "b.npz"], tmp_path / "merged.npz")
+    merged = load_bins(tmp_path / "merged.npz")
+    for key, counts in first.histograms.items():
+        np.testing.assert_array_equal(merged.histograms[key], counts + second.histograms[key])
+    assert merged.density(ALL_EVENTS, "FSC-A", "SSC-A")[0].sum() == \
+        first.density(ALL_EVENTS, "FSC-A", "SSC-A")[0].sum() + second.density(ALL_EVENTS, "FSC-A", "SSC-A")[0].sum()
+
+
+def test_grids_have_to_match():
+    first = binned(events(100, 1))
+    second = binned(events(100, 2), dict(RANGES, **{"FSC-A": 1024.0}))
+    with pytest.raises(ValueError, match="FSC-A"):
+        first.add(second)
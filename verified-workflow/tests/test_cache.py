@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from wf.cache import EstimateCache, cache_key, file_digest
+
+
+def test_cache_key():
+    assert cache_key("gmm", {"a": 1, "b": [1, 2]}) == cache_key("gmm", {"b": [1, 2], "a": 1})
+    assert cache_key("gmm", {"a": 1}) != cache_key("gmm", {"a": 2})
+    assert cache_key("gmm", "x") != cache_key("autofluorescence", "x")
+    assert len(cache_key("gmm")) == 32
+
+
+def test_file_digest(tmp_path):
+    (tmp_path / "a").write_bytes(b"events" * 1000000)
+    (tmp_path / "b").write_bytes(b"events" * 1000000)
+    (tmp_path / "c").write_bytes(b"events" * 999999 + b"Events")
+    assert file_digest(tmp_path / "a") == file_digest(tmp_path / "b")
+    assert file_digest(tmp_path / "a") != file_digest(tmp_path / "c")
+
+
+def test_put_get_restores_plots(tmp_path):
+    cache = EstimateCache(tmp_path / "cache")
+    plot = tmp_path / "run1" / "histograms.png"
+    plot.parent.mkdir()
+    plot.write_bytes(b"png")
+    cache.put("autofluorescence", "k", {"af_median": {"FITC-A": 1.0}}, {"histograms.png": plot})
+
+    assert cache.get("autofluorescence", "other") is None
+    restored = tmp_path / "run2" / "autofluorescence" / "histograms.png"
+    params = cache.get("autofluorescence", "k", {"histograms.png": restored})
+    assert params == {"af_median": {"FITC-A": 1.0}}
+    assert restored.read_bytes() == b"png"
+
+
+def test_interrupted_entry_is_a_miss(tmp_path):
+    cache = EstimateCache(tmp_path)
+    cache.entry("gmm", "k").mkdir()
+    assert cache.get("gmm", "k") is None
+
+
+@pytest.fixture(scope="module")
+def estimate(tasbe_files, blank_file, controls):
+    pytest.importorskip("cytoflow")
+    from wf.options import PlotOptions
+    from wf.pipeline import estimate_models
+    from wf.sampling import stratified_sample
+
+    from conftest import FLUOR_CHANNELS
+
+    def estimate(output_directory, cache, load=None, controls=controls):
+        return estimate_models(
+            load or (lambda: stratified_sample(tasbe_files, "Dox", 3000)),
+            output_directory,
+            blank_file=blank_file,
+            fluor_channels=FLUOR_CHANNELS,
+            controls=controls,
+            plots=PlotOptions(enabled=False),
+            cache=cache,
+            sample_key=cache_key("sample", [file_digest(p) for p, _ in tasbe_files], 3000))
+    return estimate
+
+
+def test_estimate_models_reuses_the_cache(estimate, tmp_path):
+    cache = EstimateCache(tmp_path / "cache")
+    first = estimate(tmp_path / "run1", cache)
+    assert len(list((tmp_path / "cache").glob("*/params.json"))) == 3
+
+    def load():
+        raise AssertionError("every model should come from the cache")
+
+    second = estimate(tmp_path / "run2", cache, load)
+    assert json.dumps(second.to_dict(), sort_keys=True) == json.dumps(first.to_dict(), sort_keys=True)
+    assert (tmp_path / "run2" / "compensation" / "spillover.csv").exists()
+
+
+def test_changed_controls_are_estimated_again(estimate, tmp_path, controls):
+    cache = EstimateCache(tmp_path / "cache")
+    estimate(tmp_path / "run1", cache)
+    estimate(tmp_path / "run2", cache, controls={c: controls["FITC-A"] if c == "Pacific Blue-A" else p
+                                                 for c, p in controls.items()})
+    assert len(list((tmp_path / "cache").glob("compensation-*"))) == 2
+    assert len(list((tmp_path / "cache").glob("gmm-*"))) == 1
@@ -0,0 +1,102 @@
+import shutil
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("cytoflow")
+
+from wf.cache import EstimateCache
+from wf.metrics import RunMetrics
+from wf.options import PlotOptions
+from wf.pipeline import process_file
+
+from conftest import QUAD_GATE, THRESHOLD_GATE
+
+DIM_GATE = SimpleNamespace(gate_name="Bright", channel="FITC-A", threshold=300.0)
+
+
+def previous_run(directory: Path):
+    # A previous run's checkpoint store, fetched file by file as in apply_task
+    def fetch(relative_path):
+        path = (directory / relative_path).resolve()
+        if not path.exists():
+            return None
+        local = Path(tempfile.mkdtemp()) / path.name
+        shutil.copy(path, local)
+        return local
+    return fetch
+
+
+def run(path, models, output_directory, previous=None, threshold_gate=THRESHOLD_GATE, chunk_events=None):
+    output_directory.mkdir(parents=True)
+    checkpoints = EstimateCache(
+        output_directory / "checkpoints",
+        remote=previous_run(previous / "checkpoints") if previous else None)
+    metrics = RunMetrics(output_directory)
+    process_file(Path(path), "Dox", "1", models, output_directory, threshold_gate, QUAD_GATE,
+                 plots=PlotOptions(enabled=False), chunk_events=chunk_events, metrics=metrics,
+                 checkpoints=checkpoints)
+    return [stage.stage for stage in metrics.stages]
+
+
+def outputs(directory):
+    return pd.read_csv(directory / "statistics.csv"), pd.read_parquet(directory / "cell_matrix.parquet")
+
+
+def assert_same(a, b):
+    pd.testing.assert_frame_equal(outputs(a)[0], outputs(b)[0])
+    pd.testing.assert_frame_equal(outputs(a)[1], outputs(b)[1])
+
+
+def test_checkpoints_reference_the_cell_matrix(tasbe_files, models, tmp_path):
+    run(tasbe_files[0][0], models, tmp_path / "run")
+    entries = sorted(p.name.split("-")[0] for p in (tmp_path / "run" / "checkpoints").iterdir())
+    assert entries == ["events", "tables"]
+    stored = [p.name for p in (tmp_path / "run" / "checkpoints").rglob("*") if p.is_file()]
+    assert "cell_matrix.parquet" not in stored and "events.parquet" not in stored
+    assert not (tmp_path / "run" / "events.parquet").exists()
+
+
+@pytest.mark.parametrize("chunk_events", [None, 3000])
+def test_unchanged_file_is_restored(tasbe_files, models, tmp_path, chunk_events):
+    path = tasbe_files[0][0]
+    run(path, models, tmp_path / "first", chunk_events=chunk_events)
+    stages = run(path, models, tmp_path / "second", tmp_path / "first", chunk_events=chunk_events)
+    assert not {"import", "apply_models", "stream", "gates"} & set(stages)
+    assert_same(tmp_path / "first", tmp_path / "second")
+
+    # And again from the restored run, which carried the checkpoints over
+    stages = run(path, models, tmp_path / "third", tmp_path / "second", chunk_events=chunk_events)
+    assert "gates" not in stages and "stream" not in stages
+
+
+@pytest.mark.parametrize("chunk_events", [None, 3000])
+def test_changed_gate_regates_the_stored_events(tasbe_files, models, tmp_path, chunk_events, monkeypatch):
+    def read(*args):
+        raise AssertionError("the FCS file should not be read again")
+
+    path = tasbe_files[0][0]
+    run(path, models, tmp_path / "first", chunk_events=chunk_events)
+    with monkeypatch.context() as m:
+        m.setattr("wf.pipeline.import_experiment", read)
+        m.setattr("wf.streaming.iter_chunks", read)
+        run(path, models, tmp_path / "second", tmp_path / "first", DIM_GATE, chunk_events)
+    run(path, models, tmp_path / "fresh", threshold_gate=DIM_GATE, chunk_events=chunk_events)
+    assert_same(tmp_path / "second", tmp_path / "fresh")
+
+    # The new cell matrix is the reference of both checkpoints now
+    stages = run(path, models, tmp_path / "third", tmp_path / "second", DIM_GATE, chunk_events)
+    assert "gates" not in stages and "stream" not in stages
+
+
+def test_changed_cell_matrix_is_not_restored(tasbe_files, models, tmp_path):
+    path = tasbe_files[0][0]
+    run(path, models, tmp_path / "first")
+    cells = pd.read_parquet(tmp_path / "first" / "cell_matrix.parquet")
+    cells.iloc[:10].to_parquet(tmp_path / "first" / "cell_matrix.parquet")
+    stages = run(path, models, tmp_path / "second", tmp_path / "first")
+    assert "apply_models" in stages
+    assert len(outputs(tmp_path / "second")[1]) == 10000
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("cytoflow")
+
+from wf.clustering import CLUSTER_COLUMN, SOM_COLUMN, ClusterModel, cluster_columns, fit_clusters
+from wf.options import PlotOptions
+from wf.pipeline import estimate_models
+from wf.sampling import stratified_sample
+
+from conftest import FLUOR_CHANNELS
+from test_streaming import run
+
+
+def blobs(seed=0):
+    # Three well separated blobs of 600, 300 and 100 events, half of them in
+    # the gate
+    rng = np.random.default_rng(seed)
+    centers = [(0, 0), (10, 10), (-10, 10)]
+    x = np.concatenate([rng.normal(c, 1, size=(n, 2)) for c, n in zip(centers, (600, 300, 100))])
+    data = pd.DataFrame(x, columns=["A", "B"])
+    data["CellBulk_2"] = np.arange(len(data)) % 2 == 0
+    return data
+
+
+@pytest.mark.parametrize("method", ["kmeans", "som"])
+def test_clusters_are_numbered_by_size(method):
+    data = blobs()
+    model = fit_clusters(data, ["A", "B"], method, clusters=3, som_xdim=4, som_ydim=4)
+    columns = cluster_columns(data, model)
+
+    labels = columns[CLUSTER_COLUMN]
+    assert labels.dtype == np.int16
+    assert (labels[~data["CellBulk_2"]] == 0).all()
+    inside = labels[data["CellBulk_2"].to_numpy()]
+    assert np.bincount(inside).tolist() == [0, 300, 150, 50]
+    assert (SOM_COLUMN in columns) == (method == "som")
+
+    restored = ClusterModel.from_dict(model.to_dict())
+    np.testing.assert_array_equal(cluster_columns(data, restored)[CLUSTER_COLUMN], labels)
+
+
+def test_cluster_column_clash():
+    data = blobs()
+    model = fit_clusters(data, ["A", "B"], clusters=3)
+    data[CLUSTER_COLUMN] = 1
+    with pytest.raises(ValueError, match="clashes"):
+        cluster_columns(data, model)
+
+
+def test_fit_clusters_checks_channels():
+    with pytest.raises(ValueError, match="not found"):
+        fit_clusters(blobs(), ["A", "C"])
+    with pytest.raises(ValueError, match="at least 2"):
+        fit_clusters(blobs(), ["A"])
+
+
+@pytest.fixture(scope="module")
+def clustered_models(tasbe_files, blank_file, controls, tmp_path_factory):
+    clustering = SimpleNamespace(method="som", clusters=4, channels=None, som_xdim=4, som_ydim=4,
+                                 seed=0, embedding="pca", embedding_events=2000)
+    return estimate_models(
+        lambda: stratified_sample(tasbe_files, "Dox", 6000),
+        tmp_path_factory.mktemp("estimate"),
+        blank_file=blank_file,
+        fluor_channels=FLUOR_CHANNELS,
+        controls=controls,
+        plots=PlotOptions(enabled=False),
+        clustering=clustering)
+
+
+def test_models_apply_with_clustering(tasbe_files, clustered_models):
+    ex = clustered_models.apply(stratified_sample(tasbe_files, "Dox", 3000))
+    assert CLUSTER_COLUMN in ex.conditions and SOM_COLUMN in ex.conditions
+    assert CLUSTER_COLUMN not in ex.channels
+    assert set(ex.data[CLUSTER_COLUMN]) <= set(range(5))
+
+
+@pytest.mark.parametrize("chunk_events", [None, 3000])
+def test_process_file_with_clustering(tasbe_files, clustered_models, tmp_path, chunk_events):
+    statistics = run(tasbe_files[0][0], clustered_models, tmp_path, chunk_events)
+    assert len(statistics) > 0
+
+    clusters = pd.read_csv(tmp_path / "cluster_statistics.csv")
+    counts = clusters.groupby("gate")["events"].first()
+    assert counts[[f"Cluster_{i}" for i in range(1, 5)]].sum() == counts["CellBulk_2"]
+
+    cells = pd.read_parquet(tmp_path / "cell_matrix.parquet")
+    assert cells[CLUSTER_COLUMN].value_counts().drop(0).sort_index().tolist() == \
+        counts[[f"Cluster_{i}" for i in range(1, 5)]].tolist()
@@ -0,0 +1,90 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wf.compensation import (BLOCK_EVENTS, Compensation, bleedthrough_compensation, header_compensation,
+                             parse_spillover)
+from wf.fcs import FCSHeader
+
+SPILLOVER = "3,FITC-A,PE-A,APC-A,1,0.2,0.01,0.05,1,0.1,0,0.03,1"
+
+
+def test_parse_spillover():
+    compensation = parse_spillover(SPILLOVER)
+    assert compensation.channels == ["FITC-A", "PE-A", "APC-A"]
+    assert compensation.source == "header"
+    np.testing.assert_array_equal(compensation.spillover, [[1, 0.2, 0.01], [0.05, 1, 0.1], [0, 0.03, 1]])
+
+
+@pytest.mark.parametrize("value", [
+    "",
+    "two,FITC-A,PE-A,1,0,0,1",
+    "2,FITC-A,PE-A,1,0,0",
+    "3,FITC-A,PE-A,1,0,0,1",
+    "2,FITC-A,PE-A,1,0,x,1",
+    "0",
+])
+def test_parse_malformed_spillover(value):
+    with pytest.raises(ValueError, match="Malformed spillover matrix"):
+        parse_spillover(value)
+
+
+def test_shape_must_match_channels():
+    with pytest.raises(ValueError, match="shape"):
+        Compensation(["FITC-A", "PE-A"], np.eye(3))
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_compensation_inverts_spillover(workers):
+    compensation = parse_spillover(SPILLOVER)
+    np.testing.assert_allclose(compensation.spillover @ compensation.inverse, np.eye(3), atol=1e-12)
+
+    # More than one block, so the thread pool splits the events
+    rng = np.random.default_rng(0)
+    true = rng.lognormal(5, 2, (2 * BLOCK_EVENTS + 17, 3))
+    observed = true @ compensation.spillover
+    np.testing.assert_allclose(compensation.compensate(observed, workers), true, rtol=1e-9)
+
+
+def test_round_trip_through_dict():
+    compensation = parse_spillover(SPILLOVER)
+    restored = Compensation.from_dict(compensation.to_dict())
+    assert restored.channels == compensation.channels
+    assert restored.source == "header"
+    np.testing.assert_array_equal(restored.spillover, compensation.spillover)
+
+
+def test_save_writes_the_matrix(tmp_path):
+    compensation = parse_spillover(SPILLOVER)
+    compensation.save(tmp_path / "compensation" / "spillover.csv")
+    saved = pd.read_csv(tmp_path / "compensation" / "spillover.csv", index_col="channel")
+    pd.testing.assert_frame_equal(saved, compensation.to_frame(), check_names=False)
+
+
+def test_bleedthrough_compensation():
+    bleedthrough = {("FITC-A", "PE-A"): 0.2, ("PE-A", "FITC-A"): 0.05}
+    compensation = bleedthrough_compensation(["FITC-A", "PE-A"], bleedthrough)
+    np.testing.assert_array_equal(compensation.spillover, [[1, 0.2], [0.05, 1]])
+    assert compensation.source == "controls"
+
+
+def header(text):
+    text = {"$PAR": "3", "$TOT": "0", "$P1N": "FSC-A", "$P2N": "B1-A", "$P2S": "FITC-A", "$P3N": "PE-A", **text}
+    return FCSHeader(Path("tube.fcs"), "FCS3.1", text, 0, 0, ["FSC-A", "B1-A", "PE-A"])
+
+
+def test_header_compensation_maps_stain_names():
+    compensation = header_compensation(header({"$SPILLOVER": "2,FITC-A,PE-A,1,0.2,0.05,1"}))
+    assert compensation.channels == ["B1-A", "PE-A"]
+
+
+def test_header_compensation_reads_older_keywords():
+    assert header_compensation(header({"SPILL": "2,B1-A,PE-A,1,0.2,0.05,1"})).channels == ["B1-A", "PE-A"]
+    assert header_compensation(header({})) is None
+
+
+def test_header_compensation_rejects_unknown_channels():
+    with pytest.raises(ValueError, match="APC-A"):
+        header_compensation(header({"$SPILLOVER": "2,FITC-A,APC-A,1,0.2,0.05,1"}))
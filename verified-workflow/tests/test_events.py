@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wf.events import EventTable
+from wf.gates import GatingTree, add_gate_columns
+from wf.stats import gate_statistics
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    n = 1001
+    return pd.DataFrame({
+        "FITC-A": rng.normal(100, 50, n),
+        "Dox": rng.choice(["0.1", "1.0"], n),
+        "CellBulk_2": rng.random(n) < 0.7,
+        "Cluster": rng.integers(0, 4, n).astype(np.int16),
+    })
+
+
+def test_compact_columns(frame):
+    events = EventTable.from_frame(frame, ["FITC-A"])
+    assert len(events) == 1001
+    assert events.channels == ["FITC-A"]
+    assert events.columns == list(frame.columns)
+    assert events.values("FITC-A").dtype == np.float32
+    assert isinstance(events.values("Dox"), pd.Categorical)
+    # Bit-packed until read
+    assert events._columns["CellBulk_2"].nbytes == 126
+    np.testing.assert_array_equal(events.values("CellBulk_2"), frame["CellBulk_2"])
+    assert events.values("Cluster").dtype == np.int16
+    assert events.nbytes < frame.memory_usage(deep=True).sum() / 3
+
+
+def test_round_trip(frame):
+    events = EventTable.from_frame(frame)
+    restored = events.to_frame()
+    np.testing.assert_array_equal(restored["FITC-A"], frame["FITC-A"].astype(np.float32))
+    assert restored["Dox"].astype(str).tolist() == frame["Dox"].tolist()
+    pd.testing.assert_series_equal(restored["CellBulk_2"], frame["CellBulk_2"])
+    pd.testing.assert_frame_equal(events[["Cluster", "CellBulk_2"]], frame[["Cluster", "CellBulk_2"]])
+
+
+def test_column_length_is_checked(frame):
+    events = EventTable.from_frame(frame)
+    with pytest.raises(ValueError, match="1000 values for 1001 events"):
+        events["Other"] = np.zeros(1000)
+
+
+def test_gates_on_events_match_the_frame(frame):
+    tree = GatingTree([SimpleNamespace(gate_name="Bright", gate_type="threshold", xchannel="FITC-A",
+                                       xthreshold=120.0, parent="CellBulk_2")],
+                      base={"CellBulk_2": ("CellBulk_2", True)})
+    # Same float32 values, so the same events pass every gate
+    reference = frame.astype({"FITC-A": np.float32})
+    events = EventTable.from_frame(frame, ["FITC-A"])
+    pd.testing.assert_frame_equal(gate_statistics(tree.bind(events), ["FITC-A"]),
+                                  gate_statistics(tree.bind(reference), ["FITC-A"]))
+
+    add_gate_columns(events, tree.bind(events))
+    np.testing.assert_array_equal(events.values("Bright"),
+                                  frame["CellBulk_2"] & (reference["FITC-A"] > 120.0))
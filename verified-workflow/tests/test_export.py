@@ -0,0 +1,64 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from wf.export import EventWriter, compact_frame, partition_path
+
+
+def events(n=10, dox="1", start=0):
+    return pd.DataFrame({
+        "FITC-A": np.arange(start, start + n, dtype=np.float64) / 3,
+        "Dox": [dox] * n,
+        "CellBulk_2": np.arange(n) % 2 == 0,
+        "Stain": ["a", "b"] * (n // 2),
+    })
+
+
+def test_compact_frame():
+    data = compact_frame(events(), drop=("Dox",))
+    assert list(data.columns) == ["FITC-A", "CellBulk_2", "Stain"]
+    assert data["FITC-A"].dtype == np.float32
+    assert data["CellBulk_2"].dtype == bool
+    assert data["Stain"].dtype == "category"
+
+
+def test_partition_path():
+    assert partition_path("Dox", "1.0", "TAL14_1") == Path("cell_matrix/Dox=1.0/TAL14_1.parquet")
+    assert partition_path("Dose (ng/ml)", "1/2", "a") == Path("cell_matrix/Dose%20%28ng%2Fml%29=1%2F2/a.parquet")
+
+
+def test_event_writer_appends_chunks(tmp_path):
+    chunks = [events(10, start=0), events(10, start=10), events(4, start=20)]
+    with EventWriter(tmp_path, "Dox", output_csv=True) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+    expected = pd.concat(chunks, ignore_index=True)
+    written = pd.read_parquet(tmp_path / "cell_matrix.parquet")
+    assert "Dox" not in written.columns
+    np.testing.assert_array_equal(written["FITC-A"], expected["FITC-A"].astype(np.float32))
+    assert written["Stain"].astype(str).tolist() == expected["Stain"].tolist()
+    assert pq.ParquetFile(tmp_path / "cell_matrix.parquet").metadata.num_row_groups == 3
+
+    csv = pd.read_csv(tmp_path / "cell_matrix.csv")
+    pd.testing.assert_frame_equal(csv, expected.astype({"Dox": np.int64}))
+
+
+def test_event_writer_without_csv(tmp_path):
+    with EventWriter(tmp_path, "Dox") as writer:
+        writer.write(events())
+    assert not (tmp_path / "cell_matrix.csv").exists()
+
+
+def test_hive_partitions_read_back(tmp_path):
+    for dox, name in [("1", "a"), ("2", "b"), ("2", "c")]:
+        path = tmp_path / partition_path("Dox", dox, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with EventWriter(path.parent, "Dox") as writer:
+            writer.write(events(dox=dox))
+        (path.parent / "cell_matrix.parquet").rename(path)
+
+    data = pd.read_parquet(tmp_path / "cell_matrix")
+    assert data.groupby(data["Dox"].astype(str)).size().to_dict() == {"1": 10, "2": 20}
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from wf.fcs import iter_chunks, open_events, read_events, read_header, sample_events, write_fcs
+
+
+def test_read_header(tasbe_files):
+    header = read_header(tasbe_files[0][0])
+    assert header.version.startswith("FCS")
+    assert header.event_count == 10000
+    assert header.channels == ["FITC-A", "FSC-A", "PE-Tx-Red-YG-A", "Pacific Blue-A", "SSC-A"]
+    assert header.ranges["FSC-A"] == 262143.0
+    assert header.data_end - header.data_start + 1 == header.event_count * open_events(header).dtype.itemsize
+
+
+def test_chunks_match_whole_file(tasbe_files):
+    path = tasbe_files[0][0]
+    events = read_events(path)
+    chunks = list(iter_chunks(path, 3000))
+    assert [len(c) for c in chunks] == [3000, 3000, 3000, 1000]
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), events)
+
+
+def test_events_match_cytoflow(tasbe_files):
+    flow = pytest.importorskip("cytoflow")
+    path, condition_val = tasbe_files[0]
+    ex = flow.ImportOp(conditions={"Dox": "str"}, tubes=[flow.Tube(file=path, conditions={"Dox": condition_val})]).apply()
+    events = read_events(path)
+    np.testing.assert_allclose(events.to_numpy(), ex.data[events.columns].to_numpy(), rtol=1e-6)
+
+
+def test_sample_events(tasbe_files):
+    path = tasbe_files[0][0]
+    sample = sample_events(path, 500, seed=1)
+    assert len(sample) == 500
+    pd.testing.assert_frame_equal(sample, sample_events(path, 500, seed=1))
+    # Every sampled event is an event of the file
+    events = read_events(path)
+    assert len(sample.merge(events.drop_duplicates())) == 500
+    assert len(sample_events(path, 10 ** 6)) == 10000
+
+
+def test_write_fcs_round_trip(tasbe_files, tmp_path):
+    header = read_header(tasbe_files[0][0])
+    records = open_events(header)
+    write_fcs(tmp_path / "copy.fcs", header, [records[:4000], records[4000:]], header.event_count)
+
+    copy = read_header(tmp_path / "copy.fcs")
+    assert copy.channels == header.channels
+    assert copy.event_count == header.event_count
+    assert copy.ranges == header.ranges
+    pd.testing.assert_frame_equal(read_events(tmp_path / "copy.fcs"), read_events(header.path))
+
+
+def test_write_fcs_checks_event_count(tasbe_files, tmp_path):
+    header = read_header(tasbe_files[0][0])
+    with pytest.raises(ValueError, match="expected"):
+        write_fcs(tmp_path / "short.fcs", header, [open_events(header)[:10]], 20)
+
+
+def test_not_an_fcs_file(tmp_path):
+    (tmp_path / "notes.txt").write_text("not a flow cytometry file" * 10)
+    with pytest.raises(ValueError, match="not an FCS file"):
+        read_header(tmp_path / "notes.txt")
@@ -0,0 +1,83 @@
+import json
+import os
+
+from wf.cache import file_digest
+from wf.fetch import FileCache, LocalStore, s3_version
+
+
+class CountingStore(LocalStore):
+    def __init__(self, root):
+        super().__init__(root)
+        self.downloads = []
+
+    def download(self, remote, local):
+        self.downloads.append(remote)
+        super().download(remote, local)
+
+
+def store(tmp_path):
+    (tmp_path / "remote" / "plate").mkdir(parents=True)
+    for name in ("a.fcs", "b.fcs"):
+        (tmp_path / "remote" / "plate" / name).write_bytes(name.encode() * 1000)
+    return CountingStore(tmp_path / "remote")
+
+
+def test_cached_files_are_reused(tmp_path):
+    remote = store(tmp_path)
+    cache = FileCache(tmp_path / "cache", remote.download, remote.stat)
+    paths = cache.fetch_all(["latch:///plate/a.fcs", "latch:///plate/b.fcs", "latch:///plate/a.fcs"])
+    assert sorted(remote.downloads) == ["latch:///plate/a.fcs", "latch:///plate/b.fcs"]
+    assert paths["latch:///plate/a.fcs"].read_bytes() == b"a.fcs" * 1000
+    assert cache.digest(paths["latch:///plate/a.fcs"]) == file_digest(tmp_path / "remote" / "plate" / "a.fcs")
+
+    again = FileCache(tmp_path / "cache", remote.download, remote.stat)
+    assert again.fetch_all(["latch:///plate/a.fcs", "latch:///plate/b.fcs"]) == paths
+    assert len(remote.downloads) == 2
+
+
+def test_changed_remote_file_is_fetched_again(tmp_path):
+    remote = store(tmp_path)
+    cache = FileCache(tmp_path / "cache", remote.download, remote.stat)
+    path = cache.fetch("latch:///plate/a.fcs")
+    source = tmp_path / "remote" / "plate" / "a.fcs"
+    source.write_bytes(b"replaced")
+    os.utime(source, ns=(0, 0))
+    assert cache.fetch("latch:///plate/a.fcs") == path
+    assert path.read_bytes() == b"replaced"
+    assert len(remote.downloads) == 2
+
+
+def test_corrupted_copy_is_fetched_again(tmp_path):
+    remote = store(tmp_path)
+    cache = FileCache(tmp_path / "cache", remote.download, remote.stat)
+    path = cache.fetch("latch:///plate/a.fcs")
+    path.write_bytes(b"truncated")
+    assert cache.fetch("latch:///plate/a.fcs").read_bytes() == b"a.fcs" * 1000
+    assert len(remote.downloads) == 2
+
+
+def test_unversioned_files_are_always_fetched(tmp_path):
+    remote = store(tmp_path)
+    cache = FileCache(tmp_path / "cache", remote.download)
+    cache.fetch("latch:///plate/a.fcs")
+    cache.fetch("latch:///plate/a.fcs")
+    assert len(remote.downloads) == 2
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise KeyError(Key)
+        return self.objects[(Bucket, Key)]
+
+
+def test_s3_version():
+    client = FakeS3({("bucket", "plate/a.fcs"): {"ContentLength": 5000, "ETag": '"abc"', "VersionId": "v1"},
+                     ("bucket", "plate/b.fcs"): {"ContentLength": 5000, "ETag": '"def"'}})
+    assert json.loads(s3_version("s3://bucket/plate/a.fcs", client)) == \
+        {"contentSize": 5000, "etag": '"abc"', "versionId": "v1"}
+    assert s3_version("s3://bucket/plate/a.fcs", client) != s3_version("s3://bucket/plate/b.fcs", client)
+    assert s3_version("s3://bucket/plate/c.fcs", client) is None
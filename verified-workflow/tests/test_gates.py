@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from wf.gates import ALL_EVENTS, GatingTree
+
+
+def gate(name, kind, **fields):
+    return SimpleNamespace(gate_name=name, gate_type=kind, **fields)
+
+
+@pytest.fixture
+def events():
+    return pd.DataFrame({
+        "FSC-A": [10.0, 20.0, 30.0, 40.0, 50.0, 60.0],
+        "FITC-A": [-5.0, 0.0, 5.0, 5.0, -5.0, 0.0],
+        "PE-A": [5.0, 5.0, 0.0, -5.0, -5.0, 0.0],
+    })
+
+
+def test_cycle_is_rejected():
+    with pytest.raises(ValueError, match="cycle"):
+        GatingTree([
+            gate("a", "threshold", xchannel="FSC-A", xthreshold=0.0, parent="b"),
+            gate("b", "threshold", xchannel="FSC-A", xthreshold=0.0, parent="a"),
+        ])
+
+
+def test_self_parent_is_rejected():
+    with pytest.raises(ValueError, match="cycle"):
+        GatingTree([gate("a", "threshold", xchannel="FSC-A", xthreshold=0.0, parent="a")])
+
+
+def test_unknown_parent_is_rejected():
+    with pytest.raises(ValueError, match="unknown parent"):
+        GatingTree([gate("a", "threshold", xchannel="FSC-A", xthreshold=0.0, parent="missing")])
+
+
+def test_populations_are_ordered_parents_first():
+    tree = GatingTree([
+        gate("child", "threshold", xchannel="FSC-A", xthreshold=0.0, parent="parent"),
+        gate("parent", "threshold", xchannel="FSC-A", xthreshold=0.0),
+    ])
+    assert tree.populations.index(ALL_EVENTS) < tree.populations.index("parent") < tree.populations.index("child")
+
+
+def test_child_mask_is_anded_with_parent(events):
+    tree = GatingTree([
+        gate("large", "threshold", xchannel="FSC-A", xthreshold=25.0),
+        gate("green", "range", xchannel="FITC-A", low=0.0, high=10.0, parent="large"),
+        gate("red", "threshold", xchannel="PE-A", xthreshold=-10.0, parent="green"),
+    ])
+    masks = tree.bind(events)
+    own_green = (events["FITC-A"] >= 0) & (events["FITC-A"] <= 10)
+    expected = (events["FSC-A"] > 25) & own_green
+    np.testing.assert_array_equal(masks.mask("green"), expected)
+    # The grandchild's own condition keeps every event, so it is exactly its parent
+    np.testing.assert_array_equal(masks.mask("red"), expected)
+    assert masks.mask(ALL_EVENTS).all()
+
+
+def test_quadrant_edge_events_are_in_no_quadrant(events):
+    tree = GatingTree([gate("q", "quad", xchannel="FITC-A", ychannel="PE-A", xthreshold=0.0, ythreshold=0.0)])
+    masks = tree.bind(events)
+    quadrants = np.column_stack([masks.mask(f"q_{i}") for i in range(1, 5)])
+
+    # Upper left, upper right, lower left and lower right
+    np.testing.assert_array_equal(quadrants[0], [True, False, False, False])
+    np.testing.assert_array_equal(quadrants[3], [False, False, False, True])
+    np.testing.assert_array_equal(quadrants[4], [False, False, True, False])
+    # On the x threshold, on the y threshold, and on both
+    for edge in (1, 2, 5):
+        assert not quadrants[edge].any()
+    assert (quadrants.sum(axis=1) <= 1).all()
+
+    column = masks.column("q")
+    assert list(column.cat.categories) == ["q_1", "q_2", "q_3", "q_4"]
+    assert column.isna().tolist() == [False, True, True, False, False, True]
+
+
+def test_quadrants_are_anded_with_parent(events):
+    tree = GatingTree([
+        gate("large", "threshold", xchannel="FSC-A", xthreshold=35.0),
+        gate("q", "quad", xchannel="FITC-A", ychannel="PE-A", xthreshold=0.0, ythreshold=0.0, parent="large"),
+    ])
+    masks = tree.bind(events)
+    assert masks.mask("q_1").sum() == 0
+    np.testing.assert_array_equal(masks.mask("q_3"), [False, False, False, False, True, False])
+    np.testing.assert_array_equal(masks.mask("q_4"), [False, False, False, True, False, False])
@@ -0,0 +1,64 @@
+import pandas as pd
+import pytest
+
+from wf.headers import BLANK, CONTROL, InputFile, scan_headers
+
+from conftest import DATA
+
+PBMC = DATA / "BD Biosciences - Monocyte RNA and Protein Co-Staining Analysis"
+
+
+@pytest.fixture
+def inputs(tasbe_files, blank_file, controls):
+    return ([InputFile(path, experiment="TAL14", condition_value=value) for path, value in tasbe_files]
+            + [InputFile(blank_file, BLANK)]
+            + [InputFile(path, CONTROL) for path in controls.values()])
+
+
+def test_index(inputs, tmp_path):
+    index = scan_headers(inputs)
+    assert index.channels == ["FITC-A", "FSC-A", "PE-Tx-Red-YG-A", "Pacific Blue-A", "SSC-A"]
+    assert len(index.samples) == 3
+    assert index.ranges["FITC-A"] == max(h.ranges["FITC-A"] for h in index.samples)
+
+    index.save(tmp_path / "fcs_index.csv")
+    table = pd.read_csv(tmp_path / "fcs_index.csv")
+    assert len(table) == 7 * 5
+    assert table.groupby("role")["file"].nunique().to_dict() == {"blank": 1, "control": 3, "sample": 3}
+    assert (table.loc[table["role"] == "sample", "events"] == 10000).all()
+    assert table.loc[table["channel"] == "FITC-A", "parameter"].nunique() == 1
+
+
+def test_valid_inputs(inputs):
+    scan_headers(inputs).validate({"gates": ["FITC-A", "Pacific Blue-A"], "transforms": []})
+
+
+def test_every_problem_is_reported(inputs):
+    if not PBMC.exists():
+        pytest.skip("PBMC data is not available")
+    other = InputFile(str(PBMC / "PBMC_CD4_Protein_Stained.fcs"), experiment="PBMC", condition_value="1")
+    index = scan_headers(inputs + [other])
+    with pytest.raises(ValueError) as error:
+        index.validate({"gates": ["FITC-A", "APC-A"], "clustering": ["GFP-A"]})
+    message = str(error.value)
+    assert "PBMC_CD4_Protein_Stained.fcs lacks" in message and "has extra" in message
+    assert "gates: unknown channels APC-A" in message
+    assert "clustering: unknown channels GFP-A" in message
+
+
+def test_missing_spillover_matrix(inputs):
+    with pytest.raises(ValueError, match="no spillover matrix in its header"):
+        scan_headers(inputs).validate({}, header_spillover=True)
+
+
+def test_control_missing_a_channel(inputs):
+    if not PBMC.exists():
+        pytest.skip("PBMC data is not available")
+    control = InputFile(str(PBMC / "PBMC_CD4_Protein_Unstained.fcs"), CONTROL)
+    with pytest.raises(ValueError, match="control PBMC_CD4_Protein_Unstained.fcs lacks sample channels"):
+        scan_headers(inputs + [control]).validate({})
+
+
+def test_no_samples(blank_file):
+    with pytest.raises(ValueError, match="No FCS files"):
+        scan_headers([InputFile(blank_file, BLANK)])
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+TESTS = Path(__file__).resolve().parent
+
+
+def imported(code: str) -> set:
+    # The modules a fresh interpreter has imported after running code
+    script = f"import sys; sys.path.insert(0, {str(TESTS)!r}); import conftest\n{code}\nprint(' '.join(sys.modules))"
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    return set(result.stdout.splitlines()[-1].split())
+
+
+def test_task_module_imports_no_analysis_libraries():
+    pytest.importorskip("latch")
+    modules = imported("import wf.task")
+    assert not {"cytoflow", "pandas", "sklearn", "matplotlib", "wf.pipeline", "wf.plots"} & modules
+
+
+def test_statistics_only_run_skips_the_plotting_modules(tasbe_files, tmp_path):
+    pytest.importorskip("cytoflow")
+    modules = imported(f"""
+from pathlib import Path
+from types import SimpleNamespace
+from wf.options import PlotOptions
+from wf.pipeline import estimate_models, process_file
+from wf.sampling import stratified_sample
+files = {tasbe_files!r}
+models = estimate_models(lambda: stratified_sample(files, "Dox", 3000), Path({str(tmp_path / "estimate")!r}),
+                         plots=PlotOptions(enabled=False))
+output = Path({str(tmp_path / "file")!r})
+output.mkdir()
+gate = SimpleNamespace(gate_name="Bright", channel="FITC-A", threshold=100.0)
+process_file(Path(files[0][0]), "Dox", "1", models, output, gate, plots=PlotOptions(enabled=False))
+""")
+    assert "wf.pipeline" in modules
+    # cytoflow itself still loads matplotlib
+    assert "wf.plots" not in modules
@@ -0,0 +1,93 @@
+import json
+
+import pandas as pd
+
+from wf.metrics import RunMetrics, profiled, summarize_batch, summarize_gates, summarize_stages
+
+
+def test_stages(tmp_path):
+    metrics = RunMetrics(tmp_path)
+    with metrics.stage("export", events=10) as stage:
+        with metrics.stage("write"):
+            (tmp_path / "cell_matrix.parquet").write_bytes(b"x" * 1000)
+        stage.info["files"] = 1
+
+    write, export = metrics.stages
+    assert (write.stage, write.parent, write.bytes_written) == ("write", "export", 1000)
+    assert (export.stage, export.parent, export.bytes_written) == ("export", None, 1000)
+    assert export.info == {"events": 10, "files": 1}
+    assert export.seconds >= write.seconds
+    assert export.peak_rss_mb >= write.peak_rss_mb > 0
+
+
+def test_failed_stage_is_recorded(tmp_path):
+    metrics = RunMetrics(tmp_path)
+    try:
+        with metrics.stage("gates"):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert [s.stage for s in metrics.stages] == ["gates"]
+
+
+def test_record_gates_and_outputs(tmp_path):
+    metrics = RunMetrics(tmp_path)
+    metrics.record_gates(pd.DataFrame({
+        "gate": ["All", "All", "CellBulk_2", "CellBulk_2", "Bright"],
+        "parent": ["", "", "All", "All", "CellBulk_2"],
+        "channel": ["A", "B", "A", "B", "A"],
+        "events": [100, 100, 60, 60, 15],
+    }))
+    assert metrics.gates == {
+        "All": {"parent": None, "events_in": 100, "events_out": 100},
+        "CellBulk_2": {"parent": "All", "events_in": 100, "events_out": 60},
+        "Bright": {"parent": "CellBulk_2", "events_in": 60, "events_out": 15},
+    }
+
+    (tmp_path / "plots").mkdir()
+    (tmp_path / "plots" / "a.png").write_bytes(b"png")
+    metrics.record_outputs()
+    metrics.write(tmp_path / "run_metrics.json")
+    written = json.loads((tmp_path / "run_metrics.json").read_text())
+    assert written["outputs"] == {"plots/a.png": 3}
+    assert written["gates"]["Bright"]["events_out"] == 15
+
+
+def run(seconds, peak, gates):
+    return {
+        "stages": [{"stage": "gates", "seconds": seconds, "peak_rss_mb": peak, "bytes_written": 10}],
+        "gates": {gate: {"parent": None, "events_in": n, "events_out": n // 2} for gate, n in gates.items()},
+    }
+
+
+def test_summaries():
+    runs = [run(1.0, 100, {"All": 10}), run(2.0, 300, {"All": 20}), run(0.5, 200, {})]
+    assert summarize_stages(runs) == {"gates": {"runs": 3, "seconds": 3.5, "peak_rss_mb": 300, "bytes_written": 30}}
+    assert summarize_gates(runs) == {"All": {"parent": None, "events_in": 30, "events_out": 15}}
+
+
+def test_profiled(tmp_path):
+    with profiled(tmp_path / "profile" / "estimate.prof"):
+        sorted(range(1000))
+    assert (tmp_path / "profile" / "estimate.prof").stat().st_size > 0
+    assert "cumulative" in (tmp_path / "profile" / "estimate.prof.txt").read_text()
+
+    with profiled(None):
+        pass
+
+
+def test_summarize_batch():
+    def plate(estimate):
+        return {
+            "estimate": run(5.0, 500, {}) if estimate else None,
+            "files": {"a": run(1.0, 100, {"All": 10}), "b": run(1.0, 100, {"All": 10})},
+            "reduce": run(0.5, 50, {}),
+            "stage_totals": {},
+        }
+
+    batch = summarize_batch({"plate1": plate(True), "plate2": plate(False)}, "plate1")
+    assert batch["experiments"] == ["plate1", "plate2"]
+    # The shared estimate once, four files and two reduces
+    assert batch["stage_totals"]["gates"] == {"runs": 7, "seconds": 10.0, "peak_rss_mb": 500, "bytes_written": 70}
+    assert batch["gate_totals"]["All"]["events_in"] == 40
+    assert batch["estimate"] == plate(True)["estimate"]
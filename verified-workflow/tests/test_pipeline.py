@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import pandas as pd
+
+from wf.export import merge_csvs, merge_quadrant_statistics
+
+from conftest import QUAD_GATE, THRESHOLD_GATE
+
+
+def test_models_round_trip(models, tmp_path):
+    from wf.models import load_models, save_models
+
+    save_models(models, tmp_path / "models.json")
+    restored = load_models(tmp_path / "models.json")
+    assert restored.to_dict() == models.to_dict()
+
+
+def test_process_file(tasbe_files, models, tmp_path):
+    from wf.options import PlotOptions
+    from wf.pipeline import process_file
+
+    process_file(Path(tasbe_files[0][0]), "Dox", "1", models, tmp_path, THRESHOLD_GATE, QUAD_GATE,
+                 plots=PlotOptions(dpi=30, processes=1), output_csv=True)
+
+    statistics = pd.read_csv(tmp_path / "statistics.csv")
+    counts = statistics.drop_duplicates("gate").set_index("gate")["events"]
+    assert counts["All"] == 10000
+    assert counts[[f"Quad_{i}" for i in range(1, 5)]].sum() == 10000
+    assert counts["Bright"] < counts["All"]
+
+    quadrants = pd.read_csv(tmp_path / "quadrant_gate" / "quadrant_statistics.csv")
+    assert quadrants["cells"].sum() == 10000
+    cells = pd.read_csv(tmp_path / "cell_matrix.csv")
+    assert len(cells) == 10000 and (cells["Dox"] == 1).all()
+    assert cells["Bright"].sum() == counts["Bright"]
+    for plot in ["threshold_gate/threshold_plot.png", "quadrant_gate/scatterplot.png"]:
+        assert (tmp_path / plot).stat().st_size > 0
+
+
+def test_merge_csvs(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / f"{i}.csv")
+        pd.DataFrame({"FITC-A": [i, i + 0.5], "Dox": [str(i)] * 2}).to_csv(paths[-1], index=False)
+    merge_csvs(paths, tmp_path / "merged.csv")
+    merged = pd.read_csv(tmp_path / "merged.csv")
+    pd.testing.assert_frame_equal(merged, pd.concat([pd.read_csv(p) for p in paths], ignore_index=True))
+
+
+def test_merge_quadrant_statistics(tmp_path):
+    paths = []
+    for i, cells in enumerate([[1, 2, 3, 4], [10, 20, 30, 40]]):
+        paths.append(tmp_path / f"{i}.csv")
+        pd.DataFrame({"quadrant": [1, 2, 3, 4], "quadrant_name": ["Q_1", "Q_2", "Q_3", "Q_4"],
+                      "cells": cells}).to_csv(paths[-1], index=False)
+    merge_quadrant_statistics(paths, tmp_path / "merged.csv")
+    assert pd.read_csv(tmp_path / "merged.csv")["cells"].tolist() == [11, 22, 33, 44]
@@ -0,0 +1,47 @@
+import pytest
+
+pytest.importorskip("cytoflow")
+
+from wf import plots as plot
+from wf.options import PlotOptions
+from wf.sampling import stratified_sample
+
+
+@pytest.fixture(scope="module")
+def experiment(tasbe_files, models):
+    return models.apply(stratified_sample(tasbe_files, "Dox", 3000))
+
+
+def jobs(directory, options):
+    return [
+        (plot.scatter, dict(path=directory / "scatterplot.png", options=options,
+                            xchannel="FSC-A", ychannel="SSC-A", huefacet="CellBulk_2")),
+        (plot.scatter, dict(path=directory / "markers.png", options=options,
+                            xchannel="FITC-A", ychannel="Pacific Blue-A", huefacet="Dox")),
+        (plot.histogram, dict(path=directory / "histograms" / "FITC-A.png", options=options, channel="FITC-A")),
+        (plot.threshold, dict(path=directory / "threshold_gate" / "threshold_plot.png", options=options,
+                              name="Bright", channel="FITC-A", threshold=100.0)),
+    ]
+
+
+@pytest.mark.parametrize("options", [PlotOptions(dpi=40, processes=1), PlotOptions(dpi=40, processes=3),
+                                     PlotOptions(dpi=40, density=False, processes=2)])
+def test_render(experiment, tmp_path, options):
+    plot.setup(options)
+    plot.render(plot.event_bins(experiment), jobs(tmp_path, options), options)
+    for _, kwargs in jobs(tmp_path, options):
+        assert kwargs["path"].read_bytes().startswith(b"\x89PNG")
+
+
+def test_disabled(experiment, tmp_path):
+    options = PlotOptions(enabled=False)
+    plot.render(plot.event_bins(experiment), jobs(tmp_path, options), options)
+    assert not list(tmp_path.iterdir())
+
+
+def test_failed_job_is_raised(experiment, tmp_path):
+    options = PlotOptions(dpi=40, processes=2)
+    broken = jobs(tmp_path, options) + [(plot.histogram, dict(path=tmp_path / "x.png", options=options,
+                                                               channel="Missing-A"))]
+    with pytest.raises(KeyError):
+        plot.render(plot.event_bins(experiment), broken, options)
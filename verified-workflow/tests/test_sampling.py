@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("cytoflow")
+import cytoflow as flow
+
+from wf.fcs import iter_chunks, read_events
+from wf.models import apply_gmm
+from wf.pipeline import GMM_PARAMETERS
+from wf.sampling import allocate, reservoir_sample, sample_tubes, stratified_sample
+
+from conftest import FLUOR_CHANNELS
+
+
+def test_allocate_splits_budget_evenly():
+    assert allocate(10, 3) == [4, 3, 3]
+    assert sum(allocate(100001, 15)) == 100001
+    assert allocate(2, 3) == [1, 1, 0]
+
+
+def test_reservoir_sample_returns_positions(tasbe_files):
+    path = tasbe_files[0][0]
+    events = read_events(path)
+    sample, positions = reservoir_sample(iter_chunks(path, 997), 1000, np.random.default_rng(0))
+    assert len(sample) == len(set(positions)) == 1000
+    pd.testing.assert_frame_equal(sample, events.iloc[positions].reset_index(drop=True))
+    # Uniform over the tube, not only its first chunks
+    assert positions.max() > 9000
+
+    again, _ = reservoir_sample(iter_chunks(path, 5000), 1000, np.random.default_rng(0))
+    assert not again.equals(reservoir_sample(iter_chunks(path, 5000), 1000, np.random.default_rng(1))[0])
+
+
+def test_reservoir_sample_skips_excluded(tasbe_files):
+    path = tasbe_files[0][0]
+    exclude = np.arange(0, 10000, 2)
+    _, positions = reservoir_sample(iter_chunks(path, 997), 3000, np.random.default_rng(0), exclude)
+    assert len(positions) == 3000
+    assert not np.isin(positions, exclude).any()
+
+    # Fewer events left than asked for: all of them
+    _, positions = reservoir_sample(iter_chunks(path, 997), 8000, np.random.default_rng(0), exclude)
+    assert sorted(positions) == list(range(1, 10000, 2))
+
+
+def test_sample_tubes(tasbe_files):
+    tubes = sample_tubes(tasbe_files, 3001, seed=3)
+    assert [len(data) for data, _ in tubes] == [1001, 1000, 1000]
+    again = sample_tubes(tasbe_files, 3001, seed=3)
+    for (a, _), (b, _) in zip(tubes, again):
+        pd.testing.assert_frame_equal(a, b)
+
+    everything = sample_tubes(tasbe_files, None)
+    assert [len(data) for data, _ in everything] == [10000] * 3
+
+
+def test_holdout_is_disjoint(tasbe_files):
+    estimation = [positions for _, positions in sample_tubes(tasbe_files, 15000, 0)]
+    holdout = sample_tubes(tasbe_files, 15000, 1, exclude=estimation)
+    for used, (_, positions) in zip(estimation, holdout):
+        assert len(positions) == 5000
+        assert not np.isin(positions, used).any()
+
+
+def test_stratified_sample(tasbe_files):
+    ex = stratified_sample(tasbe_files, "Dox", 3000)
+    assert len(ex.data) == 3000
+    assert ex.data.groupby("Dox").size().to_dict() == {"1": 1000, "2": 1000, "3": 1000}
+
+
+def test_controls_are_estimated_on_the_sample(tasbe_files, blank_file, controls):
+    ex = stratified_sample(tasbe_files, "Dox", 3000)
+    gmm = flow.GaussianMixtureOp(**GMM_PARAMETERS)
+    gmm.estimate(ex)
+    ex = apply_gmm(gmm, ex)
+
+    af = flow.AutofluorescenceOp(blank_file=blank_file, channels=FLUOR_CHANNELS)
+    af.estimate(ex, subset="CellBulk_2 == True")
+    assert set(af._af_median) == set(FLUOR_CHANNELS)
+    ex = af.apply(ex)
+
+    bl = flow.BleedthroughLinearOp(controls=controls)
+    bl.estimate(ex, subset="CellBulk_2 == True")
+    assert len(bl.spillover) == 6
+    assert all(0 <= value < 0.05 for value in bl.spillover.values())
@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("cytoflow")
+
+from wf.fcs import read_events, read_header
+from wf.options import PlotOptions
+from wf.pipeline import process_file
+from wf.streaming import experiment_from_events
+
+from conftest import QUAD_GATE, THRESHOLD_GATE
+
+
+def test_experiment_has_import_metadata(tasbe_files):
+    path = tasbe_files[0][0]
+    header = read_header(path)
+    ex = experiment_from_events([(read_events(path), "1")], "Dox", header)
+
+    assert ex.metadata["ignore_v"] == []
+    assert ex.metadata["name_metadata"] == "$PnN"
+    assert ex.metadata["Dox"]["experiment"]
+    assert ex.channels == header.channels
+    for channel in ex.channels:
+        assert ex.metadata[channel]["fcs_name"] == channel
+        assert ex.metadata[channel]["range"] == header.ranges[channel]
+    assert len(ex.data) == header.event_count
+
+
+def run(path, models, output_directory, chunk_events, plots=PlotOptions(enabled=False)):
+    output_directory.mkdir(parents=True, exist_ok=True)
+    process_file(Path(path), "Dox", "1", models, output_directory, THRESHOLD_GATE, QUAD_GATE,
+                 plots=plots, chunk_events=chunk_events)
+    return pd.read_csv(output_directory / "statistics.csv")
+
+
+@pytest.mark.parametrize("chunk_events", [997, 4000])
+def test_chunked_matches_in_memory(tasbe_files, models, tmp_path, chunk_events):
+    path = tasbe_files[0][0]
+    exact = run(path, models, tmp_path / "memory", None)
+    streamed = run(path, models, tmp_path / "chunks", chunk_events)
+
+    assert streamed["gate"].tolist() == exact["gate"].tolist()
+    assert streamed["events"].tolist() == exact["events"].tolist()
+    np.testing.assert_allclose(streamed["geometric_mean"], exact["geometric_mean"], rtol=1e-5)
+    # Streaming medians come from histograms; see StatisticsAccumulator
+    assert (streamed["median"].isna() == exact["median"].isna()).all()
+    error = np.abs(streamed["median"] - exact["median"]).fillna(0)
+    assert (error <= 0.0025 * np.maximum(np.abs(exact["median"]), 1.0).fillna(0)).all()
+
+    cells = pd.read_parquet(tmp_path / "chunks" / "cell_matrix.parquet")
+    assert len(cells) == read_header(path).event_count
+    pd.testing.assert_frame_equal(cells, pd.read_parquet(tmp_path / "memory" / "cell_matrix.parquet"),
+                                  check_exact=False, rtol=1e-5)
+
+
+def test_chunked_marker_plots(tasbe_files, models, tmp_path):
+    # Without density plots, markers are drawn from a sample with the models
+    # applied again
+    plots = PlotOptions(dpi=50, density=False, processes=1)
+    run(tasbe_files[0][0], models, tmp_path, 2000, plots)
+    assert (tmp_path / "quadrant_gate" / "scatterplot.png").stat().st_size > 0
+    assert (tmp_path / "threshold_gate" / "threshold_plot.png").stat().st_size > 0
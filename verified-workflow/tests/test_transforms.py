@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from wf.transforms import Transform
+
+LOGICLE_PARAMETERS = [
+    dict(),
+    dict(width=0.0),
+    dict(width=1.0, negative_decades=1.0),
+    dict(top=10000.0, decades=4.0),
+]
+
+
+def channel_values(top):
+    return np.concatenate([
+        -np.logspace(0, np.log10(top / 10), 50),
+        [0.0],
+        np.logspace(-1, np.log10(top), 80),
+    ])
+
+
+@pytest.mark.parametrize("parameters", LOGICLE_PARAMETERS)
+def test_logicle_round_trip(parameters):
+    t = Transform("logicle", **parameters)
+    values = channel_values(t.top)
+    np.testing.assert_allclose(t.inverse(t.apply(values)), values, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("parameters", LOGICLE_PARAMETERS)
+def test_logicle_scale(parameters):
+    t = Transform("logicle", **parameters)
+    zero, top = t.apply(np.array([0.0, t.top]))
+    # Zero sits at the end of the negative and linear regions, the top at 1
+    assert zero == pytest.approx((t.width + t.negative_decades) / (t.decades + t.negative_decades), abs=1e-6)
+    assert top == pytest.approx(1.0, abs=1e-6)
+
+    # Increasing throughout, including the log continuation beyond the top
+    values = np.sort(np.concatenate([channel_values(t.top), [10 * t.top, 100 * t.top]]))
+    assert (np.diff(t.apply(values)) >= 0).all()
+
+
+@pytest.mark.parametrize("kind", ["linear", "log", "arcsinh"])
+def test_round_trip(kind):
+    t = Transform(kind)
+    values = np.logspace(-1, 5, 50)
+    if kind != "log":
+        values = np.concatenate([-values, values])
+    np.testing.assert_allclose(t.inverse(t.apply(values)), values, rtol=1e-6)
@@ -1,9 +1,11 @@
-from wf.task import task
+from wf.task import estimate_task, prepare_task, apply_task, reduce_task
 
+from latch.resources.map_tasks import map_task
 from latch.resources.workflow import workflow
 from latch.types.directory import LatchOutputDir
 from latch.types.metadata import LatchAuthor, LatchMetadata, LatchParameter
 from dataclasses import dataclass
+from enum import Enum
 from latch.types import LatchDir, LatchFile, Section, Params, Text
 from latch.resources.launch_plan import LaunchPlan
 from typing import Annotated, Iterable, List, Optional, Tuple, Union
@@ -41,6 +43,73 @@ class ThresholdOp:
     # subset: str
     # subset_val: bool
 
+class GateType(Enum):
+    threshold = "threshold"
+    range = "range"
+    polygon = "polygon"
+    quad = "quad"
+
+@dataclass
+class Gate:
+    gate_name: str
+    gate_type: GateType
+    xchannel: str
+    # Name of the parent population (a gate, a quadrant such as Quad_2, or
+    # CellBulk_2); all events if empty
+    parent: Optional[str] = None
+    ychannel: Optional[str] = None
+    xthreshold: Optional[float] = None
+    ythreshold: Optional[float] = None
+    low: Optional[float] = None
+    high: Optional[float] = None
+    xvertices: Optional[List[float]] = None
+    yvertices: Optional[List[float]] = None
+
+class TransformType(Enum):
+    linear = "linear"
+    log = "log"
+    arcsinh = "arcsinh"
+    logicle = "logicle"
+
+@dataclass
+class ChannelTransform:
+    channel: str
+    transform: TransformType
+    cofactor: float = 150.0
+    # Logicle parameters T, W, M and A
+    top: float = 262144.0
+    width: float = 0.5
+    decades: float = 4.5
+    negative_decades: float = 0.0
+
+class ClusterMethod(Enum):
+    kmeans = "kmeans"
+    som = "som"
+
+class EmbeddingMethod(Enum):
+    none = "none"
+    pca = "pca"
+    umap = "umap"
+    tsne = "tsne"
+
+@dataclass
+class Clustering:
+    method: ClusterMethod
+    clusters: int = 10
+    # Compensated fluorescence channels if empty
+    channels: Optional[List[str]] = None
+    som_xdim: int = 10
+    som_ydim: int = 10
+    embedding: EmbeddingMethod = EmbeddingMethod.umap
+    embedding_events: int = 20000
+    seed: int = 0
+
+@dataclass
+class Experiment:
+    # An additional plate analysed with the main experiment's models and gates
+    experiment_name: str
+    fcs_files: List[FCS]
+
 metadata = LatchMetadata(
     display_name="Cytoflow",
     author=LatchAuthor(
@@ -61,6 +130,12 @@ metadata = LatchMetadata(
             display_name="Condition name",
             batch_table_column=True,  # Show this parameter in batched mode.
         ), 
+        "experiments": LatchParameter(
+            display_name="Additional Plates",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Further experiments, each with its own name and FCS files, analysed with the same controls, models and gates as the main experiment.",
+            description="The Gaussian mixture, autofluorescence and compensation models are estimated once across every plate."
+        ),
         "autofluoresence": LatchParameter(
             display_name="Compute Autofluoresence",
             batch_table_column=True,  # Show this parameter in batched mode.
@@ -74,6 +149,12 @@ metadata = LatchMetadata(
             detail="Apply matrix-based bleedthrough correction to a set of fluorescence channels.",
             description="Provide the single-color control files and the name of the channels they should be measured in."
         ),
+        "header_spillover": LatchParameter(
+            display_name="Use Instrument Spillover Matrix",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Without compensation controls, compensate every FCS file with the spillover matrix its instrument recorded in the file header ($SPILLOVER or $SPILL).",
+            description="Files without a spillover matrix in their header fail."
+        ),
         "quad_gate": LatchParameter(
             display_name="Add Quadrant Gate",
             batch_table_column=True,  # Show this parameter in batched mode.
@@ -82,6 +163,12 @@ metadata = LatchMetadata(
             display_name="Add Threshold Gate",
             batch_table_column=True,  # Show this parameter in batched mode.
         ),
+        "gates": LatchParameter(
+            display_name="Gating Hierarchy",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Named threshold, range, polygon and quadrant gates. Each gate is applied to the events of its parent population: another gate, a quadrant (e.g. Quad_2) or CellBulk_2. Leave the parent empty to gate all events.",
+            description="Threshold: xchannel and xthreshold. Range: xchannel, low and high. Polygon: xchannel, ychannel, xvertices and yvertices. Quadrant: xchannel, xthreshold, ychannel and ythreshold."
+        ),
         "marker_size": LatchParameter(
             display_name="Set Plot Marker Size",
             batch_table_column=True,  # Show this parameter in batched mode.
@@ -92,6 +179,74 @@ metadata = LatchMetadata(
             batch_table_column=True,  # Show this parameter in batched mode.
             detail="The opacity of the marker that will be used in scatterplots."
         ),
+        "make_plots": LatchParameter(
+            display_name="Make Plots",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Turn off for a fast run that only outputs statistics and the cell matrix."
+        ),
+        "plot_dpi": LatchParameter(
+            display_name="Plot DPI",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Resolution of every saved plot."
+        ),
+        "density_plots": LatchParameter(
+            display_name="Density Scatterplots",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Draw scatterplots as binned event densities instead of one marker per event. Much faster for files with many events."
+        ),
+        "estimation_events": LatchParameter(
+            display_name="Estimation Events (Total)",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="The Gaussian mixture, autofluorescence and compensation models are fit once on a sample of this many events in total, split evenly across the FCS files, then applied to every event of every file in parallel."
+        ),
+        "estimation_seed": LatchParameter(
+            display_name="Estimation Sample Seed",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Random seed of the estimation sample. The same files, event count and seed always give the same sample."
+        ),
+        "estimation_report": LatchParameter(
+            display_name="Report Estimation Accuracy",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Also fit the Gaussian mixture on every event and compare it to the sample fit on a held-out sample. Slow; use it to check the event count is large enough."
+        ),
+        "chunk_events": LatchParameter(
+            display_name="Stream Events in Chunks of",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="If set, each FCS file is memory-mapped and processed this many events at a time instead of being loaded whole, so large files run in bounded memory. Marker scatterplots are drawn from a random sample of this many events."
+        ),
+        "estimate_cache": LatchParameter(
+            display_name="Reuse Estimates From",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="An estimate_cache folder from a previous run. Gaussian mixture, autofluorescence and compensation models fit on identical files with identical parameters are reused instead of re-estimated."
+        ),
+        "incremental": LatchParameter(
+            display_name="Incremental Re-analysis",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Checkpoint every stage's outputs with a fingerprint of its inputs and parameters, and reuse the checkpoints of the previous run written to the same output directory, so only stages whose inputs changed are run again.",
+            description="For example, changing a gate threshold re-gates the stored compensated events without re-importing the FCS files or re-estimating the models."
+        ),
+        "transforms": LatchParameter(
+            display_name="Channel Transforms",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Scale of each channel in every plot and for clustering: linear, log, arcsinh with a cofactor, or logicle with T, W, M and A.",
+            description="Channels without a transform use linear for FSC, log for SSC and logicle for fluorescence channels."
+        ),
+        "clustering": LatchParameter(
+            display_name="Clustering",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Cluster the compensated channels with mini-batch k-means or a self-organising map (FlowSOM-style), and embed a subsample with PCA, UMAP or t-SNE.",
+            description="Clusters are fitted on the estimation sample and every event is assigned to its nearest cluster."
+        ),
+        "profile": LatchParameter(
+            display_name="Profile Run",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="Run model estimation and every per-file task under cProfile and save the profiles under profile/. Stage timings, memory, gate event counts and output sizes are always written to run_metrics.json."
+        ),
+        "output_csv": LatchParameter(
+            display_name="Also Output Cell Matrix as CSV",
+            batch_table_column=True,  # Show this parameter in batched mode.
+            detail="The cell matrix is always written as a Parquet dataset partitioned by condition. Writing a CSV copy is much slower and larger."
+        ),
         "output_to_registry": LatchParameter(
             display_name="Add Table ID to Output to Registry",
             batch_table_column=True,  # Show this parameter in batched mode.
@@ -106,19 +261,34 @@ metadata = LatchMetadata(
         Section(
             "Basic Inputs",
             Text("Specify the name for this experiment. For each FCS file, add its path and its value for the specified condition name."),
-            Params("experiment_name", "condition_name", "fcs_files")),
+            Params("experiment_name", "condition_name", "fcs_files", "experiments")),
+        Section(
+            "Plots",
+            Text("Control which plots are made and how they are rendered."),
+            Params("make_plots", "plot_dpi", "density_plots", "marker_size", "marker_alpha")),
         Section(
             "Workflow Logic",
             Text("Select compensation corrections and gates to apply to FCS files."),
             Params(
                 "autofluoresence",
                 "bleedthrough",
+                "header_spillover",
                 "quad_gate",
-                "threshold_gate")),
+                "threshold_gate",
+                "gates",
+                "transforms",
+                "clustering",
+                "estimation_events",
+                "estimation_seed",
+                "estimation_report",
+                "chunk_events",
+                "estimate_cache",
+                "incremental",
+                "profile")),
         Section(
             "Outputs",
             Text("Select the output directory for the generated workflow files."),
-            Params("output_to_registry", "output_directory"))]
+            Params("output_csv", "output_to_registry", "output_directory"))]
 )
 
 @workflow(metadata)
@@ -134,6 +304,22 @@ def cytoflow(
     output_directory: LatchOutputDir,
     marker_size: float = 0.5,
     marker_alpha: float = 0.7,
+    estimation_events: int = 100000,
+    estimation_seed: int = 0,
+    estimation_report: bool = False,
+    chunk_events: Optional[int] = None,
+    output_csv: bool = False,
+    estimate_cache: Optional[LatchDir] = None,
+    make_plots: bool = True,
+    plot_dpi: int = 350,
+    density_plots: bool = True,
+    gates: Optional[List[Gate]] = None,
+    profile: bool = False,
+    experiments: Optional[List[Experiment]] = None,
+    clustering: Optional[Clustering] = None,
+    transforms: Optional[List[ChannelTransform]] = None,
+    incremental: bool = False,
+    header_spillover: bool = False,
 ) -> LatchOutputDir:
     
     """
@@ -181,6 +367,22 @@ def cytoflow(
     * **output_directory:** Directory where output files from the analysis will be stored
     * **marker_size:** Marker size for matplotlib marker that is used in scatterplots (default = 0.5)
     * **marker_alpha:** Marker size for matplotlib marker that is used in scatterplots (default = 0.7, value must be between 0.0 and 1.0)
+    * **make_plots:** Set to False for a statistics-only run that skips all plots and plot bins and only outputs statistics and the cell matrix (default = True)
+    * **plot_dpi:** Resolution of every saved plot (default = 350)
+    * **density_plots:** Draw scatterplots as 2D-binned event densities rather than one marker per event; `marker_size` and `marker_alpha` then only apply when this is off (default = True)
+    * **estimation_events:** Total number of events sampled to fit the Gaussian mixture, autofluorescence and compensation models. The budget is split evenly across FCS files and each file is reservoir-sampled in a single pass (default = 100000)
+    * **estimation_seed:** Random seed of the estimation sample (default = 0)
+    * **estimation_report:** Also fit the Gaussian mixture on every event and write `estimation_report.json`, comparing the sample and full fits (component means and weights, log-likelihood and gate agreement on an independent holdout sample) (default = False)
+    * **chunk_events:** Optional. Process each FCS file this many events at a time, reading the FCS data segment through a memory map, so that files with millions of events run in bounded memory. Medians are then read from fine per-channel histograms and are within about 0.2% of the exact median (0.002 absolute for values near zero)
+    * **output_csv:** Also write the cell matrix as a single CSV (default = False)
+    * **estimate_cache:** Optional. The `estimate_cache` folder of a previous run. Models whose input files and parameters are unchanged are loaded from it instead of being re-estimated
+    * **incremental:** Checkpoint the outputs of every stage and, when re-run into the same output directory, only run again the stages whose inputs or parameters changed (default = False)
+    * **header_spillover:** Without `bleedthrough` controls, compensate every FCS file with the spillover matrix recorded in its header (`$SPILLOVER`, `$SPILL` or `SPILL`) (default = False)
+    * **gates:** Optional. A gating hierarchy of named gates. Each gate has a type (`threshold`, `range`, `polygon` or `quad`), its channels and limits, and a parent population: another gate, a quadrant such as `Quad_2`, or `CellBulk_2`. Gates without a parent apply to all events
+    * **transforms:** Optional. The scale of a channel in every plot and for clustering: `linear`, `log` (non-positive values are left out), `arcsinh` with `cofactor`, or `logicle` with `top` (T), `width` (W), `decades` (M) and `negative_decades` (A). Each channel is transformed once per table of events and every plot reads the transformed values, with axis ticks in channel units. Channels without a transform use linear for FSC, log for SSC and logicle (T = the channel's range) for everything else. A channel's range is the largest `$PnR` it has in any FCS file of the run, written to `channel_ranges.json`, so every file is scaled and plotted on the same axes. Gate limits are always given in channel units
+    * **clustering:** Optional. Cluster the events of `CellBulk_2` on the compensated channels (`channels`, by default the compensation or else the autofluorescence channels). `method` is `kmeans` (mini-batch k-means with `clusters` clusters) or `som` (a `som_xdim` x `som_ydim` self-organising map whose nodes are merged into `clusters` metaclusters, as in FlowSOM). `embedding` (`none`, `pca`, `umap` or `tsne`) is computed on `embedding_events` randomly chosen clustered events of the estimation sample
+    * **experiments:** Optional. Additional plates, each an experiment name with its own FCS files and condition values, analysed in the same run with the same controls, models and gates as the main experiment
+    * **profile:** Also run model estimation and every per-file task under cProfile, saving `profile/estimate.prof` and `files/<file>/profile/apply.prof` with a text summary of the slowest functions next to each (default = False)
 
     # Output Files
 
@@ -223,18 +425,68 @@ def cytoflow(
 
     """
 
-    return task(
+    estimates = estimate_task(
         experiment_name=experiment_name,
-        fcs_files=fcs_files, 
+        fcs_files=fcs_files,
         condition_name=condition_name,
         autofluoresence=autofluoresence,
         bleedthrough=bleedthrough,
+        output_directory=output_directory,
+        estimation_events=estimation_events,
+        estimation_seed=estimation_seed,
+        estimation_report=estimation_report,
+        estimate_cache=estimate_cache,
+        make_plots=make_plots,
+        plot_dpi=plot_dpi,
+        density_plots=density_plots,
+        marker_size=marker_size,
+        marker_alpha=marker_alpha,
+        profile=profile,
+        experiments=experiments,
+        clustering=clustering,
+        transforms=transforms,
+        incremental=incremental,
+        header_spillover=header_spillover,
         threshold_gate=threshold_gate,
         quad_gate=quad_gate,
-        output_to_registry=output_to_registry,
-        marker_alpha=marker_alpha,
+        gates=gates)
+
+    file_inputs = prepare_task(
+        experiment_name=experiment_name,
+        fcs_files=fcs_files,
+        condition_name=condition_name,
+        estimates=estimates,
+        threshold_gate=threshold_gate,
+        quad_gate=quad_gate,
+        make_plots=make_plots,
+        plot_dpi=plot_dpi,
+        density_plots=density_plots,
         marker_size=marker_size,
-        output_directory=output_directory)
+        marker_alpha=marker_alpha,
+        chunk_events=chunk_events,
+        output_csv=output_csv,
+        gates=gates,
+        profile=profile,
+        experiments=experiments,
+        transforms=transforms,
+        incremental=incremental)
+
+    results = map_task(apply_task)(input=file_inputs)
+
+    return reduce_task(
+        experiment_name=experiment_name,
+        fcs_files=fcs_files,
+        condition_name=condition_name,
+        results=results,
+        quad_gate=quad_gate,
+        output_to_registry=output_to_registry,
+        output_directory=output_directory,
+        output_csv=output_csv,
+        estimates=estimates,
+        experiments=experiments,
+        clustering=clustering,
+        make_plots=make_plots,
+        incremental=incremental)
 
 LaunchPlan(
     cytoflow,
@@ -0,0 +1,179 @@
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+
+import numpy as np
+import pandas as pd
+
+from wf.gates import ALL_EVENTS, GateMasks
+from wf.transforms import ChannelTransforms, ScaledEvents, Transform
+
+
+# Pre-binned event counts that every histogram and density plot is drawn
+# from. Each channel is binned once, on a fixed grid over its transformed
+# range, and the counts of every population are then read off those bin
+# indices with one bincount, instead of every plot rescanning the events.
+# Because the grids only depend on the transforms and the channel ranges,
+# which are shared by every file of a run (the largest $PnR over the run, see
+# wf.fcs.common_ranges), the counts of chunks and of files add up; they are
+# saved as a compressed .npz
+# (one per file, and one per condition for the experiment) that viewers can
+# load without the events:
+#   transforms                   JSON of each channel's transform
+#   edges|<channel>              histogram bin edges (transformed scale)
+#   density_edges|<channel>      density grid edges (transformed scale)
+#   histogram|<group>|<channel>  event counts per histogram bin
+#   density|<group>|<x>|<y>      event counts per density cell (x by y)
+# Groups are All, the gate populations and, for hue facets, <column>=<value>.
+
+HISTOGRAM_BINS = 1024
+DENSITY_BINS = 512
+
+
+@dataclass
+class BinSpec:
+    # Counts to bin up front: histograms of every channel for every group,
+    # and (group, xchannel, ychannel) densities
+    groups: List[str]
+    channels: List[str]
+    densities: List[Tuple[str, str, str]]
+
+
+class EventBins:
+    def __init__(
+        self,
+        transforms: ChannelTransforms,
+        events: Optional[ScaledEvents] = None,
+        populations: Optional[GateMasks] = None,
+    ):
+        # events and populations are only needed to bin counts that are not
+        # there yet, e.g. a hue facet of one plot
+        self.transforms = transforms
+        self.events = events
+        self.populations = populations
+        self.edges: Dict[str, np.ndarray] = {}
+        self.density_edges: Dict[str, np.ndarray] = {}
+        self.histograms: Dict[Tuple[str, str], np.ndarray] = {}
+        self.densities: Dict[Tuple[str, str, str], np.ndarray] = {}
+        self._indices: Dict[Tuple[str, int], np.ndarray] = {}
+        self._masks: Dict[str, Optional[np.ndarray]] = {}
+
+    def _edges(self, channel: str, bins: int) -> np.ndarray:
+        edges = self.edges if bins == HISTOGRAM_BINS else self.density_edges
+        if channel not in edges:
+            low, high = self.transforms.domain(channel)
+            edges[channel] = np.linspace(low, high, bins + 1)
+        return edges[channel]
+
+    def _index(self, channel: str, bins: int) -> np.ndarray:
+        # Bin of every event; values outside the grid are counted in the
+        # first or last bin and non-finite values (log of <= 0) in none
+        if (channel, bins) not in self._indices:
+            edges = self._edges(channel, bins)
+            values = self.events.scaled(channel)
+            index = np.clip(((values - edges[0]) * (bins / (edges[-1] - edges[0]))).astype(np.int32), 0, bins - 1)
+            self._indices[(channel, bins)] = np.where(np.isfinite(values), index, -1)
+        return self._indices[(channel, bins)]
+
+    def _mask(self, group: str) -> Optional[np.ndarray]:
+        if group not in self._masks:
+            if group == ALL_EVENTS:
+                mask = None
+            elif self.populations is not None and group in self.populations.tree.parents:
+                mask = self.populations.mask(group)
+            else:
+                column, value = group.split("=", 1)
+                mask = (self.events.data[column].astype(str) == value).to_numpy()
+            self._masks[group] = mask
+        return self._masks[group]
+
+    def compute(self, groups: Iterable[str], channels: List[str], densities: Iterable[Tuple[str, str, str]] = ()):
+        # Histograms of every channel for every group, one bincount per
+        # group, and the (group, xchannel, ychannel) densities
+        index = np.column_stack([self._index(c, HISTOGRAM_BINS) for c in channels])
+        offsets = np.arange(len(channels)) * (HISTOGRAM_BINS + 1)
+        for group in groups:
+            mask = self._mask(group)
+            selected = index if mask is None else index[mask]
+            # Offset each channel's bins (with a slot for non-finite values)
+            # so one bincount covers all channels
+            counts = np.bincount((selected + 1 + offsets).ravel(), minlength=len(channels) * (HISTOGRAM_BINS + 1))
+            counts = counts.reshape(len(channels), HISTOGRAM_BINS + 1)[:, 1:]
+            for c, channel in enumerate(channels):
+                self.histograms[(group, channel)] = counts[c]
+        for group, xchannel, ychannel in densities:
+            self.density(group, xchannel, ychannel)
+
+    def add_events(self, data: pd.DataFrame, populations: Optional[GateMasks], spec: BinSpec):
+        # Bins another table of events (e.g. one streamed chunk) and adds its
+        # counts
+        chunk = EventBins(self.transforms, ScaledEvents(data, self.transforms), populations)
+        chunk.compute(spec.groups, spec.channels, spec.densities)
+        self.add(chunk)
+
+    def histogram(self, group: str, channel: str) -> Tuple[np.ndarray, np.ndarray]:
+        if (group, channel) not in self.histograms:
+            self.compute([group], [channel])
+        return self.histograms[(group, channel)], self._edges(channel, HISTOGRAM_BINS)
+
+    def density(self, group: str, xchannel: str, ychannel: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        key = (group, xchannel, ychannel)
+        if key not in self.densities:
+            x, y = self._index(xchannel, DENSITY_BINS), self._index(ychannel, DENSITY_BINS)
+            mask = self._mask(group)
+            valid = (x >= 0) & (y >= 0)
+            if mask is not None:
+                valid &= mask
+            cells = np.bincount(x[valid] * DENSITY_BINS + y[valid], minlength=DENSITY_BINS * DENSITY_BINS)
+            self.densities[key] = cells.reshape(DENSITY_BINS, DENSITY_BINS)
+        return self.densities[key], self._edges(xchannel, DENSITY_BINS), self._edges(ychannel, DENSITY_BINS)
+
+    def add(self, other: "EventBins"):
+        # Adds the counts of other (e.g. the next chunk, or another file of
+        # the same condition); grids have to match
+        for own, theirs in ((self.edges, other.edges), (self.density_edges, other.density_edges)):
+            for channel, edges in theirs.items():
+                if channel not in own:
+                    own[channel] = edges
+                elif len(own[channel]) != len(edges) or not np.allclose(own[channel], edges):
+                    raise ValueError(f"Bins of {channel} do not match")
+        for key, counts in other.histograms.items():
+            self.histograms[key] = self.histograms[key] + counts if key in self.histograms else counts.copy()
+        for key, counts in other.densities.items():
+            self.densities[key] = self.densities[key] + counts if key in self.densities else counts.copy()
+
+    def save(self, path: Path):
+        arrays = {"transforms": np.array(json.dumps({c: asdict(t) for c, t in self.transforms.transforms.items()}))}
+        arrays.update({f"edges|{c}": e for c, e in self.edges.items()})
+        arrays.update({f"density_edges|{c}": e for c, e in self.density_edges.items()})
+        arrays.update({f"histogram|{g}|{c}": v for (g, c), v in self.histograms.items()})
+        arrays.update({f"density|{g}|{x}|{y}": v for (g, x, y), v in self.densities.items()})
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, **arrays)
+
+
+def load_bins(path: Path) -> EventBins:
+    with np.load(path) as f:
+        transforms = ChannelTransforms()
+        transforms.transforms = {c: Transform(**t) for c, t in json.loads(str(f["transforms"])).items()}
+        bins = EventBins(transforms)
+        for name in f.files:
+            kind, *key = name.split("|")
+            if kind == "edges":
+                bins.edges[key[0]] = f[name]
+            elif kind == "density_edges":
+                bins.density_edges[key[0]] = f[name]
+            elif kind == "histogram":
+                bins.histograms[tuple(key)] = f[name]
+            elif kind == "density":
+                bins.densities[tuple(key)] = f[name]
+    return bins
+
+
+def merge_bins(paths: List[Path], output_path: Path):
+    # Sums the counts of several files, e.g. every file of one condition
+    merged = load_bins(paths[0])
+    for path in paths[1:]:
+        merged.add(load_bins(path))
+    merged.save(output_path)
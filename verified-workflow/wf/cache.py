@@ -0,0 +1,138 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+import hashlib
+import json
+import shutil
+
+
+# Content-addressed store for estimated models and per-file stage
+# checkpoints. Each entry is a directory named <kind>-<key> holding
+# params.json and any output files (plots, tables), where key is a hash of
+# the input file contents and the stage parameters. Large outputs that stay
+# in the output directory the store is in (e.g. the cell matrix) are only
+# referenced: the entry keeps their sha256 in references.json, and they are
+# only restored if the output, or the previous run's output next to its
+# store, still has that checksum. Entries are looked up in every search
+# directory, then in a previous run's remote store, and written to the first
+# one. Remote entries are fetched file by file, so only the outputs that are
+# restored are downloaded.
+
+def file_digest(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+class EstimateCache:
+    def __init__(
+        self,
+        directory: Path,
+        search: Optional[List[Path]] = None,
+        remote: Optional[Callable[[str], Optional[Path]]] = None,
+    ):
+        # remote fetches a file of the remote store by its path relative to
+        # the store, returning None if it does not exist
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.search = [self.directory] + [Path(d) for d in (search or [])]
+        self.remote = remote
+
+    def _find(self, kind: str, key: str, names: List[str]) -> Optional[Path]:
+        for d in self.search:
+            entry = d / f"{kind}-{key}"
+            if (entry / "params.json").exists():
+                return entry
+        if self.remote is None:
+            return None
+
+        params = self.remote(f"{kind}-{key}/params.json")
+        if params is None:
+            return None
+        entry = self.entry(kind, key)
+        for name in names:
+            path = self.remote(f"{kind}-{key}/{name}")
+            if path is not None:
+                (entry / name).parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(path, entry / name)
+        # params.json last, so an interrupted fetch is not taken for an entry
+        shutil.move(params, entry / "params.json")
+        return entry
+
+    def entry(self, kind: str, key: str) -> Path:
+        # Where an entry is written
+        return self.directory / f"{kind}-{key}"
+
+    def get(
+        self,
+        kind: str,
+        key: str,
+        plots: Optional[Dict[str, Path]] = None,
+        files: Optional[List[str]] = None,
+        references: Optional[Dict[str, Path]] = None,
+    ) -> Optional[dict]:
+        # plots maps file names stored in the entry to where they should be
+        # restored in the output directory; files are read in place from
+        # entry(kind, key) instead; references map the names of referenced
+        # outputs to their path in the output directory
+        entry = self._find(kind, key, list(plots or {}) + list(files or []) + ["references.json"])
+        if entry is None:
+            print(f"Cache miss: {kind} {key}")
+            return None
+        if not self._restore_references(entry, references or {}):
+            print(f"Cache miss: {kind} {key} (referenced output changed)")
+            return None
+
+        print(f"Cache hit: {kind} {key} ({entry})")
+        if entry.parent != self.directory:
+            shutil.copytree(entry, self.directory / entry.name, dirs_exist_ok=True)
+        for name, path in (plots or {}).items():
+            if (entry / name).exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(entry / name, path)
+        with open(entry / "params.json") as f:
+            return json.load(f)
+
+    def _restore_references(self, entry: Path, references: Dict[str, Path]) -> bool:
+        # Whether every referenced output is in place with its recorded
+        # checksum, fetching it from the previous run if it is not
+        if not references:
+            return True
+        if not (entry / "references.json").exists():
+            return False
+        with open(entry / "references.json") as f:
+            digests = json.load(f)
+        for name, path in references.items():
+            if path.exists() and file_digest(path) == digests.get(name):
+                continue
+            fetched = self.remote(f"../{name}") if self.remote is not None else None
+            if fetched is None or file_digest(fetched) != digests.get(name):
+                return False
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(fetched, path)
+        return True
+
+    def put(
+        self,
+        kind: str,
+        key: str,
+        params: dict,
+        plots: Optional[Dict[str, Path]] = None,
+        references: Optional[Dict[str, Path]] = None,
+    ):
+        entry = self.entry(kind, key)
+        entry.mkdir(parents=True, exist_ok=True)
+        for name, path in (plots or {}).items():
+            if path.exists():
+                (entry / name).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy(path, entry / name)
+        if references:
+            with open(entry / "references.json", "w") as f:
+                json.dump({name: file_digest(path) for name, path in references.items()}, f, indent=2)
+        with open(entry / "params.json", "w") as f:
+            json.dump(params, f, indent=2)
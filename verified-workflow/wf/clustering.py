@@ -0,0 +1,242 @@
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
+from sklearn.decomposition import PCA
+
+from wf.gates import GatingTree
+from wf.transforms import ChannelTransforms, Transform
+
+
+# Unsupervised clustering of the compensated fluorescence channels. Clusters
+# are fitted once on the estimation sample, either with mini-batch k-means or
+# with a FlowSOM-style self-organising map whose nodes are metaclustered by
+# hierarchical clustering. Every event is then assigned to its nearest
+# centroid or SOM node a block at a time, so assignment is linear in the
+# number of events and runs chunk by chunk when streaming.
+#
+# Channels are transformed (see wf.transforms) and standardised before
+# clustering. Only events in the Gaussian mixture gate are clustered; the
+# Cluster column is 0 for the others. Clusters are numbered from 1 by
+# decreasing size in the estimation sample.
+
+CLUSTER_COLUMN = "Cluster"
+SOM_COLUMN = "SOM_node"
+
+CLUSTER_METHODS = ("kmeans", "som")
+EMBEDDING_METHODS = ("none", "pca", "umap", "tsne")
+
+BLOCK_EVENTS = 65536
+EMBEDDING_COMPONENTS = 10
+
+
+def cluster_names(clusters: int) -> List[str]:
+    return [f"{CLUSTER_COLUMN}_{i}" for i in range(1, clusters + 1)]
+
+
+def _nearest(x: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    # Index of the nearest center of every row, using
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2 where |x|^2 is the same for every c
+    squares = (centers ** 2).sum(axis=1)
+    nearest = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), BLOCK_EVENTS):
+        block = x[start:start + BLOCK_EVENTS]
+        nearest[start:start + BLOCK_EVENTS] = np.argmin(squares - 2 * block @ centers.T, axis=1)
+    return nearest
+
+
+@dataclass
+class ClusterModel:
+    method: str
+    channels: List[str]
+    transforms: Dict[str, Transform]
+    mean: np.ndarray
+    std: np.ndarray
+    # k-means centroids or the SOM codebook, in standardised units
+    centers: np.ndarray
+    # SOM node -> 0-based metacluster
+    node_clusters: Optional[np.ndarray] = None
+    gate: str = "CellBulk_2"
+
+    @property
+    def clusters(self) -> int:
+        if self.node_clusters is not None:
+            return int(self.node_clusters.max()) + 1
+        return len(self.centers)
+
+    def transform(self, values: np.ndarray) -> np.ndarray:
+        scaled = np.column_stack([self.transforms[c].apply(values[:, i]) for i, c in enumerate(self.channels)])
+        return (scaled - self.mean) / self.std
+
+    def nodes(self, data: pd.DataFrame) -> np.ndarray:
+        # Nearest centroid or SOM node of every event, -1 outside the gate
+        inside = np.flatnonzero(data[self.gate].to_numpy(dtype=bool, na_value=False))
+        values = data[self.channels].to_numpy(dtype=np.float64)
+        nodes = np.full(len(data), -1, dtype=np.int64)
+        for start in range(0, len(inside), BLOCK_EVENTS):
+            rows = inside[start:start + BLOCK_EVENTS]
+            nodes[rows] = _nearest(self.transform(values[rows]), self.centers)
+        return nodes
+
+    def labels(self, nodes: np.ndarray) -> np.ndarray:
+        if self.node_clusters is None:
+            return np.where(nodes >= 0, nodes + 1, 0)
+        return np.where(nodes >= 0, self.node_clusters[nodes] + 1, 0)
+
+    def to_dict(self) -> dict:
+        return {
+            "method": self.method,
+            "channels": list(self.channels),
+            "transforms": {c: asdict(t) for c, t in self.transforms.items()},
+            "mean": self.mean.tolist(),
+            "std": self.std.tolist(),
+            "centers": self.centers.tolist(),
+            "node_clusters": self.node_clusters.tolist() if self.node_clusters is not None else None,
+            "gate": self.gate,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "ClusterModel":
+        return cls(
+            method = d["method"],
+            channels = d["channels"],
+            transforms = {c: Transform(**t) for c, t in d["transforms"].items()},
+            mean = np.array(d["mean"]),
+            std = np.array(d["std"]),
+            centers = np.array(d["centers"]),
+            node_clusters = np.array(d["node_clusters"]) if d["node_clusters"] is not None else None,
+            gate = d["gate"])
+
+
+def train_som(x: np.ndarray, xdim: int, ydim: int, seed: int = 0, epochs: int = 10) -> np.ndarray:
+    # Batch SOM: every epoch moves each node to the neighbourhood-weighted
+    # mean of the events whose nearest node is close to it on the grid, with
+    # a Gaussian neighbourhood shrinking from half the grid to a single node
+    rng = np.random.default_rng(seed)
+    nodes = xdim * ydim
+    grid = np.array([(i, j) for i in range(xdim) for j in range(ydim)], dtype=np.float64)
+    grid_distances = ((grid[:, None, :] - grid[None, :, :]) ** 2).sum(axis=2)
+    codebook = x[rng.choice(len(x), nodes, replace=len(x) < nodes)].copy()
+
+    for radius in np.linspace(max(xdim, ydim) / 2, 0.5, epochs):
+        nearest = _nearest(x, codebook)
+        counts = np.bincount(nearest, minlength=nodes).astype(np.float64)
+        sums = np.column_stack([np.bincount(nearest, weights=x[:, c], minlength=nodes) for c in range(x.shape[1])])
+        neighbourhood = np.exp(-grid_distances / (2 * radius ** 2))
+        weights = neighbourhood @ counts
+        update = weights > 0
+        codebook[update] = (neighbourhood @ sums)[update] / weights[update, None]
+    return codebook
+
+
+def fit_clusters(
+    data: pd.DataFrame,
+    channels: List[str],
+    method: str = "kmeans",
+    clusters: int = 10,
+    seed: int = 0,
+    som_xdim: int = 10,
+    som_ydim: int = 10,
+    gate: str = "CellBulk_2",
+    transforms: Optional[ChannelTransforms] = None,
+) -> ClusterModel:
+    if method not in CLUSTER_METHODS:
+        raise ValueError(f"Unknown clustering method {method}")
+    missing = [c for c in channels if c not in data.columns]
+    if missing:
+        raise ValueError(f"Clustering channels not found: {', '.join(missing)}")
+    if len(channels) < 2:
+        raise ValueError("Clustering needs at least 2 channels")
+
+    transforms = transforms or ChannelTransforms()
+    channel_transforms = {c: transforms[c] for c in channels}
+    values = data.loc[data[gate] == True, channels].to_numpy(dtype=np.float64)
+    if len(values) < clusters:
+        raise ValueError(f"Only {len(values)} sampled events in {gate} for {clusters} clusters")
+    scaled = np.column_stack([channel_transforms[c].apply(values[:, i]) for i, c in enumerate(channels)])
+    if not np.isfinite(scaled).all():
+        raise ValueError("Clustering channels need transforms defined for every value (not log)")
+    mean, std = scaled.mean(axis=0), scaled.std(axis=0)
+    std[std == 0] = 1.0
+    x = (scaled - mean) / std
+
+    if method == "kmeans":
+        print(f"Fitting {clusters} mini-batch k-means clusters on {len(x)} events")
+        kmeans = MiniBatchKMeans(n_clusters=clusters, batch_size=4096, n_init=3, random_state=seed).fit(x)
+        model = ClusterModel(method, list(channels), channel_transforms, mean, std, kmeans.cluster_centers_, gate=gate)
+    else:
+        print(f"Training a {som_xdim}x{som_ydim} self-organising map on {len(x)} events")
+        codebook = train_som(x, som_xdim, som_ydim, seed)
+        metaclusters = AgglomerativeClustering(n_clusters=min(clusters, len(codebook)), linkage="ward").fit_predict(codebook)
+        model = ClusterModel(method, list(channels), channel_transforms, mean, std, codebook, metaclusters, gate=gate)
+
+    # Renumber clusters by decreasing size in the sample
+    sizes = np.bincount(model.labels(_nearest(x, model.centers)) - 1, minlength=model.clusters)
+    order = np.argsort(-sizes, kind="stable")
+    if model.node_clusters is None:
+        model.centers = model.centers[order]
+    else:
+        model.node_clusters = np.argsort(order)[model.node_clusters]
+    return model
+
+
+def cluster_columns(data: pd.DataFrame, model: ClusterModel) -> Dict[str, np.ndarray]:
+    nodes = model.nodes(data)
+    columns = {CLUSTER_COLUMN: model.labels(nodes)}
+    if model.method == "som":
+        columns[SOM_COLUMN] = nodes + 1
+    for name in columns:
+        if name in data.columns:
+            raise ValueError(f"Clustering column {name} clashes with an existing column")
+    return {name: values.astype(np.int16) for name, values in columns.items()}
+
+
+def add_cluster_columns(data: pd.DataFrame, model: ClusterModel):
+    for name, values in cluster_columns(data, model).items():
+        data[name] = values
+
+
+def cluster_tree(model: ClusterModel) -> GatingTree:
+    # Clusters as populations under the gate they were fitted on, so cluster
+    # statistics are computed like gate statistics
+    base = {model.gate: (model.gate, True)}
+    for i, name in enumerate(cluster_names(model.clusters), start=1):
+        base[name] = (CLUSTER_COLUMN, i, model.gate)
+    return GatingTree([], base = base)
+
+
+def embed(
+    model: ClusterModel,
+    data: pd.DataFrame,
+    method: str = "umap",
+    events: int = 20000,
+    seed: int = 0,
+) -> pd.DataFrame:
+    # 2D embedding of a random subsample of the clustered events: PCA of the
+    # standardised channels, then UMAP or t-SNE on the leading components.
+    # t-SNE uses the learning rate scaled with the number of events, as in
+    # opt-SNE.
+    if method not in EMBEDDING_METHODS:
+        raise ValueError(f"Unknown embedding method {method}")
+    rng = np.random.default_rng(seed)
+    inside = np.flatnonzero(data[model.gate].to_numpy(dtype=bool, na_value=False))
+    rows = np.sort(rng.choice(inside, min(events, len(inside)), replace=False))
+    sample = data.iloc[rows].reset_index(drop=True)
+
+    x = model.transform(sample[model.channels].to_numpy(dtype=np.float64))
+    components = PCA(n_components=min(EMBEDDING_COMPONENTS, x.shape[1]), random_state=seed).fit_transform(x)
+    print(f"Embedding {len(sample)} events with {method}")
+    if method == "umap":
+        import umap
+        coordinates = umap.UMAP(n_components=2, random_state=seed).fit_transform(components)
+    elif method == "tsne":
+        from sklearn.manifold import TSNE
+        coordinates = TSNE(n_components=2, init="pca", learning_rate="auto", random_state=seed).fit_transform(components)
+    else:
+        coordinates = components[:, :2]
+
+    sample["Embedding_1"] = coordinates[:, 0]
+    sample["Embedding_2"] = coordinates[:, 1]
+    return sample
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+import os
+
+import numpy as np
+import pandas as pd
+
+from wf.fcs import FCSHeader
+
+
+# Spillover compensation. The spillover matrix S has one row per
+# fluorochrome and one column per detector, with S[i, j] the fraction of
+# channel i's signal measured in channel j (1 on the diagonal), so that
+# observed = true @ S and true = observed @ inv(S). The matrix is either read
+# from the $SPILLOVER (FCS 3.1), $SPILL or SPILL keyword the instrument wrote
+# in the FCS header, or built from the pairwise bleedthrough coefficients
+# estimated on single-colour controls. The inverse is computed once and
+# applied to the event array as one matrix product per block of events, the
+# blocks running on a thread pool (NumPy releases the GIL in matmul).
+
+SPILLOVER_KEYWORDS = ("$SPILLOVER", "$SPILL", "SPILL")
+
+BLOCK_EVENTS = 65536
+
+
+@dataclass
+class Compensation:
+    channels: List[str]
+    spillover: np.ndarray
+    # "controls" or "header"; a header matrix is read again from every
+    # file, since each instrument records its own
+    source: str = "controls"
+
+    def __post_init__(self):
+        self.spillover = np.asarray(self.spillover, dtype=np.float64)
+        if self.spillover.shape != (len(self.channels), len(self.channels)):
+            raise ValueError(f"Spillover matrix of shape {self.spillover.shape} for {len(self.channels)} channels")
+        self._inverse = None
+
+    @property
+    def inverse(self) -> np.ndarray:
+        if self._inverse is None:
+            self._inverse = np.linalg.inv(self.spillover)
+        return self._inverse
+
+    def compensate(self, values: np.ndarray, workers: Optional[int] = None) -> np.ndarray:
+        # values has one row per event and one column per channel, in the
+        # order of self.channels
+        values = np.ascontiguousarray(values, dtype=np.float64)
+        compensated = np.empty_like(values)
+        inverse = self.inverse
+
+        def block(start: int):
+            np.matmul(values[start:start + BLOCK_EVENTS], inverse, out=compensated[start:start + BLOCK_EVENTS])
+
+        starts = range(0, len(values), BLOCK_EVENTS)
+        workers = min(len(starts), workers or os.cpu_count() or 1)
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(block, starts))
+        else:
+            for start in starts:
+                block(start)
+        return compensated
+
+    def apply(self, ex):
+        # Returns a compensated copy of a cytoflow Experiment
+        missing = [c for c in self.channels if c not in ex.data.columns]
+        if missing:
+            raise ValueError(f"Compensation channels not found: {', '.join(missing)}")
+        ex = ex.clone(deep=False)
+        compensated = self.compensate(ex.data[self.channels].to_numpy(dtype=np.float64))
+        for i, channel in enumerate(self.channels):
+            ex.data[channel] = compensated[:, i]
+        return ex
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.spillover, index=self.channels, columns=self.channels)
+
+    def save(self, path: Path):
+        # The matrix as CSV, rows are fluorochromes and columns detectors;
+        # the same layout as the FCS keyword, so it can be loaded into other
+        # analysis software
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.to_frame().to_csv(path, index_label="channel")
+
+    def to_dict(self) -> dict:
+        return {
+            "channels": list(self.channels),
+            "spillover": self.spillover.tolist(),
+            "source": self.source,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Compensation":
+        return cls(d["channels"], np.array(d["spillover"]), d.get("source", "controls"))
+
+
+def parse_spillover(value: str, source: str = "header") -> Compensation:
+    # n,channel_1,...,channel_n,s_11,s_12,...,s_nn (row major)
+    tokens = [t.strip() for t in value.split(",")]
+    try:
+        n = int(tokens[0])
+        channels = tokens[1:n + 1]
+        spillover = np.array([float(t) for t in tokens[n + 1:]])
+    except ValueError:
+        raise ValueError(f"Malformed spillover matrix: {value[:80]}")
+    if n < 1 or len(channels) != n or len(spillover) != n * n:
+        raise ValueError(f"Malformed spillover matrix: {value[:80]}")
+    return Compensation(channels, spillover.reshape(n, n), source)
+
+
+def header_compensation(header: FCSHeader) -> Optional[Compensation]:
+    # The spillover matrix recorded in the header, None if there is none.
+    # Some instruments name detectors by $PnS rather than $PnN.
+    for keyword in SPILLOVER_KEYWORDS:
+        value = header.text.get(keyword)
+        if not value:
+            continue
+        compensation = parse_spillover(value)
+        names = {header.parameter(i, "S"): c for i, c in enumerate(header.channels) if header.parameter(i, "S")}
+        compensation.channels = [c if c in header.channels else names.get(c, c) for c in compensation.channels]
+        unknown = [c for c in compensation.channels if c not in header.channels]
+        if unknown:
+            raise ValueError(f"{header.path.name}: spillover matrix channels not in the file: {', '.join(unknown)}")
+        return compensation
+    return None
+
+
+def bleedthrough_compensation(channels: List[str], bleedthrough: dict) -> Compensation:
+    # bleedthrough maps (from channel, to channel) to the fraction of the
+    # first channel measured in the second, as estimated by cytoflow's
+    # BleedthroughLinearOp
+    spillover = np.eye(len(channels))
+    for i, a in enumerate(channels):
+        for j, b in enumerate(channels):
+            if i != j:
+                spillover[i, j] = bleedthrough[(a, b)]
+    return Compensation(list(channels), spillover, "controls")
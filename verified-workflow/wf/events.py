@@ -0,0 +1,77 @@
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+
+# Compact in-memory event table used by the pipeline once the models have
+# been applied. Cytoflow keeps every channel as float64, the condition as
+# Python strings and every gate as a full-width column; here channels are
+# float32 arrays, string and categorical columns are integer-coded
+# categoricals and boolean columns (model gates such as CellBulk_2 and gate
+# membership) are bit-packed. The table supports the column access the
+# gating, statistics, binning and clustering code uses on DataFrames, and is
+# only turned into a DataFrame at the export boundaries (cell matrix and
+# checkpoints) with to_frame().
+
+Column = Union[np.ndarray, pd.Categorical]
+
+
+class EventTable:
+    def __init__(self, size: int, channels: Optional[List[str]] = None):
+        self.size = size
+        self.channels = list(channels or [])
+        self._columns: Dict[str, Column] = {}
+        self._packed = set()
+
+    @classmethod
+    def from_frame(cls, data: pd.DataFrame, channels: Optional[Iterable[str]] = None) -> "EventTable":
+        table = cls(len(data), channels)
+        for column in data.columns:
+            table[column] = data[column]
+        return table
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    @property
+    def index(self) -> pd.RangeIndex:
+        return pd.RangeIndex(self.size)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(v.nbytes for v in self._columns.values())
+
+    def __setitem__(self, name: str, values):
+        if len(values) != self.size:
+            raise ValueError(f"Column {name} has {len(values)} values for {self.size} events")
+        self._packed.discard(name)
+        dtype = getattr(values, "dtype", None)
+        if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            self._columns[name] = pd.Categorical(values)
+            return
+        values = np.asarray(values)
+        if values.dtype == bool:
+            self._columns[name] = np.packbits(values)
+            self._packed.add(name)
+        elif values.dtype.kind == "f":
+            self._columns[name] = values.astype(np.float32, copy=False)
+        else:
+            self._columns[name] = values
+
+    def values(self, name: str) -> Column:
+        if name in self._packed:
+            return np.unpackbits(self._columns[name], count=self.size).view(bool)
+        return self._columns[name]
+
+    def __getitem__(self, key) -> Union[pd.Series, pd.DataFrame]:
+        if isinstance(key, str):
+            return pd.Series(self.values(key), name=key, copy=False)
+        return pd.DataFrame({c: self.values(c) for c in key})
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({c: self.values(c) for c in self._columns})
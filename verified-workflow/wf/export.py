@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Iterator, List, Optional
+from urllib.parse import quote
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# The cell matrix is written as Parquet with float32 channels and dictionary
+# encoded condition and gate columns. The merged output is a hive-partitioned
+# dataset, cell_matrix/<condition_name>=<value>/<file>.parquet, so readers can
+# load a subset of columns or conditions. CSV is only written on request.
+
+def compact_frame(data: pd.DataFrame, drop=()) -> pd.DataFrame:
+    columns = {}
+    for column in data.columns:
+        if column in drop:
+            continue
+        values = data[column]
+        if values.dtype == np.float64:
+            values = values.astype(np.float32)
+        elif values.dtype == object:
+            values = values.astype("category")
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def partition_path(condition_name: str, condition_val: str, file_name: str) -> Path:
+    return (Path("cell_matrix")
+        / f"{quote(condition_name, safe='')}={quote(str(condition_val), safe='')}"
+        / f"{file_name}.parquet")
+
+
+class EventWriter:
+    # Appends event chunks to cell_matrix.parquet (and cell_matrix.csv if
+    # requested) in output_directory. The condition column is dropped from the
+    # Parquet file since its value is stored in the partition path.
+
+    def __init__(self, output_directory: Path, condition_name: str, output_csv: bool = False):
+        self.parquet_path = output_directory / "cell_matrix.parquet"
+        self.csv_path = output_directory / "cell_matrix.csv" if output_csv else None
+        self.condition_name = condition_name
+        self._parquet: Optional[pq.ParquetWriter] = None
+        self._csv = None
+
+    def write(self, data: pd.DataFrame):
+        table = pa.Table.from_pandas(
+            compact_frame(data, drop=(self.condition_name,)),
+            schema=self._parquet.schema if self._parquet else None,
+            preserve_index=False)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.parquet_path, table.schema, compression="zstd")
+        self._parquet.write_table(table)
+
+        if self.csv_path:
+            header = self._csv is None
+            if header:
+                self._csv = open(self.csv_path, "w")
+            data.to_csv(self._csv, header=header, index=False)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._csv is not None:
+            self._csv.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_event_store(
+    path: Path,
+    chunk_events: Optional[int] = None,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    # The columns of a stored cell matrix in chunks of chunk_events, or all
+    # at once
+    if not chunk_events:
+        yield pd.read_parquet(path, columns=columns)
+        return
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_events, columns=columns):
+        yield batch.to_pandas()
+
+
+def merge_csvs(paths: List[Path], output_path: Path):
+    # Concatenate CSVs with identical headers without parsing them
+    with open(output_path, "w") as out:
+        header_written = False
+        for path in paths:
+            with open(path) as f:
+                header = f.readline()
+                if not header_written:
+                    out.write(header)
+                    header_written = True
+                shutil.copyfileobj(f, out)
+
+
+def merge_quadrant_statistics(paths: List[Path], output_path: Path):
+    frames = [pd.read_csv(path) for path in paths]
+    merged = (pd.concat(frames)
+        .groupby(['quadrant', 'quadrant_name'], as_index=False)['cells']
+        .sum())
+    merged.to_csv(output_path, index=False)
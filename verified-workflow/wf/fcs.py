@@ -0,0 +1,205 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+# Minimal reader for the FCS 2.0/3.x list-mode binary layout. The DATA segment
+# is memory-mapped so events can be read in fixed-size chunks without loading
+# the whole file. write_fcs writes the same layout back out, e.g. for
+# synthetic benchmark files.
+
+@dataclass
+class FCSHeader:
+    path: Path
+    version: str
+    text: Dict[str, str]
+    data_start: int
+    data_end: int
+    channels: List[str] = field(default_factory=list)
+
+    @property
+    def event_count(self) -> int:
+        return int(self.text["$TOT"])
+
+    @property
+    def parameter_count(self) -> int:
+        return int(self.text["$PAR"])
+
+    def parameter(self, i: int, key: str) -> Optional[str]:
+        # Parameters are 1-indexed in the FCS standard, e.g. $P1N
+        return self.text.get(f"$P{i + 1}{key}")
+
+    @property
+    def ranges(self) -> Dict[str, float]:
+        return {c: float(self.parameter(i, "R")) for i, c in enumerate(self.channels)}
+
+
+def common_ranges(headers: Iterable[FCSHeader]) -> Dict[str, float]:
+    # The largest $PnR of every channel over several files. $PnR is often
+    # just the file's own data maximum, so every task of a run scales and
+    # bins channels on these shared ranges instead.
+    ranges: Dict[str, float] = {}
+    for header in headers:
+        for channel, value in header.ranges.items():
+            ranges[channel] = max(value, ranges.get(channel, value))
+    return ranges
+
+
+def _parse_text(raw: bytes) -> Dict[str, str]:
+    raw = raw.decode("utf-8", errors="replace")
+    delimiter = raw[0]
+    # A doubled delimiter is an escaped literal delimiter inside a value
+    placeholder = "\0"
+    tokens = raw[1:].replace(delimiter * 2, placeholder).split(delimiter)
+    tokens = [t.replace(placeholder, delimiter) for t in tokens]
+    if tokens and tokens[-1] == "":
+        tokens = tokens[:-1]
+
+    text = {}
+    for key, value in zip(tokens[0::2], tokens[1::2]):
+        text[key.strip().upper()] = value.strip()
+    return text
+
+
+def read_header(path: Path) -> FCSHeader:
+    path = Path(path)
+    with open(path, "rb") as f:
+        header = f.read(58)
+        version = header[0:6].decode("ascii")
+        if not version.startswith("FCS"):
+            raise ValueError(f"{path} is not an FCS file")
+
+        offsets = [int(header[i:i + 8].strip() or 0) for i in range(10, 58, 8)]
+        text_start, text_end, data_start, data_end = offsets[:4]
+
+        f.seek(text_start)
+        text = _parse_text(f.read(text_end - text_start + 1))
+
+    # Offsets that do not fit in the 8-byte header fields are only in TEXT
+    if data_start == 0 or data_end == 0:
+        data_start = int(text["$BEGINDATA"])
+        data_end = int(text["$ENDDATA"])
+
+    fcs = FCSHeader(path, version, text, data_start, data_end)
+    fcs.channels = [fcs.parameter(i, "N") for i in range(fcs.parameter_count)]
+
+    mode = text.get("$MODE", "L")
+    if mode != "L":
+        raise ValueError(f"{path}: only list mode FCS files are supported (found $MODE {mode})")
+
+    return fcs
+
+
+def _record_dtype(header: FCSHeader) -> np.dtype:
+    byteorder = header.text.get("$BYTEORD", "1,2,3,4")
+    endian = "<" if byteorder.startswith("1") else ">"
+    datatype = header.text["$DATATYPE"].upper()
+
+    fields = []
+    for i, channel in enumerate(header.channels):
+        if datatype == "F":
+            fmt = "f4"
+        elif datatype == "D":
+            fmt = "f8"
+        elif datatype == "I":
+            bits = int(header.parameter(i, "B"))
+            if bits not in (8, 16, 32, 64):
+                raise ValueError(f"{header.path}: unsupported integer width {bits} for {channel}")
+            fmt = f"u{bits // 8}"
+        else:
+            raise ValueError(f"{header.path}: unsupported $DATATYPE {datatype}")
+        fields.append((f"p{i}", endian + fmt))
+    return np.dtype(fields)
+
+
+def open_events(header: FCSHeader) -> np.memmap:
+    dtype = _record_dtype(header)
+    return np.memmap(
+        header.path,
+        dtype=dtype,
+        mode="r",
+        offset=header.data_start,
+        shape=(header.event_count,))
+
+
+def _to_frame(header: FCSHeader, records: np.ndarray) -> pd.DataFrame:
+    columns = {}
+    for i, channel in enumerate(header.channels):
+        values = np.asarray(records[f"p{i}"])
+        if values.dtype.kind == "u":
+            # Integer data only uses the low bits covered by $PnR
+            value_range = int(float(header.parameter(i, "R")))
+            if value_range & (value_range - 1) == 0:
+                values = values & (value_range - 1)
+        columns[channel] = values.astype(np.float64)
+    return pd.DataFrame(columns)
+
+
+def iter_chunks(path: Path, chunk_events: int) -> Iterator[pd.DataFrame]:
+    header = read_header(path)
+    events = open_events(header)
+    for start in range(0, header.event_count, chunk_events):
+        yield _to_frame(header, events[start:start + chunk_events])
+
+
+def read_events(path: Path, indices: Optional[np.ndarray] = None) -> pd.DataFrame:
+    header = read_header(path)
+    events = open_events(header)
+    if indices is not None:
+        events = events[np.sort(indices)]
+    return _to_frame(header, events)
+
+
+def sample_events(path: Path, n: int, seed: int = 0) -> pd.DataFrame:
+    header = read_header(path)
+    if n >= header.event_count:
+        return read_events(path)
+    rng = np.random.default_rng(seed)
+    return read_events(path, rng.choice(header.event_count, size=n, replace=False))
+
+
+# Keywords describing the segment layout of the file they were read from
+_SEGMENT_KEYWORDS = {"$BEGINDATA", "$ENDDATA", "$BEGINANALYSIS", "$ENDANALYSIS",
+                     "$BEGINSTEXT", "$ENDSTEXT", "$NEXTDATA", "$TOT"}
+
+
+def write_fcs(path: Path, header: FCSHeader, records: Iterable[np.ndarray], event_count: int):
+    # Writes an FCS 3.1 file with the TEXT keywords and record layout of
+    # header; records are chunks of that layout (e.g. slices of open_events)
+    # and must hold event_count events in total
+    dtype = _record_dtype(header)
+    text = {k: v for k, v in header.text.items() if k not in _SEGMENT_KEYWORDS}
+    text["$TOT"] = str(event_count)
+
+    def encode(offsets: Dict[str, int]) -> bytes:
+        # Fixed-width offsets, so the TEXT length does not depend on them
+        keywords = dict(text, **{k: f"{v:020d}" for k, v in offsets.items()})
+        escape = lambda value: (value or " ").replace("/", "//")
+        return ("/" + "".join(f"{escape(k)}/{escape(v)}/" for k, v in keywords.items())).encode("utf-8")
+
+    text_start = 256
+    placeholder = dict.fromkeys(["$BEGINDATA", "$ENDDATA", "$BEGINANALYSIS", "$ENDANALYSIS", "$BEGINSTEXT", "$ENDSTEXT", "$NEXTDATA"], 0)
+    text_end = text_start + len(encode(placeholder)) - 1
+    data_start = text_end + 1
+    data_end = data_start + event_count * dtype.itemsize - 1
+    raw_text = encode(dict(placeholder, **{"$BEGINDATA": data_start, "$ENDDATA": data_end}))
+
+    def offset(value: int) -> str:
+        # Offsets beyond 99,999,999 are only given in TEXT
+        return f"{value if value <= 99999999 else 0:>8}"
+
+    with open(path, "wb") as f:
+        f.write(("FCS3.1    " + offset(text_start) + offset(text_end) + offset(data_start) + offset(data_end)
+                 + offset(0) + offset(0)).encode("ascii").ljust(text_start))
+        f.write(raw_text)
+        written = 0
+        for chunk in records:
+            chunk = np.asarray(chunk).astype(dtype, copy=False)
+            f.write(chunk.tobytes())
+            written += len(chunk)
+
+    if written != event_count:
+        raise ValueError(f"{path}: wrote {written} events, expected {event_count}")
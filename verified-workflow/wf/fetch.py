@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from wf.cache import file_digest
+
+
+# On-node cache for input files. Remote files are downloaded concurrently,
+# with a bounded number of downloads in flight, into a directory keyed by
+# their remote path. Each cached file is stored next to its sha256 and the
+# version of the remote file it was downloaded from (e.g. size and version
+# id), and is only reused if the remote file still has that version and the
+# local copy still has that checksum. Files shared between runs on a node
+# (e.g. the same blank and single-color controls) are only downloaded once, a
+# file replaced at the same remote path is downloaded again and a truncated
+# download is never read.
+
+FILE_CACHE = Path("/root/.cache/flow-cyte/files")
+
+FETCH_WORKERS = 8
+
+
+class LocalStore:
+    # Stand-in for the remote store: remote paths are resolved against a
+    # local directory, e.g. latch:///tasbe/TAL14_1.fcs -> <root>/tasbe/TAL14_1.fcs
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, remote: str) -> Path:
+        return self.root / remote.split("://", 1)[-1].lstrip("/")
+
+    def download(self, remote: str, local: Path):
+        shutil.copyfile(self._path(remote), local)
+
+    def stat(self, remote: str) -> str:
+        stat = self._path(remote).stat()
+        return f"size={stat.st_size};mtime_ns={stat.st_mtime_ns}"
+
+
+def s3_version(remote: str, client=None) -> Optional[str]:
+    # Size, ETag and version id of an S3 object, None if its metadata cannot
+    # be read (e.g. no credentials for the bucket)
+    if client is None:
+        import boto3
+        client = boto3.client("s3")
+    bucket, _, key = remote[len("s3://"):].partition("/")
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        print(f"Could not read the version of {remote}: {e}")
+        return None
+    return json.dumps({
+        "contentSize": head["ContentLength"],
+        "etag": head["ETag"],
+        "versionId": head.get("VersionId"),
+    }, sort_keys=True)
+
+
+class FileCache:
+    def __init__(
+        self,
+        directory: Path,
+        download: Callable[[str, Path], None],
+        stat: Optional[Callable[[str], Optional[str]]] = None,
+    ):
+        # stat returns the current version of a remote file, None if the
+        # store does not report one, in which case the file is always
+        # downloaded again
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.download = download
+        self.stat = stat
+        self.digests: Dict[Path, str] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, remote: str) -> Path:
+        return self.directory / hashlib.sha256(remote.encode()).hexdigest()[:32]
+
+    def _cached(self, path: Path, checksum: Path, version: Path, remote_version: Optional[str]) -> Optional[str]:
+        if not path.exists() or not checksum.exists() or not version.exists():
+            return None
+        if remote_version is None or version.read_text() != remote_version:
+            print(f"Remote file changed or has no version, fetching again: {path}")
+            return None
+        expected = checksum.read_text().strip()
+        if file_digest(path) != expected:
+            print(f"File cache checksum mismatch, fetching again: {path}")
+            return None
+        return expected
+
+    def fetch(self, remote: str) -> Path:
+        entry = self._entry(remote)
+        entry.mkdir(parents=True, exist_ok=True)
+        path = entry / remote.rstrip("/").split("/")[-1]
+        checksum = entry / "sha256"
+        version = entry / "version"
+
+        # Read before downloading, so a file replaced during the download is
+        # recorded with the older version and fetched again next time
+        remote_version = self.stat(remote) if self.stat is not None else None
+        digest = self._cached(path, checksum, version, remote_version)
+        if digest is None:
+            print(f"Downloading {remote}")
+            # Download next to the entry and rename into place, so other
+            # processes never see a partial file
+            partial = entry / f".{path.name}.{os.getpid()}.{threading.get_ident()}"
+            self.download(remote, partial)
+            digest = file_digest(partial)
+            # The checksum and version are removed first, so an interrupted
+            # update never pairs the new file with the old version
+            version.unlink(missing_ok=True)
+            checksum.unlink(missing_ok=True)
+            os.replace(partial, path)
+            checksum.write_text(digest)
+            if remote_version is not None:
+                version.write_text(remote_version)
+        else:
+            print(f"File cache hit: {remote}")
+
+        with self._lock:
+            self.digests[path] = digest
+        return path
+
+    def digest(self, path) -> str:
+        # sha256 of a fetched file without reading it again
+        return self.digests.get(Path(path)) or file_digest(path)
+
+    def fetch_all(self, remotes: Iterable[str], workers: int = FETCH_WORKERS) -> Dict[str, Path]:
+        unique = list(dict.fromkeys(remotes))
+        if not unique:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(unique)))) as pool:
+            return dict(zip(unique, pool.map(self.fetch, unique)))
@@ -0,0 +1,252 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Gating tree evaluated lazily over one shared event table. A population's
+# mask is its own gate condition ANDed with its parent's mask, computed only
+# when first requested and cached as packed bits (one bit per event), so a
+# deep gating strategy costs O(events) memory rather than one full column
+# per gate.
+#
+# Gate types and the events they keep:
+#   threshold: xchannel > xthreshold
+#   range:     low <= xchannel <= high
+#   polygon:   (xchannel, ychannel) inside the polygon (xvertices, yvertices)
+#   quad:      four populations <name>_1 (upper left), <name>_2 (upper right),
+#              <name>_3 (lower left) and <name>_4 (lower right); events on
+#              either threshold line are in no quadrant
+# Threshold and quad gates follow cytoflow's ThresholdOp and QuadOp.
+
+ALL_EVENTS = "All"
+
+GATE_TYPES = ("threshold", "range", "polygon", "quad")
+
+
+@dataclass
+class GateSpec:
+    name: str
+    kind: str
+    xchannel: str
+    ychannel: Optional[str] = None
+    xthreshold: Optional[float] = None
+    ythreshold: Optional[float] = None
+    low: Optional[float] = None
+    high: Optional[float] = None
+    vertices: Optional[np.ndarray] = None
+    parent: str = ALL_EVENTS
+
+    @property
+    def populations(self) -> List[str]:
+        if self.kind == "quad":
+            return [f"{self.name}_{i}" for i in range(1, 5)]
+        return [self.name]
+
+    @property
+    def channels(self) -> List[str]:
+        return [c for c in (self.xchannel, self.ychannel) if c]
+
+
+def gate_spec(gate) -> GateSpec:
+    # Normalises a workflow Gate (or a legacy ThresholdOp / QuadOp input)
+    kind = getattr(gate, "gate_type", None)
+    kind = getattr(kind, "value", kind)
+    if kind is None:
+        kind = "quad" if hasattr(gate, "ythreshold") else "threshold"
+
+    if kind not in GATE_TYPES:
+        raise ValueError(f"Gate {gate.gate_name}: unknown gate type {kind}")
+
+    spec = GateSpec(
+        name=gate.gate_name,
+        kind=kind,
+        xchannel=getattr(gate, "xchannel", None) or getattr(gate, "channel", None),
+        ychannel=getattr(gate, "ychannel", None),
+        xthreshold=getattr(gate, "xthreshold", None) if hasattr(gate, "xthreshold") else getattr(gate, "threshold", None),
+        ythreshold=getattr(gate, "ythreshold", None),
+        low=getattr(gate, "low", None),
+        high=getattr(gate, "high", None),
+        parent=getattr(gate, "parent", None) or ALL_EVENTS)
+
+    if kind == "polygon":
+        xs, ys = getattr(gate, "xvertices", None), getattr(gate, "yvertices", None)
+        if not xs or not ys or len(xs) != len(ys) or len(xs) < 3:
+            raise ValueError(f"Gate {spec.name}: a polygon gate needs at least 3 matching x and y vertices")
+        spec.vertices = np.column_stack([xs, ys]).astype(np.float64)
+
+    required = {
+        "threshold": ["xchannel", "xthreshold"],
+        "range": ["xchannel", "low", "high"],
+        "polygon": ["xchannel", "ychannel"],
+        "quad": ["xchannel", "ychannel", "xthreshold", "ythreshold"],
+    }[kind]
+    missing = [field for field in required if getattr(spec, field) is None]
+    if missing:
+        raise ValueError(f"Gate {spec.name}: a {kind} gate needs {', '.join(missing)}")
+    return spec
+
+
+def _inside_polygon(x: np.ndarray, y: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    # Even-odd ray casting, vectorised over events
+    inside = np.zeros(len(x), dtype=bool)
+    x0, y0 = vertices[-1]
+    for x1, y1 in vertices:
+        crosses = (y1 > y) != (y0 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xcross = (x0 - x1) * (y - y1) / (y0 - y1) + x1
+        inside ^= crosses & (x < xcross)
+        x0, y0 = x1, y1
+    return inside
+
+
+class GatingTree:
+    def __init__(self, gates: List, base: Optional[Dict[str, Tuple]] = None):
+        # base populations are read from existing data columns as
+        # {name: (column, value)}, e.g. the Gaussian mixture gate; their
+        # parent is All unless given as {name: (column, value, parent)}
+        self.base = dict(base or {})
+        self.specs = [gate_spec(g) for g in gates]
+
+        self.gates: Dict[str, GateSpec] = {}
+        self.parents: Dict[str, Optional[str]] = {ALL_EVENTS: None}
+        self.owner: Dict[str, GateSpec] = {}
+        for name, source in self.base.items():
+            self.parents[name] = source[2] if len(source) > 2 else ALL_EVENTS
+
+        for spec in self.specs:
+            if spec.name in self.parents or spec.name in self.gates:
+                raise ValueError(f"Gate name {spec.name} is used more than once")
+            self.gates[spec.name] = spec
+            for population in spec.populations:
+                if population in self.parents:
+                    raise ValueError(f"Population {population} is defined more than once")
+                self.parents[population] = spec.parent
+                self.owner[population] = spec
+
+        for name in self.base:
+            if self.parents[name] not in self.parents:
+                raise ValueError(f"Population {name}: unknown parent population {self.parents[name]}")
+        for spec in self.specs:
+            if spec.parent not in self.parents:
+                raise ValueError(f"Gate {spec.name}: unknown parent population {spec.parent}")
+        self.populations = self._ordered()
+
+    def _ordered(self) -> List[str]:
+        # Parents before children; also rejects cycles
+        ordered, state = [], {}
+
+        def visit(population):
+            if state.get(population) == "done":
+                return
+            if state.get(population) == "visiting":
+                raise ValueError(f"Gate hierarchy has a cycle through {population}")
+            state[population] = "visiting"
+            parent = self.parents[population]
+            if parent is not None:
+                visit(parent)
+            state[population] = "done"
+            ordered.append(population)
+
+        for population in self.parents:
+            visit(population)
+        return ordered
+
+    @property
+    def channels(self) -> List[str]:
+        return sorted({c for spec in self.specs for c in spec.channels})
+
+    def bind(self, data: pd.DataFrame) -> "GateMasks":
+        return GateMasks(self, data)
+
+
+class GateMasks:
+    def __init__(self, tree: GatingTree, data: pd.DataFrame):
+        self.tree = tree
+        self.data = data
+        self.size = len(data)
+        self._packed: Dict[str, np.ndarray] = {}
+
+    @property
+    def populations(self) -> List[str]:
+        return self.tree.populations
+
+    def parent(self, population: str) -> Optional[str]:
+        return self.tree.parents[population]
+
+    def _values(self, channel: str) -> np.ndarray:
+        return self.data[channel].to_numpy()
+
+    def _own(self, population: str) -> np.ndarray:
+        if population in self.tree.base:
+            column, value = self.tree.base[population][:2]
+            return (self.data[column] == value).to_numpy(dtype=bool, na_value=False)
+
+        spec = self.tree.owner[population]
+        x = self._values(spec.xchannel)
+        if spec.kind == "threshold":
+            return x > spec.xthreshold
+        if spec.kind == "range":
+            return (x >= spec.low) & (x <= spec.high)
+        y = self._values(spec.ychannel)
+        if spec.kind == "polygon":
+            return _inside_polygon(x, y, spec.vertices)
+
+        quadrant = int(population.rsplit("_", 1)[1])
+        left, right = x < spec.xthreshold, x > spec.xthreshold
+        lower, upper = y < spec.ythreshold, y > spec.ythreshold
+        return {
+            1: left & upper,
+            2: right & upper,
+            3: left & lower,
+            4: right & lower,
+        }[quadrant]
+
+    def mask(self, population: str) -> np.ndarray:
+        if population == ALL_EVENTS:
+            return np.ones(self.size, dtype=bool)
+        if population not in self._packed:
+            own = self._own(population)
+            parent = self.tree.parents[population]
+            if parent != ALL_EVENTS:
+                own = own & self.mask(parent)
+            self._packed[population] = np.packbits(own)
+        return np.unpackbits(self._packed[population], count=self.size).view(bool)
+
+    def column(self, gate_name: str) -> pd.Series:
+        # Materialises one gate as a column for export: bool for single
+        # population gates, categorical quadrant names for quad gates
+        spec = self.tree.gates[gate_name]
+        if spec.kind != "quad":
+            return pd.Series(self.mask(gate_name), index=self.data.index, name=gate_name)
+
+        codes = np.full(self.size, -1, dtype=np.int8)
+        for i, population in enumerate(spec.populations):
+            codes[self.mask(population)] = i
+        return pd.Series(
+            pd.Categorical.from_codes(codes, categories=spec.populations),
+            index=self.data.index,
+            name=gate_name)
+
+
+def add_gate_columns(data: pd.DataFrame, masks: GateMasks):
+    # Gate membership is only materialised as columns for the exported
+    # cell matrix and for plotting
+    for name in masks.tree.gates:
+        if name in data.columns:
+            raise ValueError(f"Gate name {name} clashes with an existing column")
+        data[name] = masks.column(name)
+
+
+def gating_tree(threshold_gate=None, quad_gate=None, gates: Optional[List] = None) -> GatingTree:
+    # The single threshold and quadrant gates are roots of the tree, next to
+    # the user's gating hierarchy; all of them can use the Gaussian mixture
+    # population CellBulk_2 as a parent
+    specs = []
+    if threshold_gate:
+        specs.append(threshold_gate)
+    if quad_gate:
+        specs.append(quad_gate)
+    specs.extend(gates or [])
+    return GatingTree(specs, base = {"CellBulk_2": ("CellBulk_2", True)})
@@ -0,0 +1,128 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from wf.compensation import SPILLOVER_KEYWORDS, header_compensation
+from wf.fcs import FCSHeader, common_ranges, read_header
+
+
+# Header-only scan of every FCS input. Only the HEADER and TEXT segments are
+# parsed, so the whole run's inputs are indexed and checked in milliseconds,
+# before any events are read or models are fit. The index has one row per
+# file and channel:
+#   file, role (sample, blank or control), experiment, condition_value,
+#   version, cytometer, date, start_time, end_time, events, spillover
+#   channel, parameter (position), name ($PnS), range ($PnR),
+#   voltage ($PnV), gain ($PnG)
+
+SAMPLE = "sample"
+BLANK = "blank"
+CONTROL = "control"
+
+
+@dataclass
+class InputFile:
+    path: str
+    role: str = SAMPLE
+    experiment: Optional[str] = None
+    condition_value: Optional[str] = None
+
+
+@dataclass
+class InputIndex:
+    files: List[InputFile]
+    headers: List[FCSHeader] = field(default_factory=list)
+
+    @property
+    def samples(self) -> List[FCSHeader]:
+        return [h for f, h in zip(self.files, self.headers) if f.role == SAMPLE]
+
+    @property
+    def channels(self) -> List[str]:
+        # Channels of the first sample, which every other file is checked
+        # against
+        return list(self.samples[0].channels)
+
+    @property
+    def ranges(self) -> Dict[str, float]:
+        return common_ranges(self.samples)
+
+    def table(self) -> pd.DataFrame:
+        rows = []
+        for f, header in zip(self.files, self.headers):
+            text = header.text
+            spillover = next((k for k in SPILLOVER_KEYWORDS if text.get(k)), None)
+            for i, channel in enumerate(header.channels):
+                rows.append({
+                    "file": Path(f.path).name,
+                    "role": f.role,
+                    "experiment": f.experiment,
+                    "condition_value": f.condition_value,
+                    "version": header.version,
+                    "cytometer": text.get("$CYT"),
+                    "date": text.get("$DATE"),
+                    "start_time": text.get("$BTIM"),
+                    "end_time": text.get("$ETIM"),
+                    "events": header.event_count,
+                    "spillover": spillover,
+                    "channel": channel,
+                    "parameter": i + 1,
+                    "name": header.parameter(i, "S"),
+                    "range": header.parameter(i, "R"),
+                    "voltage": header.parameter(i, "V"),
+                    "gain": header.parameter(i, "G"),
+                })
+        return pd.DataFrame(rows)
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.table().to_csv(path, index=False)
+
+    def validate(self, required: Dict[str, List[str]], header_spillover: bool = False):
+        # Raises one ValueError listing every problem found: samples whose
+        # channels differ from the first sample's, blanks or controls missing
+        # a sample channel (cytoflow re-imports them with the experiment's
+        # channels), and channels named in required (e.g. {"gates": [...]})
+        # that are not in the samples
+        problems = []
+        channels = self.channels
+        reference = Path(self.files[0].path).name
+        for f, header in zip(self.files, self.headers):
+            name = Path(f.path).name
+            if header.event_count == 0:
+                problems.append(f"{name} has no events")
+            missing = [c for c in channels if c not in header.channels]
+            if f.role == SAMPLE:
+                extra = [c for c in header.channels if c not in channels]
+                differences = ([f"lacks {', '.join(missing)}"] if missing else []) + ([f"has extra {', '.join(extra)}"] if extra else [])
+                if differences:
+                    problems.append(f"{name} {' and '.join(differences)} compared to {reference}")
+            elif missing:
+                problems.append(f"{f.role} {name} lacks sample channels {', '.join(missing)}")
+
+        for what, names in required.items():
+            unknown = sorted({c for c in names or [] if c not in channels})
+            if unknown:
+                problems.append(f"{what}: unknown channels {', '.join(unknown)}")
+
+        if header_spillover:
+            for f, header in zip(self.files, self.headers):
+                if f.role != SAMPLE:
+                    continue
+                try:
+                    if header_compensation(header) is None:
+                        problems.append(f"{Path(f.path).name} has no spillover matrix in its header")
+                except ValueError as e:
+                    problems.append(str(e))
+
+        if problems:
+            available = ", ".join(channels)
+            raise ValueError(f"Invalid inputs: {'; '.join(problems)} (sample channels: {available})")
+
+
+def scan_headers(files: List[InputFile]) -> InputIndex:
+    if not any(f.role == SAMPLE for f in files):
+        raise ValueError("No FCS files to analyse")
+    return InputIndex(files, [read_header(f.path) for f in files])
@@ -0,0 +1,198 @@
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import time
+
+import pandas as pd
+
+
+# Per-stage run metrics: wall time, peak resident memory and bytes written to
+# the output directory, plus event counts through every gate and the sizes of
+# the output files. On Linux the peak RSS is reset at the start of every
+# stage, so it is the peak of that stage alone (stages can be nested);
+# elsewhere it is the peak of the process so far. Forked plot workers are
+# reported separately as the largest finished child process.
+
+def _status_kb(key: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    kb = _status_kb("VmHWM")
+    if kb is None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024
+
+
+def child_peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def directory_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    parent: Optional[str] = None
+    seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    child_peak_rss_mb: float = 0.0
+    bytes_written: int = 0
+    info: Dict = field(default_factory=dict)
+
+
+class RunMetrics:
+    def __init__(self, output_directory: Path):
+        self.output_directory = Path(output_directory)
+        self.stages: List[StageMetrics] = []
+        self.gates: Dict[str, Dict] = {}
+        self.outputs: Dict[str, int] = {}
+        self._open: List[StageMetrics] = []
+
+    @contextmanager
+    def stage(self, name: str, **info):
+        # info is stored with the stage, e.g. event counts; the yielded
+        # StageMetrics can be updated from inside the block
+        metrics = StageMetrics(name, parent=self._open[-1].stage if self._open else None, info=dict(info))
+        # Keep the enclosing stages' peaks before resetting for this one
+        for outer in self._open:
+            outer.peak_rss_mb = max(outer.peak_rss_mb, peak_rss_mb())
+        _reset_peak_rss()
+        self._open.append(metrics)
+        before = directory_size(self.output_directory)
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.seconds = time.perf_counter() - start
+            metrics.peak_rss_mb = max(metrics.peak_rss_mb, peak_rss_mb())
+            metrics.child_peak_rss_mb = child_peak_rss_mb()
+            metrics.bytes_written = directory_size(self.output_directory) - before
+            self._open.pop()
+            for outer in self._open:
+                outer.peak_rss_mb = max(outer.peak_rss_mb, metrics.peak_rss_mb)
+            self.stages.append(metrics)
+            print(f"{name}: {metrics.seconds:.2f} s, peak RSS {metrics.peak_rss_mb:.0f} MB, {metrics.bytes_written} bytes written")
+
+    def record_gates(self, table: pd.DataFrame):
+        # Events into (the parent population) and out of every gate, from a
+        # gate statistics table
+        counts = table.drop_duplicates("gate").set_index("gate")
+        for gate, row in counts.iterrows():
+            parent = row["parent"] or None
+            self.gates[gate] = {
+                "parent": parent,
+                "events_in": int(counts.loc[parent, "events"]) if parent else int(row["events"]),
+                "events_out": int(row["events"]),
+            }
+
+    def record_outputs(self):
+        self.outputs = {
+            str(path.relative_to(self.output_directory)): path.stat().st_size
+            for path in sorted(self.output_directory.rglob("*")) if path.is_file()
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": [asdict(s) for s in self.stages],
+            "gates": self.gates,
+            "outputs": self.outputs,
+        }
+
+    def write(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def summarize_stages(runs: Iterable[dict]) -> Dict[str, Dict]:
+    # Totals per stage name over several runs (e.g. every per-file task):
+    # summed time and bytes written, largest peak RSS
+    totals: Dict[str, Dict] = {}
+    for run in runs:
+        for stage in run["stages"]:
+            total = totals.setdefault(stage["stage"], {"runs": 0, "seconds": 0.0, "peak_rss_mb": 0.0, "bytes_written": 0})
+            total["runs"] += 1
+            total["seconds"] += stage["seconds"]
+            total["peak_rss_mb"] = max(total["peak_rss_mb"], stage["peak_rss_mb"])
+            total["bytes_written"] += stage["bytes_written"]
+    return totals
+
+
+def summarize_gates(runs: Iterable[dict]) -> Dict[str, Dict]:
+    # Events into and out of every gate, summed over several runs
+    totals: Dict[str, Dict] = {}
+    for run in runs:
+        for gate, counts in run["gates"].items():
+            total = totals.setdefault(gate, {"parent": counts["parent"], "events_in": 0, "events_out": 0})
+            total["events_in"] += counts["events_in"]
+            total["events_out"] += counts["events_out"]
+    return totals
+
+
+def summarize_batch(plate_metrics: Dict[str, dict], estimate_experiment: str) -> dict:
+    # Totals over the run_metrics.json of every plate of a batch. The shared
+    # estimate is stored with estimate_experiment and only counted once.
+    estimate = plate_metrics[estimate_experiment]["estimate"]
+    files = [run for m in plate_metrics.values() for run in m["files"].values()]
+    runs = ([estimate] if estimate else []) + files + [m["reduce"] for m in plate_metrics.values()]
+    return {
+        "experiments": list(plate_metrics),
+        "stage_totals": summarize_stages(runs),
+        "gate_totals": summarize_gates(files),
+        "estimate": estimate,
+        "experiment_stage_totals": {name: m["stage_totals"] for name, m in plate_metrics.items()},
+    }
+
+
+@contextmanager
+def profiled(path: Optional[Path]):
+    # With a path, profiles the block with cProfile and writes the raw stats
+    # to path (for snakeviz, pstats etc.) and the top functions by
+    # cumulative time to path.txt
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+        path.with_suffix(path.suffix + ".txt").write_text(summary.getvalue())
@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import json
+
+import cytoflow as flow
+import cytoflow.utility as util
+import numpy as np
+import pandas as pd
+from sklearn.mixture import GaussianMixture
+
+from wf.clustering import ClusterModel, cluster_columns
+from wf.compensation import Compensation
+
+
+# Fitted models are serialised as plain parameters (GMM weights/means/
+# covariances, autofluorescence medians, the spillover matrix, cluster
+# centroids) rather than pickled cytoflow operations, so they can be cached
+# and shared between runs.
+
+def gmm_to_dict(op: flow.GaussianMixtureOp) -> dict:
+    return {
+        "name": op.name,
+        "channels": list(op.channels),
+        "scale": dict(op.scale),
+        "num_components": op.num_components,
+        "sigma": op.sigma,
+        "gmms": [
+            {
+                "group": group,
+                "covariance_type": gmm.covariance_type,
+                "weights": gmm.weights_.tolist(),
+                "means": gmm.means_.tolist(),
+                "covariances": gmm.covariances_.tolist(),
+                "precisions_cholesky": gmm.precisions_cholesky_.tolist(),
+            }
+            for group, gmm in op._gmms.items()
+        ],
+    }
+
+
+def gmm_from_dict(d: dict) -> flow.GaussianMixtureOp:
+    op = flow.GaussianMixtureOp(name = d["name"],
+                                channels = d["channels"],
+                                scale = d["scale"],
+                                num_components = d["num_components"],
+                                sigma = d["sigma"])
+    gmms = {}
+    for g in d["gmms"]:
+        gmm = GaussianMixture(n_components = d["num_components"], covariance_type = g["covariance_type"])
+        gmm.weights_ = np.array(g["weights"])
+        gmm.means_ = np.array(g["means"])
+        gmm.covariances_ = np.array(g["covariances"])
+        gmm.precisions_cholesky_ = np.array(g["precisions_cholesky"])
+        group = tuple(g["group"]) if isinstance(g["group"], list) else g["group"]
+        gmms[group] = gmm
+    op._gmms = gmms
+    return op
+
+
+def autofluorescence_to_dict(op: flow.AutofluorescenceOp) -> dict:
+    return {
+        "channels": list(op.channels),
+        "median": dict(op._af_median),
+        "stdev": dict(op._af_stdev),
+    }
+
+
+def autofluorescence_from_dict(d: dict) -> flow.AutofluorescenceOp:
+    op = flow.AutofluorescenceOp()
+    op.channels = d["channels"]
+    op._af_median = d["median"]
+    op._af_stdev = d["stdev"]
+    return op
+
+
+def apply_gmm(op: flow.GaussianMixtureOp, ex: flow.Experiment) -> flow.Experiment:
+    if not op._scale:
+        # Scales are not serialised; rebuild them against the experiment
+        op._scale = {c: util.scale_factory(op.scale.get(c, "linear"), ex, channel = c)
+                     for c in op.channels}
+    return op.apply(ex)
+
+
+@dataclass
+class Models:
+    gmm: flow.GaussianMixtureOp
+    autofluorescence: Optional[flow.AutofluorescenceOp] = None
+    compensation: Optional[Compensation] = None
+    clustering: Optional[ClusterModel] = None
+
+    def apply(self, ex: flow.Experiment) -> flow.Experiment:
+        ex = apply_gmm(self.gmm, ex)
+        if self.autofluorescence is not None:
+            ex = self.autofluorescence.apply(ex)
+        if self.compensation is not None:
+            ex = self.compensation.apply(ex)
+        if self.clustering is not None:
+            # Conditions rather than bare columns, so cytoflow (ex.channels)
+            # keeps them apart from the channels
+            for name, values in cluster_columns(ex.data, self.clustering).items():
+                ex.add_condition(name, "int16", pd.Series(values, index=ex.data.index))
+        return ex
+
+    def to_dict(self) -> dict:
+        return {
+            "gmm": gmm_to_dict(self.gmm),
+            "autofluorescence": autofluorescence_to_dict(self.autofluorescence) if self.autofluorescence else None,
+            "compensation": self.compensation.to_dict() if self.compensation else None,
+            "clustering": self.clustering.to_dict() if self.clustering else None,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Models":
+        return cls(
+            gmm = gmm_from_dict(d["gmm"]),
+            autofluorescence = autofluorescence_from_dict(d["autofluorescence"]) if d["autofluorescence"] else None,
+            compensation = Compensation.from_dict(d["compensation"]) if d.get("compensation") else None,
+            clustering = ClusterModel.from_dict(d["clustering"]) if d.get("clustering") else None)
+
+
+def save_models(models: Models, path: Path):
+    with open(path, "w") as f:
+        json.dump(models.to_dict(), f, indent=2)
+
+
+def load_models(path: Path) -> Models:
+    with open(path) as f:
+        return Models.from_dict(json.load(f))
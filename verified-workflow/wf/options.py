@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+from typing import Optional
+
+
+# Plot options are passed to every task, so they live apart from the plot
+# renderers in wf.plots, which runs without plots never import.
+
+@dataclass
+class PlotOptions:
+    enabled: bool = True
+    dpi: int = 350
+    density: bool = True
+    bins: int = 256
+    marker_size: float = 0.5
+    marker_alpha: float = 0.7
+    processes: Optional[int] = None
@@ -0,0 +1,607 @@
+from dataclasses import asdict, replace
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import json
+
+import cytoflow as flow
+import pandas as pd
+
+from wf.bins import BinSpec, EventBins, load_bins
+from wf.cache import EstimateCache, cache_key, file_digest
+from wf.clustering import ClusterModel, add_cluster_columns, cluster_tree, embed, fit_clusters
+from wf.compensation import Compensation, bleedthrough_compensation, header_compensation
+from wf.events import EventTable
+from wf.export import EventWriter
+from wf.models import (
+    Models,
+    apply_gmm,
+    autofluorescence_from_dict,
+    autofluorescence_to_dict,
+    gmm_from_dict,
+    gmm_to_dict,
+)
+from wf.options import PlotOptions
+from wf.sampling import compare_gmm_fits, sample_tubes, stratified_sample
+from wf.fcs import read_header
+from wf.metrics import RunMetrics
+from wf.gates import ALL_EVENTS, GatingTree, add_gate_columns, gating_tree
+from wf.stats import StatisticsAccumulator, gate_counts, gate_statistics
+from wf.streaming import sample_experiment, stream_file
+from wf.transforms import ChannelTransforms, ScaledEvents
+
+
+def import_experiment(
+    files: List[Tuple[str, str]],
+    condition_name: str,
+    events: Optional[int] = None,
+) -> flow.Experiment:
+    # files is a list of (local path, condition value) pairs
+    tubes = []
+    for path, condition_val in files:
+        tubes.append(flow.Tube(file = path, conditions = {condition_name : condition_val}))
+
+    import_op = flow.ImportOp(conditions = {condition_name : 'str'}, tubes = tubes)
+    if events:
+        import_op.events = events
+    return import_op.apply()
+
+
+GMM_PARAMETERS = dict(name = "CellBulk",
+                      channels = ["FSC-A", "SSC-A"],
+                      scale = {"SSC-A" : "log"},
+                      num_components = 2,
+                      sigma = 2)
+
+
+def plotting():
+    # The plot renderers are only imported once a plot is drawn, so runs
+    # without plots never load them
+    from wf import plots
+    return plots
+
+
+def estimate_models(
+    load_experiment: Callable[[], flow.Experiment],
+    output_directory: Path,
+    blank_file: Optional[str] = None,
+    fluor_channels: Optional[List[str]] = None,
+    controls: Optional[Dict[str, str]] = None,
+    plots: PlotOptions = PlotOptions(),
+    cache: Optional[EstimateCache] = None,
+    sample_key: Optional[str] = None,
+    metrics: Optional[RunMetrics] = None,
+    clustering=None,
+    transforms: Optional[ChannelTransforms] = None,
+    spillover: Optional[Compensation] = None,
+) -> Models:
+    # load_experiment is only called if some model has to be estimated.
+    # Without controls, a spillover matrix read from the FCS header can be
+    # given instead; either way the matrix is written to
+    # compensation/spillover.csv.
+    # With a cache, each model is keyed on the contents of its input files,
+    # its parameters and the fitted parameters of the models applied before
+    # it.
+    metrics = metrics or RunMetrics(output_directory)
+    experiments = {}
+
+    def experiment() -> flow.Experiment:
+        if "ex" not in experiments:
+            experiments["ex"] = load_experiment()
+        return experiments["ex"]
+
+    def cached(kind, key, plots):
+        if cache is None or key is None:
+            return None
+        return cache.get(kind, key, plots)
+
+    def store(kind, key, params, plots):
+        if cache is not None and key is not None:
+            cache.put(kind, key, params, plots)
+
+    # Extract bulk of data
+    gmm_key = cache_key("gmm", sample_key, GMM_PARAMETERS) if sample_key else None
+    gmm_plots = {"scatterplot.png": output_directory / "scatterplot.png",
+                 "gaussian_plot.png": output_directory / "gaussian_plot.png"}
+    with metrics.stage("gmm"):
+        params = cached("gmm", gmm_key, gmm_plots)
+        if params:
+            gm_1 = gmm_from_dict(params)
+        else:
+            ex = experiment()
+
+            # Save initial scatterplot
+            if plots.enabled:
+                plot = plotting()
+                plot.render(plot.event_bins(ex, transforms), [(plot.scatter, dict(
+                    path=gmm_plots["scatterplot.png"],
+                    options=plots,
+                    xchannel="FSC-A",
+                    ychannel="SSC-A"))], plots)
+
+            gm_1 = flow.GaussianMixtureOp(**GMM_PARAMETERS)
+            gm_1.estimate(ex)
+            ex_morpho = gm_1.apply(ex)
+            experiments["morpho"] = ex_morpho
+
+            if plots.enabled:
+                plot.render(plot.event_bins(ex_morpho, transforms), [(plot.scatter, dict(
+                    path=gmm_plots["gaussian_plot.png"],
+                    options=plots,
+                    xchannel="FSC-A",
+                    ychannel="SSC-A",
+                    huefacet="CellBulk_2"))], plots)
+            store("gmm", gmm_key, gmm_to_dict(gm_1), gmm_plots)
+
+    def morpho() -> flow.Experiment:
+        if "morpho" not in experiments:
+            experiments["morpho"] = apply_gmm(gm_1, experiment())
+        return experiments["morpho"]
+
+    models = Models(gmm = gm_1)
+
+    def compensated() -> flow.Experiment:
+        if "compensated" not in experiments:
+            ex = morpho()
+            if models.autofluorescence is not None:
+                ex = models.autofluorescence.apply(ex)
+            if models.compensation is not None:
+                ex = models.compensation.apply(ex)
+            experiments["compensated"] = ex
+        return experiments["compensated"]
+
+    af_key = None
+    bl_key = None
+    if blank_file:
+        with metrics.stage("autofluorescence"):
+            print("Autofluorescence")
+            curr_output_directory = output_directory / "autofluorescence"
+            curr_output_directory.mkdir(parents=True, exist_ok=True)
+
+            af_plots = {"histograms.png": curr_output_directory / "histograms.png"}
+            # Keyed on the fitted mixture rather than on the sample it was fit
+            # on: the blank is gated with it
+            af_key = cache_key(
+                "autofluorescence",
+                file_digest(blank_file),
+                fluor_channels,
+                gmm_to_dict(gm_1)) if cache is not None else None
+            params = cached("autofluorescence", af_key, af_plots)
+            if params:
+                af_op = autofluorescence_from_dict(params)
+            else:
+                ex_morpho = morpho()
+                af_op = flow.AutofluorescenceOp()
+                af_op.blank_file = blank_file
+                af_op.channels = fluor_channels
+
+                af_op.estimate(ex_morpho, subset = "CellBulk_2 == True")
+                if plots.enabled:
+                    af_op.default_view().plot(ex_morpho)
+                    import matplotlib.pyplot as plt
+                    plt.savefig(af_plots["histograms.png"], dpi=plots.dpi, bbox_inches='tight')
+                    plt.close('all')
+                store("autofluorescence", af_key, autofluorescence_to_dict(af_op), af_plots)
+
+            models.autofluorescence = af_op
+
+    if controls:
+        with metrics.stage("bleedthrough"):
+            print("Compensation Analysis")
+            curr_output_directory = output_directory / "bleedthrough"
+            curr_output_directory.mkdir(parents=True, exist_ok=True)
+
+            bl_plots = {"compensation_matrix.png": curr_output_directory / "compensation_matrix.png"}
+            bl_key = cache_key(
+                "compensation",
+                {channel: file_digest(path) for channel, path in controls.items()},
+                autofluorescence_to_dict(models.autofluorescence) if models.autofluorescence else None,
+                gmm_to_dict(gm_1)) if cache is not None else None
+            params = cached("compensation", bl_key, bl_plots)
+            if params:
+                compensation = Compensation.from_dict(params)
+            else:
+                ex_af = morpho()
+                if models.autofluorescence is not None:
+                    ex_af = models.autofluorescence.apply(ex_af)
+
+                bl_op = flow.BleedthroughLinearOp()
+                bl_op.controls = controls
+                bl_op.estimate(ex_af, subset = "CellBulk_2 == True")
+                if plots.enabled:
+                    bl_op.default_view().plot(ex_af)
+                    import matplotlib.pyplot as plt
+                    plt.savefig(bl_plots["compensation_matrix.png"], dpi=plots.dpi, bbox_inches='tight')
+                    plt.close('all')
+                compensation = bleedthrough_compensation(list(controls), bl_op.spillover)
+                store("compensation", bl_key, compensation.to_dict(), bl_plots)
+
+            models.compensation = compensation
+    elif spillover is not None:
+        print(f"Compensating with the {len(spillover.channels)} channel spillover matrix from the FCS header")
+        bl_key = cache_key("compensation", spillover.to_dict())
+        models.compensation = spillover
+    if models.compensation is not None:
+        models.compensation.save(output_directory / "compensation" / "spillover.csv")
+
+    if clustering:
+        with metrics.stage("clustering"):
+            print("Clustering")
+            curr_output_directory = output_directory / "clustering"
+            curr_output_directory.mkdir(parents=True, exist_ok=True)
+
+            # Defaults to the compensated (or autofluorescence corrected) channels
+            channels = clustering.channels or (models.compensation.channels if models.compensation else None) or fluor_channels
+            if not channels:
+                raise ValueError("Clustering needs channels when there is no compensation or autofluorescence correction")
+            parameters = dict(
+                method = getattr(clustering.method, "value", clustering.method),
+                clusters = clustering.clusters,
+                channels = channels,
+                som_xdim = clustering.som_xdim,
+                som_ydim = clustering.som_ydim,
+                seed = clustering.seed)
+            embedding = getattr(clustering.embedding, "value", clustering.embedding)
+
+            cluster_plots = {"embedding.png": curr_output_directory / "embedding.png",
+                             "embedding.csv": curr_output_directory / "embedding.csv"}
+            transforms = transforms or ChannelTransforms()
+            cluster_key = cache_key(
+                "clustering",
+                parameters,
+                {c: asdict(transforms[c]) for c in channels},
+                embedding,
+                clustering.embedding_events,
+                bl_key,
+                af_key,
+                gmm_key) if gmm_key else None
+            params = cached("clustering", cluster_key, cluster_plots)
+            if params:
+                cluster_model = ClusterModel.from_dict(params)
+            else:
+                ex_bl = compensated()
+                cluster_model = fit_clusters(ex_bl.data, transforms=transforms, **parameters)
+                if embedding != "none":
+                    data = ex_bl.data.copy()
+                    add_cluster_columns(data, cluster_model)
+                    points = embed(cluster_model, data, embedding, clustering.embedding_events, clustering.seed)
+                    points.to_csv(cluster_plots["embedding.csv"], index=False)
+                    if plots.enabled:
+                        plot = plotting()
+                        plot.render(EventBins(transforms), [(plot.embedding, dict(
+                            path=cluster_plots["embedding.png"],
+                            options=plots,
+                            points=points))], plots)
+                store("clustering", cluster_key, cluster_model.to_dict(), cluster_plots)
+
+            models.clustering = cluster_model
+
+    return models
+
+
+def estimation_report(
+    gmm: flow.GaussianMixtureOp,
+    files: List[Tuple[str, str]],
+    condition_name: str,
+    budget: int,
+    seed: int,
+    path: Path,
+):
+    # Refit the Gaussian mixture on every event and compare it to the
+    # subsample fit on a holdout sample disjoint from the estimation sample
+    print("Fitting the Gaussian mixture on all events for the estimation report")
+    full = stratified_sample(files, condition_name, None)
+    full_gmm = flow.GaussianMixtureOp(**GMM_PARAMETERS)
+    full_gmm.estimate(full)
+
+    # The holdout is drawn from the events the estimation sample left out
+    estimation = [positions for _, positions in sample_tubes(files, budget, seed)]
+    holdout = stratified_sample(files, condition_name, budget, seed + 1, exclude=estimation)
+    report = {
+        "sample_events": budget,
+        "full_events": int(len(full.data)),
+        "seed": seed,
+        **compare_gmm_fits(gmm, full_gmm, holdout, "CellBulk_2"),
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    if "holdout_gate_agreement" in report:
+        print(f"Holdout gate agreement between subsample and full fit: {report['holdout_gate_agreement']:.4f}")
+    else:
+        print("No events are left out of the estimation sample for a holdout")
+
+
+def quadrant_names(gate_name: str) -> List[str]:
+    return [f"{gate_name}_{i}" for i in range(1, 5)]
+
+
+def quadrant_statistics(gate_name: str, counts: pd.Series) -> pd.DataFrame:
+    # Index by quadrant name so that empty quadrants are kept as zero counts
+    names = quadrant_names(gate_name)
+    return pd.DataFrame(
+        {'quadrant': ["Q1", "Q2", "Q3", "Q4"],
+        'quadrant_name': names,
+        'cells': counts.reindex(names, fill_value=0).values
+        })
+
+
+def plot_bin_spec(tree: GatingTree, channels: List[str], quad_gate=None) -> BinSpec:
+    # Counts the file plots are drawn from: histograms of all events and of
+    # every population a gate is drawn on, densities of the quadrant gate and
+    # of the 2D gates
+    groups = [ALL_EVENTS]
+    densities = []
+    if quad_gate:
+        densities.append((ALL_EVENTS, quad_gate.xchannel, quad_gate.ychannel))
+    for spec in tree.gates.values():
+        if spec.parent not in groups:
+            groups.append(spec.parent)
+        if spec.kind in ("quad", "polygon"):
+            densities.append((spec.parent, spec.xchannel, spec.ychannel))
+    return BinSpec(groups, list(channels), list(dict.fromkeys(densities)))
+
+
+def file_plot_jobs(
+    channels: List[str],
+    output_directory: Path,
+    plots: PlotOptions,
+    condition_name: str,
+    threshold_gate=None,
+    quad_gate=None,
+    quadrant_data: Optional[pd.DataFrame] = None,
+    tree: Optional[GatingTree] = None,
+    gates: Optional[List] = None,
+    table: Optional[pd.DataFrame] = None,
+) -> List:
+    plot = plotting()
+    jobs = []
+    for channel in channels:
+        jobs.append((plot.histogram, dict(
+            path=output_directory / "histograms" / f"{channel}.png",
+            options=plots,
+            channel=channel)))
+    if threshold_gate:
+        jobs.append((plot.threshold, dict(
+            path=output_directory / "threshold_gate" / "threshold_plot.png",
+            options=plots,
+            name=threshold_gate.gate_name,
+            channel=threshold_gate.channel,
+            threshold=threshold_gate.threshold)))
+    if quad_gate:
+        jobs.append((plot.quad, dict(
+            path=output_directory / "quadrant_gate" / "scatterplot.png",
+            options=plots,
+            name=quad_gate.gate_name,
+            xchannel=quad_gate.xchannel,
+            xthreshold=quad_gate.xthreshold,
+            ychannel=quad_gate.ychannel,
+            ythreshold=quad_gate.ythreshold,
+            huefacet=condition_name,
+            quadrant_data=quadrant_data)))
+    if gates:
+        counts = gate_counts(table)
+        percents = table.drop_duplicates("gate").set_index("gate")["percent_of_parent"]
+        for gate in gates:
+            spec = tree.gates[gate.gate_name]
+            jobs.append((plot.gate, dict(
+                path=output_directory / "gates" / f"{spec.name}.png",
+                options=plots,
+                tree=tree,
+                name=spec.name,
+                percents=percents,
+                quadrant_data=quadrant_statistics(spec.name, counts) if spec.kind == "quad" else None)))
+    return jobs
+
+
+def process_file(
+    path: Path,
+    condition_name: str,
+    condition_val: str,
+    models: Models,
+    output_directory: Path,
+    threshold_gate=None,
+    quad_gate=None,
+    plots: PlotOptions = PlotOptions(),
+    chunk_events: Optional[int] = None,
+    output_csv: bool = False,
+    gates: Optional[List] = None,
+    metrics: Optional[RunMetrics] = None,
+    transforms: Optional[List] = None,
+    checkpoints: Optional[EstimateCache] = None,
+    ranges: Optional[Dict[str, float]] = None,
+):
+    # Apply the fitted models and the gating tree to every event of one FCS
+    # file and write its plots, gate statistics and cell matrix. With
+    # checkpoints, the outputs of each stage are stored under a fingerprint
+    # of its inputs and parameters, and a stage whose fingerprint is
+    # unchanged is restored instead of run:
+    #   events: the events with models applied (file contents, models)
+    #   tables: statistics, cell matrix and plot bins (events, gates,
+    #           transforms)
+    #   plots:  the plot images (tables, plot options)
+    # Both the events and the tables checkpoints reference the cell matrix
+    # rather than storing a copy: it holds every event with the models
+    # applied, next to the gate columns.
+    metrics = metrics or RunMetrics(output_directory)
+    header = read_header(path)
+    if models.compensation is not None and models.compensation.source == "header":
+        # Every file is compensated with the matrix its instrument recorded
+        compensation = header_compensation(header)
+        if compensation is None:
+            raise ValueError(f"{Path(path).name} has no spillover matrix in its header")
+        models = replace(models, compensation=compensation)
+    # Channels are scaled on the run's ranges (see estimate_task), so every
+    # file is plotted on the same axes
+    channel_transforms = ChannelTransforms(transforms, {**header.ranges, **(ranges or {})})
+    tree = gating_tree(threshold_gate, quad_gate, gates)
+    clusters = cluster_tree(models.clustering) if models.clustering else None
+
+    keys = {}
+    if checkpoints is not None:
+        keys["events"] = cache_key("events", file_digest(path), models.to_dict())
+        keys["tables"] = cache_key(
+            "tables",
+            keys["events"],
+            Path(path).stem,
+            condition_name,
+            condition_val,
+            threshold_gate,
+            quad_gate,
+            gates,
+            output_csv,
+            plots.enabled,
+            {c: asdict(channel_transforms[c]) for c in header.channels},
+            # The bin grids, which also depend on the run's ranges
+            {c: channel_transforms.domain(c) for c in header.channels})
+        keys["plots"] = cache_key(
+            "plots",
+            keys["tables"],
+            {k: v for k, v in asdict(plots).items() if k != "processes"},
+            None if plots.density else chunk_events)
+
+    cell_matrix = {"cell_matrix.parquet": output_directory / "cell_matrix.parquet"}
+
+    def cached(kind, outputs, references=None):
+        if checkpoints is None:
+            return None
+        return checkpoints.get(kind, keys[kind], outputs, references=references)
+
+    def store(kind, params, outputs, references=None):
+        if checkpoints is not None:
+            checkpoints.put(kind, keys[kind], params, outputs, references)
+
+    names = ["statistics.csv"]
+    if clusters:
+        names.append("cluster_statistics.csv")
+    if quad_gate:
+        names.append("quadrant_gate/quadrant_statistics.csv")
+    if output_csv:
+        names.append("cell_matrix.csv")
+    if plots.enabled:
+        names.append("histograms.npz")
+    table_outputs = {name: output_directory / name for name in names}
+
+    events = None
+    if cached("tables", table_outputs, cell_matrix) is not None:
+        table = pd.read_csv(output_directory / "statistics.csv", dtype={condition_name: str})
+        table["parent"] = table["parent"].fillna("")
+        bins = load_bins(output_directory / "histograms.npz") if plots.enabled else None
+        # Carry the events checkpoint over to this run's checkpoints, so the
+        # next run can still start from it
+        cached("events", None, cell_matrix)
+    else:
+        # The events with models applied, from the cell matrix they were
+        # checkpointed with or the FCS file. The previous cell matrix is
+        # moved aside, since this run writes a new one.
+        stored = None
+        restored = cached("events", None, cell_matrix)
+        if restored is not None:
+            stored = output_directory / "events.parquet"
+            cell_matrix["cell_matrix.parquet"].replace(stored)
+
+        with EventWriter(output_directory, condition_name, output_csv) as writer:
+            if not chunk_events:
+                if stored:
+                    with metrics.stage("import") as stage:
+                        data = pd.read_parquet(stored, columns=[c for c in restored["columns"] if c != condition_name])
+                        data[condition_name] = condition_val
+                        events = EventTable.from_frame(data[restored["columns"]], restored["channels"])
+                        stage.info["events"] = len(events)
+                else:
+                    with metrics.stage("import") as stage:
+                        ex = import_experiment([(str(path), condition_val)], condition_name)
+                        stage.info["events"] = len(ex.data)
+                    with metrics.stage("apply_models") as stage:
+                        # Only the compact table is kept once the models are applied
+                        ex = models.apply(ex)
+                        events = EventTable.from_frame(ex.data, ex.channels)
+                        ex = None
+                        stage.info["event_bytes"] = events.nbytes
+                columns = events.columns
+                channels = events.channels
+                with metrics.stage("gates"):
+                    masks = tree.bind(events)
+                    table = gate_statistics(masks, events.channels)
+                    add_gate_columns(events, masks)
+                if plots.enabled:
+                    with metrics.stage("binning"):
+                        scaled = ScaledEvents(events, channel_transforms)
+                        scaled.precompute(events.channels)
+                        bins = EventBins(channel_transforms, scaled, masks)
+                        spec = plot_bin_spec(tree, events.channels, quad_gate)
+                        bins.compute(spec.groups, spec.channels, spec.densities)
+                if clusters:
+                    with metrics.stage("cluster_statistics"):
+                        cluster_table = gate_statistics(clusters.bind(events), events.channels)
+                with metrics.stage("export"):
+                    writer.write(events.to_frame())
+            else:
+                # Streaming: statistics, binned plot counts and the cell matrix
+                # cover every event; marker scatterplots are drawn from a random
+                # sample of chunk_events events
+                print(f"Streaming {path} in chunks of {chunk_events} events")
+                with metrics.stage("stream", chunk_events=chunk_events) as stage:
+                    channels = header.channels
+                    statistics = StatisticsAccumulator(tree, channels)
+                    cluster_statistics = StatisticsAccumulator(clusters, channels) if clusters else None
+                    bins = EventBins(channel_transforms) if plots.enabled else None
+                    columns = stream_file(path, condition_name, condition_val, models, tree, writer, statistics,
+                                          chunk_events, cluster_statistics, bins,
+                                          plot_bin_spec(tree, channels, quad_gate),
+                                          stored, restored["columns"] if stored else None)
+                    table = statistics.table()
+                    if clusters:
+                        cluster_table = cluster_statistics.table()
+                    stage.info["events"] = int(table["events"].iloc[0])
+
+        table.insert(0, "file", Path(path).stem)
+        table.insert(1, condition_name, condition_val)
+        table.to_csv(output_directory / "statistics.csv", index=False)
+
+        if clusters:
+            cluster_table.insert(0, "file", Path(path).stem)
+            cluster_table.insert(1, condition_name, condition_val)
+            cluster_table.to_csv(output_directory / "cluster_statistics.csv", index=False)
+
+        if quad_gate:
+            curr_output_directory = output_directory / "quadrant_gate"
+            curr_output_directory.mkdir(parents=True, exist_ok=True)
+            quadrant_statistics(quad_gate.gate_name, gate_counts(table)).to_csv(
+                curr_output_directory / "quadrant_statistics.csv", index=False)
+
+        if plots.enabled:
+            bins.save(output_directory / "histograms.npz")
+        if stored:
+            stored.unlink()
+        if checkpoints is not None:
+            with metrics.stage("checkpoint"):
+                store("events", {"channels": channels, "columns": columns}, None, cell_matrix)
+                store("tables", {}, table_outputs, cell_matrix)
+
+    metrics.record_gates(table)
+    counts = gate_counts(table)
+
+    quadrant_data = None
+    if threshold_gate:
+        print("Threshold Gate:")
+        print(counts[[ALL_EVENTS, threshold_gate.gate_name]])
+    if quad_gate:
+        print("Quadrant Gate")
+        quadrant_data = quadrant_statistics(quad_gate.gate_name, counts)
+
+    if not plots.enabled:
+        return
+
+    with metrics.stage("plots") as stage:
+        jobs = file_plot_jobs(header.channels, output_directory, plots, condition_name, threshold_gate, quad_gate,
+                              quadrant_data, tree, gates, table)
+        plot_outputs = {str(job[1]["path"].relative_to(output_directory)): job[1]["path"] for job in jobs}
+        if cached("plots", plot_outputs) is None:
+            if events is None and not plots.density:
+                sample = models.apply(sample_experiment(
+                    [(str(path), condition_val)], condition_name, chunk_events or header.event_count))
+                bins.events = ScaledEvents(sample.data, channel_transforms)
+
+            print("Making Plots")
+            plotting().render(bins, jobs, plots)
+            store("plots", {}, plot_outputs)
+        stage.info["plots"] = len(jobs)
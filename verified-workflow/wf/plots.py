@@ -0,0 +1,324 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import multiprocessing
+import os
+
+import cytoflow as flow
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+from matplotlib.patches import Patch
+import numpy as np
+import pandas as pd
+
+from wf.bins import EventBins
+from wf.clustering import CLUSTER_COLUMN
+from wf.gates import ALL_EVENTS
+from wf.options import PlotOptions
+from wf.transforms import ChannelTransforms, ScaledEvents
+
+
+# Headless plot rendering. Each figure is a job (function, kwargs) that is
+# rendered with the Agg backend in a forked worker process, so the event data
+# is shared with the workers instead of being pickled to them. Histograms and
+# scatterplots are drawn from pre-binned counts (see wf.bins) on the
+# transformed scale, cropped to the occupied bins and merged down to at most
+# `bins` bins per axis, with ticks in channel units. Scatterplots are drawn as
+# density images; only marker scatterplots read the events themselves.
+
+def setup(options: PlotOptions):
+    matplotlib.use("Agg")
+    matplotlib.rc('figure', dpi = options.dpi)
+
+
+def experiment_ranges(ex: flow.Experiment) -> Dict[str, float]:
+    return {c: ex.metadata[c].get("range") for c in ex.channels}
+
+
+def event_bins(ex: flow.Experiment, transforms: Optional[ChannelTransforms] = None, populations=None) -> EventBins:
+    # Bins for plotting an experiment; counts are binned as the plots ask
+    # for them unless computed beforehand
+    events = ScaledEvents(ex.data, transforms or ChannelTransforms(ranges=experiment_ranges(ex)))
+    events.precompute(ex.channels)
+    return EventBins(events.transforms, events, populations)
+
+
+_shared = {}
+
+
+def _run(job: Tuple[Callable, Dict]):
+    function, kwargs = job
+    function(_shared["bins"], **kwargs)
+    plt.close('all')
+
+
+def render(bins: EventBins, jobs: List[Tuple[Callable, Dict]], options: PlotOptions):
+    if not options.enabled or not jobs:
+        return
+
+    processes = min(len(jobs), options.processes or os.cpu_count() or 1)
+    _shared["bins"] = bins
+    try:
+        if processes <= 1:
+            for job in jobs:
+                _run(job)
+        else:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                pool.map(_run, jobs)
+    finally:
+        _shared.clear()
+
+
+def _save(path: Path, options: PlotOptions):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    plt.savefig(path, dpi=options.dpi, bbox_inches='tight')
+
+
+def _extent(counts: np.ndarray, axis: int) -> Tuple[int, int]:
+    # First and past-the-last occupied bin along axis
+    occupied = np.flatnonzero(counts.sum(axis=tuple(a for a in range(counts.ndim) if a != axis)))
+    if len(occupied) == 0:
+        return 0, counts.shape[axis]
+    return int(occupied[0]), int(occupied[-1]) + 1
+
+
+def _coarsen(counts: np.ndarray, edges: np.ndarray, start: int, stop: int, bins: int, axis: int = 0):
+    # Counts of bins start..stop merged by a whole factor into at most
+    # `bins` bins, padding the last one with empty bins
+    factor = max(1, -(-(stop - start) // bins))
+    size = -(-(stop - start) // factor)
+    selected = np.take(counts, np.arange(start, stop), axis=axis)
+    padding = [(0, 0)] * counts.ndim
+    padding[axis] = (0, size * factor - (stop - start))
+    selected = np.pad(selected, padding)
+    shape = list(selected.shape)
+    shape[axis:axis + 1] = [size, factor]
+    step = edges[1] - edges[0]
+    return selected.reshape(shape).sum(axis=axis + 1), edges[0] + step * (start + factor * np.arange(size + 1))
+
+
+def _axis(ax, bins: EventBins, channel: str, axis: str):
+    # Axis label and ticks in channel units for a transformed channel
+    transform = bins.transforms[channel]
+    label = channel if transform.kind == "linear" else f"{channel} ({transform.label})"
+    low, high = ax.get_xlim() if axis == "x" else ax.get_ylim()
+    positions, labels = transform.ticks(low, high)
+    if axis == "x":
+        ax.set_xlabel(label)
+        if positions:
+            ax.set_xticks(positions, labels)
+    else:
+        ax.set_ylabel(label)
+        if positions:
+            ax.set_yticks(positions, labels)
+
+
+def _position(bins: EventBins, channel: str, value: float) -> float:
+    # Where a value in channel units (e.g. a gate threshold) is drawn
+    return float(bins.transforms[channel].apply(np.array([value]))[0])
+
+
+_hue_cmaps = ["Greys", "Reds", "Blues", "Greens", "Purples", "Oranges"]
+
+
+def _hues(events: ScaledEvents, huefacet: str) -> List[object]:
+    return list(pd.unique(events.data[huefacet].dropna()))
+
+
+def density(
+    bins: EventBins,
+    xchannel: str,
+    ychannel: str,
+    options: PlotOptions,
+    huefacet: Optional[str] = None,
+    group: str = ALL_EVENTS,
+):
+    # Binned counts of a population drawn as an image; each hue value gets
+    # its own colormap layer
+    if huefacet is None:
+        layers = [(None, group)]
+    else:
+        layers = [(value, f"{huefacet}={value}") for value in _hues(bins.events, huefacet)]
+    densities = [bins.density(name, xchannel, ychannel) for _, name in layers]
+    total = sum(counts for counts, _, _ in densities)
+    xstart, xstop = _extent(total, 0)
+    ystart, ystop = _extent(total, 1)
+
+    fig, ax = plt.subplots()
+    handles = []
+    for i, ((value, _), (counts, xedges, yedges)) in enumerate(zip(layers, densities)):
+        counts, xedges = _coarsen(counts, xedges, xstart, xstop, options.bins, axis=0)
+        counts, yedges = _coarsen(counts, yedges, ystart, ystop, options.bins, axis=1)
+        counts = np.ma.masked_equal(counts, 0)
+        cmap = "viridis" if huefacet is None else _hue_cmaps[i % len(_hue_cmaps)]
+        ax.pcolormesh(xedges, yedges, counts.T,
+                      cmap=cmap,
+                      norm=LogNorm(),
+                      alpha=1.0 if huefacet is None else options.marker_alpha,
+                      rasterized=True)
+        if huefacet is not None:
+            handles.append(Patch(color=plt.get_cmap(cmap)(0.7), label=str(value)))
+
+    _axis(ax, bins, xchannel, "x")
+    _axis(ax, bins, ychannel, "y")
+    if handles:
+        ax.legend(handles=handles, title=huefacet, bbox_to_anchor=(1.05, 1), loc="upper left", fontsize=10)
+    return ax
+
+
+def points(
+    bins: EventBins,
+    xchannel: str,
+    ychannel: str,
+    options: PlotOptions,
+    huefacet: Optional[str] = None,
+):
+    # One marker per event, coloured by hue value
+    events = bins.events
+    x, y = events.scaled(xchannel), events.scaled(ychannel)
+    if huefacet is None:
+        groups = [(None, np.ones(len(events), dtype=bool))]
+    else:
+        groups = [(value, (events.data[huefacet] == value).to_numpy()) for value in _hues(events, huefacet)]
+    fig, ax = plt.subplots()
+    for value, mask in groups:
+        ax.scatter(x[mask], y[mask], s=options.marker_size, alpha=options.marker_alpha, marker=".",
+                   label=None if value is None else str(value), rasterized=True)
+
+    _axis(ax, bins, xchannel, "x")
+    _axis(ax, bins, ychannel, "y")
+    if huefacet is not None:
+        ax.legend(title=huefacet, bbox_to_anchor=(1.05, 1), loc="upper left", markerscale=20, fontsize=10)
+    return ax
+
+
+def scatter(
+    bins: EventBins,
+    path: Path,
+    options: PlotOptions,
+    xchannel: str,
+    ychannel: str,
+    huefacet: Optional[str] = None,
+):
+    (density if options.density else points)(bins, xchannel, ychannel, options, huefacet)
+    _save(path, options)
+
+
+def _histogram(bins: EventBins, channel: str, options: PlotOptions, group: str = ALL_EVENTS):
+    counts, edges = bins.histogram(group, channel)
+    start, stop = _extent(counts, 0)
+    counts, edges = _coarsen(counts, edges, start, stop, options.bins)
+    fig, ax = plt.subplots()
+    ax.hist(edges[:-1], bins=edges, weights=counts, histtype="stepfilled", alpha=0.7)
+    _axis(ax, bins, channel, "x")
+    ax.set_ylabel("events")
+    return ax
+
+
+def histogram(bins: EventBins, path: Path, options: PlotOptions, channel: str):
+    _histogram(bins, channel, options)
+    _save(path, options)
+
+
+def threshold(bins: EventBins, path: Path, options: PlotOptions, name: str, channel: str, threshold: float):
+    ax = _histogram(bins, channel, options)
+    ax.axvline(_position(bins, channel, threshold), color='black', linewidth=1)
+    ax.set_title(name)
+    _save(path, options)
+
+
+def quad(
+    bins: EventBins,
+    path: Path,
+    options: PlotOptions,
+    name: str,
+    xchannel: str,
+    xthreshold: float,
+    ychannel: str,
+    ythreshold: float,
+    huefacet: str,
+    quadrant_data: pd.DataFrame,
+):
+    if options.density:
+        ax = density(bins, xchannel, ychannel, options)
+    else:
+        ax = points(bins, xchannel, ychannel, options, huefacet)
+    ax.axvline(_position(bins, xchannel, xthreshold), color='black', linewidth=1)
+    ax.axhline(_position(bins, ychannel, ythreshold), color='black', linewidth=1)
+
+    label_quadrants(quadrant_data)
+    _save(path, options)
+
+
+def label_quadrants(quadrant_data: pd.DataFrame):
+    sum_q = quadrant_data['cells'].sum()
+
+    positions = {
+        "Q1": (0.05, 0.95, 'left', 'top'),
+        "Q2": (0.95, 0.95, 'right', 'top'),
+        "Q3": (0.05, 0.05, 'left', 'bottom'),
+        "Q4": (0.95, 0.05, 'right', 'bottom'),
+    }
+    for quadrant, cells in zip(quadrant_data['quadrant'], quadrant_data['cells']):
+        x, y, ha, va = positions[quadrant]
+        percent = round((cells/sum_q)*100,2) if sum_q else 0.0
+        plt.text(x, y, f'{quadrant}: {percent}%',
+            horizontalalignment=ha,
+            verticalalignment=va, color='red',transform=plt.gca().transAxes)
+
+
+def gate(
+    bins: EventBins,
+    path: Path,
+    options: PlotOptions,
+    tree,
+    name: str,
+    percents: pd.Series,
+    quadrant_data: pd.DataFrame,
+):
+    # One gate of a gating tree, drawn on the events of its parent population
+    spec = tree.gates[name]
+
+    if spec.kind in ("threshold", "range"):
+        ax = _histogram(bins, spec.xchannel, options, spec.parent)
+        limits = [spec.xthreshold] if spec.kind == "threshold" else [spec.low, spec.high]
+        for limit in limits:
+            ax.axvline(_position(bins, spec.xchannel, limit), color='black', linewidth=1)
+        ax.text(0.95, 0.95, f'{name}: {round(percents.get(name, 0.0), 2)}%',
+            horizontalalignment='right',
+            verticalalignment='top', color='red', transform=ax.transAxes)
+    else:
+        ax = density(bins, spec.xchannel, spec.ychannel, options, group=spec.parent)
+        if spec.kind == "quad":
+            ax.axvline(_position(bins, spec.xchannel, spec.xthreshold), color='black', linewidth=1)
+            ax.axhline(_position(bins, spec.ychannel, spec.ythreshold), color='black', linewidth=1)
+            label_quadrants(quadrant_data)
+        else:
+            # Edges are straight in channel units, so they are drawn through
+            # points along each edge
+            closed = np.vstack([spec.vertices, spec.vertices[:1]])
+            steps = np.linspace(0, 1, 50)[:-1, None]
+            outline = np.vstack([a + steps * (b - a) for a, b in zip(closed[:-1], closed[1:])])
+            ax.fill(bins.transforms[spec.xchannel].apply(outline[:, 0]),
+                    bins.transforms[spec.ychannel].apply(outline[:, 1]),
+                    fill=False, edgecolor='black', linewidth=1)
+            ax.text(0.95, 0.95, f'{name}: {round(percents.get(name, 0.0), 2)}%',
+                horizontalalignment='right',
+                verticalalignment='top', color='red', transform=ax.transAxes)
+
+    ax.set_title(f"{name} (of {spec.parent})")
+    _save(path, options)
+
+
+def embedding(bins: EventBins, path: Path, options: PlotOptions, points: pd.DataFrame):
+    # Embedded events (see wf.clustering.embed) coloured by cluster
+    fig, ax = plt.subplots()
+    palette = plt.get_cmap("tab20")
+    for i, (cluster, group) in enumerate(points.groupby(CLUSTER_COLUMN)):
+        ax.scatter(group["Embedding_1"], group["Embedding_2"],
+                   s=options.marker_size, alpha=options.marker_alpha, marker=".",
+                   color=palette(i % palette.N), label=f"{CLUSTER_COLUMN}_{cluster}", rasterized=True)
+    ax.set_xlabel("Embedding 1")
+    ax.set_ylabel("Embedding 2")
+    ax.legend(bbox_to_anchor=(1.05, 1), loc="upper left", markerscale=20, fontsize=10)
+    _save(path, options)
@@ -0,0 +1,167 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import cytoflow as flow
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from wf.fcs import iter_chunks, read_header
+from wf.models import apply_gmm
+from wf.streaming import experiment_from_events
+
+
+# Event subsampling for model estimation. Every tube is read once, chunk by
+# chunk, into a fixed-size reservoir, so the sample is uniform within each
+# tube, reproducible for a given seed and never needs the whole tube in
+# memory.
+
+def reservoir_sample(
+    chunks: Iterable[pd.DataFrame],
+    k: int,
+    rng: np.random.Generator,
+    exclude: Optional[np.ndarray] = None,
+) -> Tuple[pd.DataFrame, np.ndarray]:
+    # Vectorised Algorithm R: the t-th event (1-based) replaces a random
+    # reservoir slot with probability k/t. Also returns the position in the
+    # tube of every sampled event; events at the positions in exclude are
+    # skipped.
+    reservoir = None
+    columns = None
+    positions = np.empty(k, dtype=np.int64)
+    seen = 0
+    offset = 0
+    for chunk in chunks:
+        values = chunk.to_numpy()
+        index = offset + np.arange(len(values))
+        offset += len(values)
+        if exclude is not None and len(exclude):
+            keep = ~np.isin(index, exclude)
+            values, index = values[keep], index[keep]
+        if reservoir is None:
+            columns = chunk.columns
+            reservoir = np.empty((k, values.shape[1]), dtype=values.dtype)
+
+        fill = max(0, min(k - seen, len(values)))
+        reservoir[seen:seen + fill] = values[:fill]
+        positions[seen:seen + fill] = index[:fill]
+
+        rest = values[fill:]
+        t = seen + fill + np.arange(1, len(rest) + 1)
+        slots = (rng.random(len(rest)) * t).astype(np.int64)
+        keep = slots < k
+        reservoir[slots[keep]] = rest[keep]
+        positions[slots[keep]] = index[fill:][keep]
+
+        seen += len(values)
+
+    if reservoir is None:
+        return pd.DataFrame(), positions[:0]
+    n = min(seen, k)
+    return pd.DataFrame(reservoir[:n], columns=columns), positions[:n]
+
+
+def allocate(budget: int, tubes: int) -> List[int]:
+    # Split the event budget evenly so that every tube is represented
+    share, remainder = divmod(budget, tubes)
+    return [share + (1 if i < remainder else 0) for i in range(tubes)]
+
+
+def sample_tubes(
+    files: List[Tuple[str, str]],
+    budget: Optional[int],
+    seed: int = 0,
+    chunk_events: int = 100000,
+    exclude: Optional[List[np.ndarray]] = None,
+) -> List[Tuple[pd.DataFrame, np.ndarray]]:
+    # The sampled events of every tube and their positions in the tube. A
+    # budget of None keeps every event; exclude has the positions to leave
+    # out of each tube, e.g. those of another sample.
+    rng = np.random.default_rng(seed)
+    sizes = allocate(budget, len(files)) if budget else [None] * len(files)
+
+    tubes = []
+    for i, ((path, _), k) in enumerate(zip(files, sizes)):
+        chunks = iter_chunks(path, chunk_events)
+        if k is None:
+            data = pd.concat(chunks, ignore_index=True)
+            tubes.append((data, np.arange(len(data))))
+        else:
+            tubes.append(reservoir_sample(chunks, k, rng, exclude[i] if exclude else None))
+    return tubes
+
+
+def stratified_sample(
+    files: List[Tuple[str, str]],
+    condition_name: str,
+    budget: Optional[int],
+    seed: int = 0,
+    chunk_events: int = 100000,
+    exclude: Optional[List[np.ndarray]] = None,
+) -> flow.Experiment:
+    # Reservoir-samples budget events in total from the (path, condition
+    # value) pairs. A budget of None keeps every event.
+    tubes = sample_tubes(files, budget, seed, chunk_events, exclude)
+    return experiment_from_events(
+        [(data, condition_val) for (data, _), (_, condition_val) in zip(tubes, files)],
+        condition_name,
+        read_header(files[0][0]))
+
+
+def _gmm(op: flow.GaussianMixtureOp):
+    return next(iter(op._gmms.values()))
+
+
+def _scaled(op: flow.GaussianMixtureOp, ex: flow.Experiment) -> np.ndarray:
+    # Log scales mask non-positive values; those events are left out
+    x = np.column_stack([np.ma.filled(np.ma.asarray(op._scale[c](ex.data[c]), dtype=float), np.nan)
+                         for c in op.channels])
+    return x[np.all(np.isfinite(x), axis=1)]
+
+
+def compare_gmm_fits(
+    sample_op: flow.GaussianMixtureOp,
+    full_op: flow.GaussianMixtureOp,
+    holdout: flow.Experiment,
+    gate: str,
+) -> Dict:
+    # Parameter differences between the subsample and the full-data fit, and
+    # how differently the two models score and gate a held-out sample
+    sample_gmm, full_gmm = _gmm(sample_op), _gmm(full_op)
+
+    # Components are matched by the distance between their means
+    cost = np.linalg.norm(sample_gmm.means_[:, None, :] - full_gmm.means_[None, :, :], axis=2)
+    rows, cols = linear_sum_assignment(cost)
+
+    report = {
+        "channels": list(sample_op.channels),
+        "components": [
+            {
+                "sample_mean": sample_gmm.means_[i].tolist(),
+                "full_mean": full_gmm.means_[j].tolist(),
+                "mean_difference": float(np.linalg.norm(sample_gmm.means_[i] - full_gmm.means_[j])),
+                "weight_difference": float(abs(sample_gmm.weights_[i] - full_gmm.weights_[j])),
+            }
+            for i, j in zip(rows, cols)
+        ],
+        "holdout_events": int(len(holdout.data)),
+    }
+    if len(holdout.data) == 0:
+        # The estimation sample took every event
+        return report
+
+    sample_gate = apply_gmm(sample_op, holdout).data[gate]
+    full_gate = apply_gmm(full_op, holdout).data[gate]
+    x = _scaled(sample_op, holdout)
+
+    return {
+        **report,
+        "holdout_log_likelihood": {
+            "sample_fit": float(sample_gmm.score(x)),
+            "full_fit": float(full_gmm.score(x)),
+        },
+        "holdout_gate_fraction": {
+            "sample_fit": float(sample_gate.mean()),
+            "full_fit": float(full_gate.mean()),
+        },
+        "holdout_gate_agreement": float((sample_gate == full_gate).mean()),
+    }
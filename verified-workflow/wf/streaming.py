@@ -0,0 +1,101 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import cytoflow as flow
+import pandas as pd
+
+from wf.bins import BinSpec, EventBins
+from wf.events import EventTable
+from wf.export import EventWriter, read_event_store
+from wf.fcs import FCSHeader, iter_chunks, read_header, sample_events
+from wf.gates import GatingTree, add_gate_columns
+from wf.stats import StatisticsAccumulator
+
+
+def experiment_from_events(
+    tubes: List[Tuple[pd.DataFrame, str]],
+    condition_name: str,
+    header: FCSHeader,
+) -> flow.Experiment:
+    # Equivalent of ImportOp for (events, condition value) pairs that were
+    # already read into memory, with the metadata ImportOp reads from the
+    # first tube's header. AutofluorescenceOp and BleedthroughLinearOp check
+    # their blank and control files against it ($PnN names, $PnV voltages)
+    # before importing them.
+    ex = flow.Experiment()
+    ex.metadata["ignore_v"] = []
+    ex.metadata["name_metadata"] = "$PnN"
+    ex.add_condition(condition_name, "category")
+    ex.metadata[condition_name]["experiment"] = True
+    ranges = header.ranges
+    # As ImportOp, voltages are only kept if the first parameter has one: the
+    # FCS parser it uses only reads the $Pn keywords that $P1 has
+    voltages = header.parameter(0, "V") is not None
+    for channel in tubes[0][0].columns:
+        ex.add_channel(channel)
+        ex.metadata[channel]["fcs_name"] = channel
+        voltage = header.parameter(header.channels.index(channel), "V") if voltages else None
+        if voltage:
+            ex.metadata[channel]["voltage"] = voltage
+        ex.metadata[channel]["range"] = ranges[channel]
+    for data, condition_val in tubes:
+        ex.add_events(data, {condition_name: condition_val})
+    return ex
+
+
+def sample_experiment(
+    files: List[Tuple[str, str]],
+    condition_name: str,
+    events: int,
+    seed: int = 0,
+) -> flow.Experiment:
+    # Reads at most `events` random events from each (path, condition value)
+    tubes = [(sample_events(path, events, seed), condition_val) for path, condition_val in files]
+    return experiment_from_events(tubes, condition_name, read_header(files[0][0]))
+
+
+def stream_file(
+    path: Path,
+    condition_name: str,
+    condition_val: str,
+    models,
+    tree: GatingTree,
+    writer: EventWriter,
+    statistics: StatisticsAccumulator,
+    chunk_events: int,
+    cluster_statistics: Optional[StatisticsAccumulator] = None,
+    bins: Optional[EventBins] = None,
+    bin_spec: Optional[BinSpec] = None,
+    stored: Optional[Path] = None,
+    columns: Optional[List[str]] = None,
+) -> List[str]:
+    # Apply already-estimated models and the gating tree chunk by chunk,
+    # appending each chunk to the writer, the gate (and cluster) statistics
+    # and the binned plot counts. Only one chunk of events is held in memory
+    # at a time. Chunks with models applied are read from the columns of a
+    # stored cell matrix, if given, instead of the FCS file. Returns the
+    # columns of the events with models applied.
+    header = read_header(path)
+
+    if stored:
+        chunks = read_event_store(stored, chunk_events, [c for c in columns if c != condition_name])
+    else:
+        chunks = iter_chunks(path, chunk_events)
+    for i, chunk in enumerate(chunks):
+        if stored:
+            chunk[condition_name] = condition_val
+            data = EventTable.from_frame(chunk[columns], header.channels)
+        else:
+            ex = models.apply(experiment_from_events([(chunk, condition_val)], condition_name, header))
+            data = EventTable.from_frame(ex.data, ex.channels)
+            columns = data.columns
+        masks = tree.bind(data)
+        statistics.add(masks)
+        if cluster_statistics is not None:
+            cluster_statistics.add(cluster_statistics.tree.bind(data))
+        if bins is not None:
+            bins.add_events(data, masks, bin_spec)
+        add_gate_columns(data, masks)
+        writer.write(data.to_frame())
+        print(f"Processed {min((i + 1) * chunk_events, header.event_count)} of {header.event_count} events")
+    return columns
@@ -1,16 +1,24 @@
 from latch.resources.tasks import small_task
-from latch.types.directory import LatchOutputDir
+from latch.types.directory import LatchDir, LatchOutputDir
 from latch.types.file import LatchFile
 from latch.types.metadata import LatchAuthor, LatchMetadata, LatchParameter, MultiselectOption
 from dataclasses import dataclass
-from typing import Annotated, Iterable, List, Optional, Tuple, Union
+from enum import Enum
+from typing import Annotated, Callable, Dict, Iterable, List, Optional, Tuple, Union
 from pathlib import Path
-import cytoflow as flow
-import matplotlib
-from matplotlib import colormaps
-import seaborn as sns
-import matplotlib.pyplot as plt
-import pandas as pd
+import json
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+
+from wf.fetch import FILE_CACHE, FileCache, LocalStore, s3_version
+from wf.options import PlotOptions
+
+# Registering the workflow and starting a task container import this module,
+# so the analysis modules (cytoflow, pandas, scikit-learn, pyarrow) are only
+# imported inside the tasks that use them, and the plot renderers only when
+# plots are made.
 
 
 @dataclass
@@ -46,199 +54,634 @@ class ThresholdOp:
     # subset: str
     # subset_val: bool
 
+class GateType(Enum):
+    threshold = "threshold"
+    range = "range"
+    polygon = "polygon"
+    quad = "quad"
+
+@dataclass
+class Gate:
+    gate_name: str
+    gate_type: GateType
+    xchannel: str
+    # Name of the parent population (a gate, a quadrant such as Quad_2, or
+    # CellBulk_2); all events if empty
+    parent: Optional[str] = None
+    ychannel: Optional[str] = None
+    xthreshold: Optional[float] = None
+    ythreshold: Optional[float] = None
+    low: Optional[float] = None
+    high: Optional[float] = None
+    xvertices: Optional[List[float]] = None
+    yvertices: Optional[List[float]] = None
+
+class TransformType(Enum):
+    linear = "linear"
+    log = "log"
+    arcsinh = "arcsinh"
+    logicle = "logicle"
+
+@dataclass
+class ChannelTransform:
+    channel: str
+    transform: TransformType
+    cofactor: float = 150.0
+    # Logicle parameters T, W, M and A
+    top: float = 262144.0
+    width: float = 0.5
+    decades: float = 4.5
+    negative_decades: float = 0.0
+
+class ClusterMethod(Enum):
+    kmeans = "kmeans"
+    som = "som"
+
+class EmbeddingMethod(Enum):
+    none = "none"
+    pca = "pca"
+    umap = "umap"
+    tsne = "tsne"
+
+@dataclass
+class Clustering:
+    method: ClusterMethod
+    clusters: int = 10
+    # Compensated fluorescence channels if empty
+    channels: Optional[List[str]] = None
+    som_xdim: int = 10
+    som_ydim: int = 10
+    embedding: EmbeddingMethod = EmbeddingMethod.umap
+    embedding_events: int = 20000
+    seed: int = 0
+
+@dataclass
+class Experiment:
+    # An additional plate analysed with the main experiment's models and gates
+    experiment_name: str
+    fcs_files: List[FCS]
+
+@dataclass
+class FileInput:
+    # Everything a single map task needs to process one FCS file
+    index: int
+    experiment_name: str
+    fcs: FCS
+    condition_name: str
+    models: LatchFile
+    threshold_gate: Optional[ThresholdOp]
+    quad_gate: Optional[QuadOp]
+    remote_directory: str
+    plots: PlotOptions
+    chunk_events: Optional[int]
+    output_csv: bool
+    gates: Optional[List[Gate]]
+    profile: bool
+    transforms: Optional[List[ChannelTransform]] = None
+    incremental: bool = False
+    ranges: Optional[LatchFile] = None
+
+
+def plates(experiment_name: str, fcs_files: List[FCS], experiments: Optional[List[Experiment]]) -> List[Tuple[str, List[FCS]]]:
+    # The main experiment followed by the additional plates sharing its models
+    return [(experiment_name, fcs_files)] + [(e.experiment_name, e.fcs_files) for e in experiments or []]
+
+
+def download_latch_file(remote: str, local: Path):
+    shutil.move(LatchFile(remote).local_path, local)
+
+
+def latch_file_version(remote: str) -> Optional[str]:
+    # Size, version id and modification time of a file in Latch Data, or
+    # size, ETag and version id of an S3 object; None for other paths
+    import gql
+    from latch_cli.utils.path import normalize_path
+    from latch_sdk_gql.execute import execute
+
+    if remote.startswith("s3://"):
+        return s3_version(remote)
+    if not remote.startswith("latch://"):
+        return None
+    node = execute(
+        gql.gql("""
+        query getVersion($path: String!) {
+            ldataResolvePathToNode(path: $path) {
+                path
+                ldataNode {
+                    finalLinkTarget {
+                        ldataObjectMeta {
+                            contentSize
+                            versionId
+                            modifyTime
+                        }
+                    }
+                }
+            }
+        }
+        """),
+        {"path": normalize_path(remote)},
+    )["ldataResolvePathToNode"]
+    if node is None or node["ldataNode"] is None or node["path"]:
+        return None
+    meta = node["ldataNode"]["finalLinkTarget"]["ldataObjectMeta"]
+    if meta is None:
+        return None
+    return json.dumps(meta, sort_keys=True)
+
+
+def input_cache() -> FileCache:
+    # FLOW_CYTE_LOCAL_STORE points remote paths at a local directory instead
+    # of blob storage, e.g. for testing and benchmarks
+    store = os.environ.get("FLOW_CYTE_LOCAL_STORE")
+    if store:
+        local = LocalStore(Path(store))
+        return FileCache(FILE_CACHE, local.download, local.stat)
+    return FileCache(FILE_CACHE, download_latch_file, latch_file_version)
+
+
+def previous_run(remote_directory: str) -> Callable[[str], Optional[Path]]:
+    # Fetches files of a previous run from remote_directory, e.g. its
+    # checkpoints, or None where the previous run did not write them
+    store = os.environ.get("FLOW_CYTE_LOCAL_STORE")
+    download = LocalStore(Path(store)).download if store else download_latch_file
+
+    def fetch(relative_path: str) -> Optional[Path]:
+        local = Path(tempfile.mkdtemp()) / Path(relative_path).name
+        directory = remote_directory
+        while relative_path.startswith("../"):
+            directory, relative_path = directory.rsplit("/", 1)[0], relative_path[3:]
+        try:
+            download(f"{directory}/{relative_path}", local)
+        except Exception:
+            return None
+        return local
+
+    return fetch
+
+
+def previous_checkpoints(remote_directory: str, digest: str) -> Optional[Callable[[str], Optional[Path]]]:
+    # The checkpoints a previous run into remote_directory wrote for a file
+    # with this sha256, whatever its name or position in that run, from the
+    # run's checkpoints.json (see reduce_experiment)
+    index = previous_run(remote_directory)("checkpoints.json")
+    if index is None:
+        return None
+    with open(index) as f:
+        location = json.load(f).get(digest)
+    if location is None:
+        return None
+    return previous_run(f"{remote_directory}/{location}/checkpoints")
+
+
+def fetch_inputs(cache: FileCache, files: List[LatchFile]) -> List[str]:
+    # Local paths of the files, in order. Remote files are downloaded
+    # concurrently through the node's file cache before any compute starts.
+    remote = cache.fetch_all(f.remote_path for f in files if f.remote_path)
+    return [str(remote[f.remote_path]) if f.remote_path else f.local_path for f in files]
+
+
 @small_task
-def task(
+def estimate_task(
     experiment_name: str,
     fcs_files: List[FCS],
     condition_name: str,
     autofluoresence: Optional[AutofluorescenceOp],
     bleedthrough: Optional[List[BleedthroughLinearOp]],
-    threshold_gate: Optional[ThresholdOp],
-    quad_gate: Optional[QuadOp],
-    output_to_registry: Optional[str],
     output_directory: LatchOutputDir,
+    estimation_events: int = 100000,
+    estimation_seed: int = 0,
+    estimation_report: bool = False,
+    estimate_cache: Optional[LatchDir] = None,
+    make_plots: bool = True,
+    plot_dpi: int = 350,
+    density_plots: bool = True,
     marker_size: float = 0.5,
     marker_alpha: float = 0.7,
+    profile: bool = False,
+    experiments: Optional[List[Experiment]] = None,
+    clustering: Optional[Clustering] = None,
+    transforms: Optional[List[ChannelTransform]] = None,
+    incremental: bool = False,
+    header_spillover: bool = False,
+    threshold_gate: Optional[ThresholdOp] = None,
+    quad_gate: Optional[QuadOp] = None,
+    gates: Optional[List[Gate]] = None,
 ) -> LatchOutputDir:
-    
+    # Fit the GMM, autofluorescence, bleedthrough and clustering models once
+    # on a stratified subsample of every plate; the per-file map tasks only
+    # apply them.
+    from wf.cache import EstimateCache, cache_key
+    from wf.compensation import header_compensation
+    from wf.gates import gating_tree
+    from wf.headers import BLANK, CONTROL, InputFile, scan_headers
+    from wf.metrics import RunMetrics, profiled
+    from wf.models import save_models
+    from wf.pipeline import GMM_PARAMETERS, estimate_models, estimation_report as write_estimation_report
+    from wf.sampling import stratified_sample
+    from wf.transforms import ChannelTransforms
+
     print("Setting up local directories")
     local_output_directory = Path(f"/root/output_data/{experiment_name}")
     local_output_directory.mkdir(parents=True, exist_ok=True)
-    local_output_directory = Path(f"/root/output_data")
     print("Sample output directory: ", local_output_directory)
-    matplotlib.rc('figure', dpi = 350)
-
-    # INITIALIZE EXPERIMENT
-    tubes = []
-    for fcs_file in fcs_files:
-        tubes.append(flow.Tube(file = fcs_file.file.local_path, conditions = {condition_name : fcs_file.condition_val}))
-
-    import_op = flow.ImportOp(conditions = {condition_name : 'str'}, tubes = tubes)
-    ex = import_op.apply()
-
-    # Save initial scatterplot
-    flow.ScatterplotView(xchannel = "FSC-A",
-                     ychannel = "SSC-A",
-                     yscale = "log").plot(ex, alpha=marker_alpha, s=marker_size, marker=".")
-
-    path_png = f"/root/output_data/{experiment_name}/scatterplot.png"
-    plt.savefig(path_png, bbox_inches='tight')
-
-
-
-    # Initialize channels
-    channels = ex.channels
-
-
-    # Histograms
-    print("Making Histograms")
-    curr_output_directory = Path(f"/root/output_data/{experiment_name}/histograms/")
-    curr_output_directory.mkdir(parents=True, exist_ok=True)
-
-    for channel in channels:
-        # LOG
-        flow.HistogramView(channel = channel, scale="log", yfacet = condition_name).plot(ex)
-        path_png = f"/root/output_data/{experiment_name}/histograms/{channel}.png"
-        plt.savefig(path_png, bbox_inches='tight')
-
-    # Extract bulk of data
-    gm_1 = flow.GaussianMixtureOp(name = "CellBulk",
-                              channels = ["FSC-A", "SSC-A"],
-                              scale = {"SSC-A" : "log"},
-                              num_components = 2,
-                              sigma = 2)
-    gm_1.estimate(ex)
-    ex_morpho = gm_1.apply(ex)
-
-    flow.ScatterplotView(xchannel = "FSC-A",
-                        ychannel = "SSC-A",
-                        yscale = "log",
-                        huefacet = "CellBulk_2").plot(ex_morpho, s=marker_size, alpha=marker_alpha, marker=".")
-    
-    path_png = f"/root/output_data/{experiment_name}/gaussian_plot.png"
-    plt.savefig(path_png, bbox_inches='tight')
-
-
+    plots = PlotOptions(
+        enabled=make_plots,
+        dpi=plot_dpi,
+        density=density_plots,
+        marker_size=marker_size,
+        marker_alpha=marker_alpha)
+    if plots.enabled:
+        from wf.plots import setup
+        setup(plots)
+    metrics = RunMetrics(local_output_directory)
+
+    names = [name for name, plate in plates(experiment_name, fcs_files, experiments) for _ in plate]
+    fcs_files = [fcs_file for _, plate in plates(experiment_name, fcs_files, experiments) for fcs_file in plate]
+
+    print("Fetching input files")
+    file_cache = input_cache()
+    inputs = [fcs_file.file for fcs_file in fcs_files]
     if autofluoresence:
-        print("Autofluorescence")
-        curr_output_directory = Path(f"/root/output_data/{experiment_name}/autofluorescence/")
-        curr_output_directory.mkdir(parents=True, exist_ok=True)
-
-        af_op = flow.AutofluorescenceOp()
-        af_op.blank_file = autofluoresence.blank_file.local_path
-        af_op.channels = autofluoresence.fluor_channels
-
-        af_op.estimate(ex_morpho, subset = "CellBulk_2 == True")
-        af_op.default_view().plot(ex_morpho)
-        path_png = f"/root/output_data/{experiment_name}/autofluorescence/histograms.png"
-        plt.savefig(path_png, bbox_inches='tight')
-
-        ex_af = af_op.apply(ex_morpho)
-    else:
-        ex_af = ex_morpho
-
+        inputs.append(autofluoresence.blank_file)
     if bleedthrough:
-        print("Compensation Analysis")
-        curr_output_directory = Path(f"/root/output_data/{experiment_name}/bleedthrough/")
-        curr_output_directory.mkdir(parents=True, exist_ok=True)
-        bl_op = flow.BleedthroughLinearOp()
-        bl_op.controls = {bleedthrough[i].fluor_channel: bleedthrough[i].control_file.local_path for i in range(len(bleedthrough))}
-        bl_op.estimate(ex_af, subset = "CellBulk_2 == True")
-        bl_op.default_view().plot(ex_af)
-        path_png = f"/root/output_data/{experiment_name}/bleedthrough/compensation_matrix.png"
-        plt.savefig(path_png, bbox_inches='tight')
-        ex_bl = bl_op.apply(ex_af)
-    else:
-        ex_bl = ex_af
-
-    # THRESHOLD GATE
-    if threshold_gate:
-        curr_output_directory = Path(f"/root/output_data/{experiment_name}/threshold_gate/")
-        curr_output_directory.mkdir(parents=True, exist_ok=True)
+        inputs.extend(b.control_file for b in bleedthrough)
+    with metrics.stage("fetch_inputs", files=len(inputs)):
+        paths = fetch_inputs(file_cache, inputs)
+
+    n = len(fcs_files)
+    files = [(path, fcs_file.condition_val) for path, fcs_file in zip(paths, fcs_files)]
+    blank_file = paths[n] if autofluoresence else None
+    controls = dict(zip((b.fluor_channel for b in bleedthrough), paths[n + bool(autofluoresence):])) if bleedthrough else None
+
+    # Check every channel the models, gates and transforms name against the
+    # FCS headers before any events are read
+    with metrics.stage("scan_headers", files=len(paths)):
+        index = scan_headers(
+            [InputFile(path, experiment=name, condition_value=value) for (path, value), name in zip(files, names)]
+            + ([InputFile(blank_file, BLANK)] if blank_file else [])
+            + [InputFile(path, CONTROL) for path in (controls or {}).values()])
+        index.save(local_output_directory / "fcs_index.csv")
+        index.validate({
+            "Gaussian mixture": GMM_PARAMETERS["channels"],
+            "gates": gating_tree(threshold_gate, quad_gate, gates).channels,
+            "autofluorescence": autofluoresence.fluor_channels if autofluoresence else None,
+            "compensation": list(controls or {}),
+            "clustering": clustering.channels if clustering else None,
+            "transforms": [t.channel for t in transforms or []],
+        }, header_spillover=header_spillover and not bleedthrough)
+
+    # One range per channel for the whole run, the largest $PnR of any FCS
+    # file, which every map task scales and bins channels on
+    ranges = index.ranges
+    with open(local_output_directory / "channel_ranges.json", "w") as f:
+        json.dump(ranges, f, indent=2)
+    header = index.samples[0]
+    channel_transforms = ChannelTransforms(transforms, ranges)
+    spillover = header_compensation(header) if header_spillover and not bleedthrough else None
+
+    def load_experiment():
+        print(f"Sampling {estimation_events} events across {len(files)} tubes for estimation")
+        with metrics.stage("sample", events=estimation_events):
+            return stratified_sample(files, condition_name, estimation_events, estimation_seed)
+
+    # New estimates are written to this run's output; a previous run's
+    # estimate_cache folder can be passed in to reuse its models, and
+    # incremental runs also reuse those of the previous run written to the
+    # same output directory
+    remote_output = f"{output_directory.remote_path}/{experiment_name}"
+    cache = EstimateCache(
+        local_output_directory / "estimate_cache",
+        search=[Path(estimate_cache.local_path)] if estimate_cache else None,
+        remote=previous_run(f"{remote_output}/estimate_cache") if incremental else None)
+    sample_key = cache_key(
+        [file_cache.digest(path) for path, _ in files],
+        estimation_events,
+        estimation_seed)
+
+    with profiled(local_output_directory / "profile" / "estimate.prof" if profile else None):
+        models = estimate_models(
+            load_experiment,
+            local_output_directory,
+            blank_file=blank_file,
+            fluor_channels=autofluoresence.fluor_channels if autofluoresence else None,
+            controls=controls,
+            plots=plots,
+            cache=cache,
+            sample_key=sample_key,
+            metrics=metrics,
+            clustering=clustering,
+            transforms=channel_transforms,
+            spillover=spillover)
+    save_models(models, local_output_directory / "models.json")
+
+    if estimation_report:
+        with metrics.stage("estimation_report"):
+            write_estimation_report(
+                models.gmm,
+                files,
+                condition_name,
+                estimation_events,
+                estimation_seed,
+                local_output_directory / "estimation_report.json")
+
+    metrics.write(local_output_directory / "metrics" / "estimate.json")
+
+    return LatchOutputDir(str(local_output_directory), remote_output)
+
 
-        thresh_op = flow.ThresholdOp(name = threshold_gate.gate_name, channel = threshold_gate.channel, threshold = threshold_gate.threshold)
-        tv = thresh_op.default_view(scale = 'log')
-        tv.plot(ex_bl)
+@small_task
+def prepare_task(
+    experiment_name: str,
+    fcs_files: List[FCS],
+    condition_name: str,
+    estimates: LatchDir,
+    threshold_gate: Optional[ThresholdOp],
+    quad_gate: Optional[QuadOp],
+    make_plots: bool = True,
+    plot_dpi: int = 350,
+    density_plots: bool = True,
+    marker_size: float = 0.5,
+    marker_alpha: float = 0.7,
+    chunk_events: Optional[int] = None,
+    output_csv: bool = False,
+    gates: Optional[List[Gate]] = None,
+    profile: bool = False,
+    experiments: Optional[List[Experiment]] = None,
+    transforms: Optional[List[ChannelTransform]] = None,
+    incremental: bool = False,
+) -> List[FileInput]:
+    # Fail before fanning out if the gate hierarchy or a transform is invalid
+    from wf.gates import gating_tree
+    from wf.transforms import ChannelTransforms
+    gating_tree(threshold_gate, quad_gate, gates)
+    ChannelTransforms(transforms)
+    names = [name for name, _ in plates(experiment_name, fcs_files, experiments)]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Experiment names must be unique: {names}")
+
+    plots = PlotOptions(
+        enabled=make_plots,
+        dpi=plot_dpi,
+        density=density_plots,
+        marker_size=marker_size,
+        marker_alpha=marker_alpha)
+    models = LatchFile(f"{estimates.remote_path}/models.json")
+    ranges = LatchFile(f"{estimates.remote_path}/channel_ranges.json")
+    # Every plate is written next to the main experiment's folder
+    remote_root = estimates.remote_path.rstrip("/").rsplit("/", 1)[0]
+    files = [
+        (name, fcs_file)
+        for name, plate in plates(experiment_name, fcs_files, experiments)
+        for fcs_file in plate
+    ]
+    return [
+        FileInput(
+            index=i,
+            experiment_name=name,
+            fcs=fcs_file,
+            condition_name=condition_name,
+            models=models,
+            threshold_gate=threshold_gate,
+            quad_gate=quad_gate,
+            remote_directory=f"{remote_root}/{name}",
+            plots=plots,
+            chunk_events=chunk_events,
+            output_csv=output_csv,
+            gates=gates,
+            profile=profile,
+            transforms=transforms,
+            incremental=incremental,
+            ranges=ranges)
+        for i, (name, fcs_file) in enumerate(files)
+    ]
 
-        path_png = f"/root/output_data/{experiment_name}/threshold_gate/threshold_plot.png"
-        plt.savefig(path_png, bbox_inches='tight')
 
-        ex_tv = thresh_op.apply(ex_bl)
-        print("Threshold Gate:")
-        print(ex_tv.data.groupby(threshold_gate.gate_name).size())
-    else:
-        ex_tv = ex_bl
+@small_task
+def apply_task(input: FileInput) -> LatchDir:
+    from wf.cache import EstimateCache
+    from wf.metrics import RunMetrics, profiled
+    from wf.models import load_models
+    from wf.pipeline import process_file
+
+    metrics = RunMetrics(Path(f"/root/output_data/{input.experiment_name}/files"))
+    cache = input_cache()
+    with metrics.stage("fetch_inputs"):
+        local_path = Path(fetch_inputs(cache, [input.fcs.file])[0])
+    file_name = f"{input.index:04d}_{local_path.stem}"
+    local_output_directory = Path(f"/root/output_data/{input.experiment_name}/files/{file_name}")
+    local_output_directory.mkdir(parents=True, exist_ok=True)
+    metrics.output_directory = local_output_directory
+    print("File output directory: ", local_output_directory)
+    if input.plots.enabled:
+        from wf.plots import setup
+        setup(input.plots)
+
+    with metrics.stage("load_models"):
+        models = load_models(Path(input.models.local_path))
+        ranges = None
+        if input.ranges is not None:
+            with open(input.ranges.local_path) as f:
+                ranges = json.load(f)
+    # Incremental runs restore unchanged stages from the checkpoints the
+    # previous run into the same output directory wrote for a file with the
+    # same contents
+    checkpoints = None
+    if input.incremental:
+        digest = cache.digest(local_path)
+        checkpoints = EstimateCache(
+            local_output_directory / "checkpoints",
+            remote=previous_checkpoints(input.remote_directory, digest))
+        with open(local_output_directory / "checkpoints" / "source.json", "w") as f:
+            json.dump({"sha256": digest}, f)
+    with profiled(local_output_directory / "profile" / "apply.prof" if input.profile else None):
+        process_file(
+            local_path,
+            input.condition_name,
+            input.fcs.condition_val,
+            models,
+            local_output_directory,
+            threshold_gate=input.threshold_gate,
+            quad_gate=input.quad_gate,
+            plots=input.plots,
+            chunk_events=input.chunk_events,
+            output_csv=input.output_csv,
+            gates=input.gates,
+            metrics=metrics,
+            transforms=input.transforms,
+            checkpoints=checkpoints,
+            ranges=ranges)
+
+    metrics.record_outputs()
+    metrics.write(local_output_directory / "run_metrics.json")
+    return LatchDir(str(local_output_directory), f"{input.remote_directory}/files/{file_name}")
+
+
+def fetch_result(result: LatchDir, relative_path: str) -> Path:
+    # Only fetch the per-file tables, not the per-file plots
+    return Path(LatchFile(f"{result.remote_path}/{relative_path}").local_path)
+
+
+def reduce_experiment(
+    experiment_name: str,
+    fcs_files: List[FCS],
+    condition_name: str,
+    results: List[LatchDir],
+    quad_gate: Optional[QuadOp],
+    output_csv: bool = False,
+    estimates: Optional[LatchDir] = None,
+    clusters: bool = False,
+    make_plots: bool = False,
+    shared_estimate: bool = False,
+    incremental: bool = False,
+) -> Path:
+    from wf.bins import merge_bins
+    from wf.export import merge_csvs, merge_quadrant_statistics, partition_path
+    from wf.metrics import RunMetrics, summarize_gates, summarize_stages
 
+    local_output_directory = Path(f"/root/output_data/{experiment_name}")
+    local_output_directory.mkdir(parents=True, exist_ok=True)
+    metrics = RunMetrics(local_output_directory)
+
+    # Map task outputs are in the same order as fcs_files
+    print(f"Partitioning cell matrix by condition for {experiment_name}")
+    with metrics.stage("partition_cell_matrix"):
+        for fcs_file, result in zip(fcs_files, results):
+            file_name = result.remote_path.rstrip("/").split("/")[-1]
+            partition = local_output_directory / partition_path(condition_name, fcs_file.condition_val, file_name)
+            partition.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(fetch_result(result, "cell_matrix.parquet"), partition)
+
+    with metrics.stage("merge_statistics"):
+        merge_csvs(
+            [fetch_result(result, "statistics.csv") for result in results],
+            local_output_directory / "statistics.csv")
+
+    if clusters:
+        with metrics.stage("merge_cluster_statistics"):
+            merge_csvs(
+                [fetch_result(result, "cluster_statistics.csv") for result in results],
+                local_output_directory / "cluster_statistics.csv")
+
+    if output_csv:
+        print("Merging cell matrices")
+        with metrics.stage("merge_cell_matrix_csv"):
+            merge_csvs(
+                [fetch_result(result, "cell_matrix.csv") for result in results],
+                local_output_directory / "cell_matrix.csv")
 
-    # QUAD GATE
     if quad_gate:
-        print("Quadrant Gate")
-        curr_output_directory = Path(f"/root/output_data/{experiment_name}/quadrant_gate/")
+        curr_output_directory = local_output_directory / "quadrant_gate"
         curr_output_directory.mkdir(parents=True, exist_ok=True)
+        with metrics.stage("merge_quadrant_statistics"):
+            merge_quadrant_statistics(
+                [fetch_result(result, "quadrant_gate/quadrant_statistics.csv") for result in results],
+                curr_output_directory / "quadrant_statistics.csv")
+
+    if make_plots:
+        # Binned plot counts summed per condition, for viewers that draw
+        # histograms and densities without the events
+        print("Merging histograms per condition")
+        with metrics.stage("merge_histograms"):
+            by_condition: Dict[str, List[Path]] = {}
+            for fcs_file, result in zip(fcs_files, results):
+                by_condition.setdefault(fcs_file.condition_val, []).append(fetch_result(result, "histograms.npz"))
+            for condition_val, paths in by_condition.items():
+                name = f"{quote(condition_name, safe='')}={quote(str(condition_val), safe='')}.npz"
+                merge_bins(paths, local_output_directory / "histograms" / name)
+
+    def load(path: Path) -> dict:
+        with open(path) as f:
+            return json.load(f)
+
+    if incremental:
+        # Where the checkpoints of each file are, by the file's sha256, for
+        # the next incremental run (see apply_task)
+        index = {}
+        for result in results:
+            file_name = result.remote_path.rstrip("/").split("/")[-1]
+            index[load(fetch_result(result, "checkpoints/source.json"))["sha256"]] = f"files/{file_name}"
+        with open(local_output_directory / "checkpoints.json", "w") as f:
+            json.dump(index, f, indent=2)
+
+    print("Writing run metrics")
+    estimate = load(fetch_result(estimates, "metrics/estimate.json")) if estimates else None
+    files = {
+        result.remote_path.rstrip("/").split("/")[-1]: load(fetch_result(result, "run_metrics.json"))
+        for result in results
+    }
+    metrics.record_outputs()
+    reduce = metrics.to_dict()
+    # An estimate shared by several plates is only totalled once, in the
+    # batch metrics
+    runs = ([estimate] if estimate and not shared_estimate else []) + list(files.values()) + [reduce]
+    run_metrics = {
+        "experiment_name": experiment_name,
+        "stage_totals": summarize_stages(runs),
+        "gate_totals": summarize_gates(files.values()),
+        "estimate": estimate,
+        "estimate_shared": shared_estimate,
+        "files": files,
+        "reduce": reduce,
+    }
+    with open(local_output_directory / "run_metrics.json", "w") as f:
+        json.dump(run_metrics, f, indent=2)
+
+    return local_output_directory
 
-        q = flow.QuadOp(name=quad_gate.gate_name,
-            xchannel=quad_gate.xchannel,
-            xthreshold=quad_gate.xthreshold,
-            ychannel=quad_gate.ychannel,
-            ythreshold=quad_gate.ythreshold)
-
-        qv = q.default_view(huefacet = condition_name,
-                    xscale = "log",
-                    yscale = "log")
-
-        palette = plt.get_cmap('jet').copy()
-        palette.set_under('white', 1.0)
 
-        qv.plot(ex_tv, cmap=palette,line_props={"color" : 'black', "linewidth" : 1},marker=".",s=0.5, alpha=marker_alpha)
-
-        exq = q.apply(ex_tv)
-        quad_array = exq.data.groupby(quad_gate.gate_name).size()
-
-        string = quad_gate.gate_name
-        sum_q = sum(quad_array)
-        print(sum_q)
-
-        q1 = quad_array[0]
-        plt.text(0.05, 0.95, f'Q1: {round((q1/sum_q)*100,2)}%',
-            horizontalalignment='left',
-            verticalalignment='top', color='red',transform=plt.gca().transAxes)
-
-        q2 = quad_array[1]
-        plt.text(0.95, 0.95, f'Q2: {round((q2/sum_q)*100,2)}%',
-            horizontalalignment='right',
-            verticalalignment='top', color='red',transform=plt.gca().transAxes)
-
-        q3 = quad_array[2]
-        plt.text(0.05, 0.05, f'Q3: {round((q3/sum_q)*100,2)}%',
-            horizontalalignment='left',
-            verticalalignment='bottom', color='red', transform=plt.gca().transAxes)
-
-        q4 = quad_array[3]
-        plt.text(0.95, 0.05, f'Q4: {round((q4/sum_q)*100,2)}%',
-            horizontalalignment='right',
-            verticalalignment='bottom', color='red',transform=plt.gca().transAxes)
-        
-        plt.legend(bbox_to_anchor=(1.05, 1), loc="upper left", markerscale=20, fontsize=10)
-
-        path_png = f"/root/output_data/{experiment_name}/quadrant_gate/scatterplot.png"
-        plt.savefig(path_png, bbox_inches='tight')
-
-        quads = ["Q1", "Q2", "Q3", "Q4"]
-        names = [f"{quad_gate.gate_name}_1", f"{quad_gate.gate_name}_2",f"{quad_gate.gate_name}_3",f"{quad_gate.gate_name}_4"]
-        quad_array = quad_array
-
-        quadrant_data = pd.DataFrame(
-            {'quadrant': quads,
-            'quadrant_name': names,
-            'cells': quad_array
-            })
-        csv_path = f"/root/output_data/{experiment_name}/quadrant_gate/quadrant_statistics.csv"
-        quadrant_data.to_csv(csv_path, index=False)
-
-    else:
-        exq = ex_tv
-
-    csv_path = f"/root/output_data/{experiment_name}/cell_matrix.csv"
-    exq.data.to_csv(csv_path, index=False)
-
-    return LatchOutputDir(str(local_output_directory), str(output_directory.remote_path))
\ No newline at end of file
+@small_task
+def reduce_task(
+    experiment_name: str,
+    fcs_files: List[FCS],
+    condition_name: str,
+    results: List[LatchDir],
+    quad_gate: Optional[QuadOp],
+    output_to_registry: Optional[str],
+    output_directory: LatchOutputDir,
+    output_csv: bool = False,
+    estimates: Optional[LatchDir] = None,
+    experiments: Optional[List[Experiment]] = None,
+    clustering: Optional[Clustering] = None,
+    make_plots: bool = True,
+    incremental: bool = False,
+) -> LatchOutputDir:
+    # Map task outputs are in plate order, then file order within a plate
+    directories = []
+    start = 0
+    for name, plate in plates(experiment_name, fcs_files, experiments):
+        directories.append((name, reduce_experiment(
+            name,
+            plate,
+            condition_name,
+            results[start:start + len(plate)],
+            quad_gate,
+            output_csv,
+            estimates,
+            clustering is not None,
+            make_plots,
+            shared_estimate=bool(experiments),
+            incremental=incremental)))
+        start += len(plate)
+
+    if experiments:
+        import pandas as pd
+
+        print("Combining statistics across experiments")
+        combined = []
+        for name, directory in directories:
+            table = pd.read_csv(directory / "statistics.csv", dtype={condition_name: str})
+            table.insert(0, "experiment", name)
+            combined.append(table)
+        pd.concat(combined).to_csv(directories[0][1] / "batch_statistics.csv", index=False)
+
+        from wf.metrics import summarize_batch
+
+        print("Combining run metrics across experiments")
+        plate_metrics = {}
+        for name, directory in directories:
+            with open(directory / "run_metrics.json") as f:
+                plate_metrics[name] = json.load(f)
+        with open(directories[0][1] / "batch_run_metrics.json", "w") as f:
+            json.dump(summarize_batch(plate_metrics, experiment_name), f, indent=2)
+
+    return LatchOutputDir("/root/output_data", str(output_directory.remote_path))
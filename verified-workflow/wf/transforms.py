@@ -0,0 +1,222 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Per-channel scale transforms, applied once per event table and kept as
+# float32 arrays that every plot (and the clustering stage) reads, instead of
+# each view rescaling the raw channel on its own. Every transform is defined
+# for all values, so negative compensated values are handled the same way
+# everywhere:
+#   linear:  x
+#   log:     log10(x), non-positive values are dropped (NaN)
+#   arcsinh: arcsinh(x / cofactor)
+#   logicle: the logicle scale of Parks et al. with parameters T (top), W
+#            (width of the linear region, decades), M (decades) and A
+#            (additional negative decades); 0..1 maps to 0..T
+# Gate limits stay in channel units; only their drawn position is
+# transformed.
+
+TRANSFORM_TYPES = ("linear", "log", "arcsinh", "logicle")
+
+LOGICLE_POINTS = 65537
+
+
+@lru_cache(maxsize=None)
+def _logicle(top: float, width: float, decades: float, negative_decades: float) -> Tuple:
+    # Parameters of the biexponential B(y) = a e^(b y) - c e^(-d y) + f
+    # (Moore and Parks 2012), whose inverse is the logicle scale
+    w = width / (decades + negative_decades)
+    x2 = negative_decades / (decades + negative_decades)
+    x1 = x2 + w
+    x0 = x2 + 2 * w
+    b = (decades + negative_decades) * np.log(10)
+
+    # d solves 2 (ln d - ln b) + w (b + d) = 0 on (0, b]
+    d = b
+    if w > 0:
+        low, high = 0.0, b
+        for _ in range(200):
+            d = (low + high) / 2
+            if 2 * (np.log(d) - np.log(b)) + w * (b + d) > 0:
+                high = d
+            else:
+                low = d
+
+    c_a = np.exp(x0 * (b + d))
+    mf_a = np.exp(b * x1) - c_a / np.exp(d * x1)
+    a = top / (np.exp(b) - mf_a - c_a / np.exp(d))
+    return a, b, c_a * a, d, -mf_a * a, x1
+
+
+def _logicle_inverse(y: np.ndarray, parameters: Tuple) -> np.ndarray:
+    a, b, c, d, f, x1 = parameters
+    y = np.asarray(y, dtype=np.float64)
+    negative = y < x1
+    y = np.where(negative, 2 * x1 - y, y)
+    x = a * np.exp(b * y) - c * np.exp(-d * y) + f
+    return np.where(negative, -x, x)
+
+
+@lru_cache(maxsize=None)
+def _logicle_table(top: float, width: float, decades: float, negative_decades: float) -> Tuple[np.ndarray, np.ndarray]:
+    # Logicle has no closed form, so B(y) is tabulated once from -T to T and
+    # inverted by interpolation
+    parameters = _logicle(top, width, decades, negative_decades)
+    y = np.linspace(2 * parameters[-1] - 1, 1, LOGICLE_POINTS)
+    return _logicle_inverse(y, parameters), y
+
+
+@dataclass
+class Transform:
+    kind: str = "linear"
+    cofactor: float = 150.0
+    top: float = 262144.0
+    width: float = 0.5
+    decades: float = 4.5
+    negative_decades: float = 0.0
+
+    @property
+    def label(self) -> str:
+        return self.kind
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        if self.kind == "linear":
+            scaled = values
+        elif self.kind == "log":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                scaled = np.where(values > 0, np.log10(np.where(values > 0, values, 1.0)), np.nan)
+        elif self.kind == "arcsinh":
+            scaled = np.arcsinh(values / self.cofactor)
+        else:
+            x, y = _logicle_table(self.top, self.width, self.decades, self.negative_decades)
+            x1 = _logicle(self.top, self.width, self.decades, self.negative_decades)[-1]
+            scaled = np.interp(values, x, y)
+            # Beyond +-T the scale continues as its asymptotic log scale
+            beyond = np.abs(values) > self.top
+            if beyond.any():
+                extra = np.log10(np.abs(values[beyond]) / self.top) / (self.decades + self.negative_decades)
+                scaled[beyond] = np.where(values[beyond] > 0, 1 + extra, 2 * x1 - 1 - extra)
+        return scaled.astype(np.float32)
+
+    def inverse(self, scaled: np.ndarray) -> np.ndarray:
+        scaled = np.asarray(scaled, dtype=np.float64)
+        if self.kind == "linear":
+            return scaled
+        if self.kind == "log":
+            return 10 ** scaled
+        if self.kind == "arcsinh":
+            return np.sinh(scaled) * self.cofactor
+        return _logicle_inverse(scaled, _logicle(self.top, self.width, self.decades, self.negative_decades))
+
+    def domain(self, value_range: float) -> Tuple[float, float]:
+        # Fixed span of the transformed scale for a channel with this $PnR
+        # range, so that binned counts from different files line up
+        if self.kind == "linear":
+            return 0.0, float(value_range)
+        if self.kind == "log":
+            return 0.0, float(np.log10(value_range))
+        low, high = self.apply(np.array([-0.01 * value_range, value_range]))
+        return float(low), float(high)
+
+    def ticks(self, low: float, high: float) -> Tuple[List[float], List[str]]:
+        # Axis ticks at 0 and at powers of ten of the channel values, for an
+        # axis spanning low..high on the transformed scale
+        if self.kind == "linear":
+            return [], []
+        # 0 first, then decades from the largest down, so that ticks crowded
+        # in the linear part of the scale are the ones dropped
+        candidates = [(0.0, "0")]
+        for k in range(9, -1, -1):
+            candidates += [(10.0 ** k, f"$10^{{{k}}}$"), (-10.0 ** k, f"$-10^{{{k}}}$")]
+        positions = self.apply(np.array([v for v, _ in candidates]))
+
+        ticks = []
+        for position, (_, label) in zip(positions, candidates):
+            if not np.isfinite(position) or position < low or position > high:
+                continue
+            if all(abs(position - p) > 0.04 * (high - low) for p, _ in ticks):
+                ticks.append((float(position), label))
+        ticks.sort()
+        return [p for p, _ in ticks], [l for _, l in ticks]
+
+
+def transform(t) -> Transform:
+    # Normalises a workflow ChannelTransform input
+    kind = getattr(t, "transform", None)
+    kind = getattr(kind, "value", kind)
+    if kind not in TRANSFORM_TYPES:
+        raise ValueError(f"Transform for {t.channel}: unknown transform {kind}")
+
+    spec = Transform(
+        kind=kind,
+        cofactor=t.cofactor,
+        top=t.top,
+        width=t.width,
+        decades=t.decades,
+        negative_decades=t.negative_decades)
+    if kind == "arcsinh" and spec.cofactor <= 0:
+        raise ValueError(f"Transform for {t.channel}: the arcsinh cofactor must be positive")
+    if kind == "logicle":
+        if spec.top <= 0 or spec.decades <= 0 or spec.width < 0 or spec.negative_decades < 0:
+            raise ValueError(f"Transform for {t.channel}: logicle needs top > 0, decades > 0, width >= 0 and negative decades >= 0")
+        if 2 * spec.width > spec.decades:
+            raise ValueError(f"Transform for {t.channel}: logicle width can be at most half the decades")
+    return spec
+
+
+def default_transform(channel: str, top: Optional[float] = None) -> Transform:
+    # Scatter channels keep their usual linear (FSC) and log (SSC) scales;
+    # fluorescence channels use logicle so compensated negatives are kept
+    name = channel.upper()
+    if name.startswith("FSC") or name.startswith("TIME"):
+        return Transform("linear")
+    if name.startswith("SSC"):
+        return Transform("log")
+    return Transform("logicle", top=float(top) if top else Transform.top)
+
+
+class ChannelTransforms:
+    def __init__(self, transforms: Optional[Iterable] = None, ranges: Optional[Dict[str, float]] = None):
+        # transforms are workflow ChannelTransform inputs; channels without one
+        # use default_transform with their $PnR range as the logicle top
+        self.transforms: Dict[str, Transform] = {}
+        for t in transforms or []:
+            if t.channel in self.transforms:
+                raise ValueError(f"Channel {t.channel} has more than one transform")
+            self.transforms[t.channel] = transform(t)
+        self.ranges = dict(ranges or {})
+
+    def __getitem__(self, channel: str) -> Transform:
+        if channel not in self.transforms:
+            self.transforms[channel] = default_transform(channel, self.ranges.get(channel))
+        return self.transforms[channel]
+
+    def domain(self, channel: str) -> Tuple[float, float]:
+        return self[channel].domain(self.ranges.get(channel) or Transform.top)
+
+
+class ScaledEvents:
+    # An event table with its transformed channels. Each channel is
+    # transformed at most once, to float32.
+
+    def __init__(self, data: pd.DataFrame, transforms: ChannelTransforms, scaled: Optional[Dict[str, np.ndarray]] = None):
+        self.data = data
+        self.transforms = transforms
+        self._scaled: Dict[str, np.ndarray] = dict(scaled or {})
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def scaled(self, channel: str) -> np.ndarray:
+        if channel not in self._scaled:
+            self._scaled[channel] = self.transforms[channel].apply(self.data[channel].to_numpy())
+        return self._scaled[channel]
+
+    def precompute(self, channels: Iterable[str]):
+        for channel in channels:
+            self.scaled(channel)